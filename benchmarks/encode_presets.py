@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+''' Report zmovie encode time and file size for each encoder preset on a
+    synthetic stack of frames. Requires ffmpeg on the path.
+
+    python benchmarks/encode_presets.py [--frames N] [--size WxH] '''
+
+import os
+import sys
+import time
+import tempfile
+from argparse import ArgumentParser
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from omero_scripts.analysis.zmovie import (FFmpegPipeWriter,  # noqa: E402
+                                           encode_args)
+
+PRESETS = [
+    ('mp4', 'libx264', ['ultrafast', 'veryfast', 'medium', 'slow']),
+    ('webm', 'libvpx-vp9', ['8', '4']),
+    ('webp', 'libwebp', ['default'])
+]
+
+
+def synthetic_frames(count, w, h):
+    ''' Smooth gradients with a moving blob and some noise, standing in for
+        the planes of a cycle '''
+    rng = numpy.random.RandomState(0)
+    yy, xx = numpy.mgrid[0:h, 0:w]
+    for i in range(count):
+        cx = w * (i + 1) / (count + 1)
+        blob = numpy.exp(-((xx - cx) ** 2 + (yy - h / 2) ** 2) /
+                         (2 * (min(w, h) / 6) ** 2))
+        frame = numpy.empty((h, w, 3), dtype=numpy.uint8)
+        for c in range(3):
+            channel = 255 * blob * (c + 1) / 3 + rng.normal(0, 8, (h, w))
+            frame[:, :, c] = numpy.clip(channel, 0, 255)
+        yield frame
+
+
+def main(argv=sys.argv):
+
+    parser = ArgumentParser(description='Benchmark zmovie encoder presets')
+    parser.add_argument('--frames', type=int, default=40)
+    parser.add_argument('--size', default='1024x1024')
+    args = parser.parse_args(argv[1:])
+
+    w, h = (int(v) for v in args.size.split('x'))
+    frames = list(synthetic_frames(args.frames, w, h))
+
+    print('format, codec, preset, seconds, bytes')
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt, codec, presets in PRESETS:
+            for preset in presets:
+                output_file = os.path.join(tmp, 'bench.{}'.format(fmt))
+                writer = FFmpegPipeWriter(output_file, 1,
+                                          encode_args(codec, preset=preset))
+
+                start = time.time()
+                for frame in frames:
+                    writer.write(frame)
+                returncode = writer.close()
+                elapsed = time.time() - start
+
+                if returncode != 0:
+                    print('{}, {}, {}, failed, -'.format(fmt, codec, preset))
+                    continue
+
+                print('{}, {}, {}, {:.2f}, {}'.format(
+                    fmt, codec, preset, elapsed, os.path.getsize(output_file)
+                ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,756 @@
+''' A stand-in for BlitzGateway and its query service, serving a synthetic
+    catalog of users, projects of datasets, screens of 1536 well plates and
+    their images, and multi-channel rendered planes, so that the scripts can
+    be benchmarked without an OMERO server.
+
+    The query service recognises the queries made by the scripts by their
+    from clause, and generates the rows they would return already filtered,
+    ordered and paged, as OMERO rtypes. Objects are numbered in order, so
+    that the rows of any page are computed from its position rather than
+    stored, and millions of images cost nothing to hold. A query it does not
+    recognise raises FakeQueryError.
+
+    Requires omero-py for the rtypes and parameters, and numpy and OpenCV
+    for rendered planes. install(catalog) replaces omero.gateway.BlitzGateway
+    so that every connection made by OMEROConnectionManager is to the fake '''
+
+import re
+import time
+import uuid
+import datetime
+import threading
+from itertools import islice
+
+WELL_ROWS = 32
+WELL_COLUMNS = 48
+WELLS = WELL_ROWS * WELL_COLUMNS
+
+# Every object was last updated by the one synthetic event, at the start of
+# the first day of imports
+EVENT_ID = 1
+EPOCH = datetime.datetime(2020, 1, 1)
+EVENT_TIME = int((EPOCH - datetime.datetime(1970, 1, 1)).total_seconds() *
+                 1000)
+DAY = 24 * 60 * 60 * 1000
+
+# strftime formats of the periods of TO_CHAR
+PERIODS = {
+    'yyyy': '%Y',
+    'yyyy-mm': '%Y-%m',
+    'yyyy-mm-dd': '%Y-%m-%d'
+}
+
+
+class FakeQueryError(Exception):
+    pass
+
+
+class Catalog(object):
+    ''' The synthetic contents of the fake server. IDs are assigned in order:
+        each project has the same number of datasets, each dataset of images
+        and so on, with the images of the screens following those of the
+        projects. Each image was imported on one of a number of consecutive
+        days, in turn by ID '''
+
+    def __init__(self, users=20, groups=4, projects=10, datasets=10,
+                 images=1000, screens=2, plates=20, fields=4, days=365,
+                 size_z=10, size_t=10, size_c=4, size_xy=2048, tile_size=512,
+                 levels=3, latency=0.0, collation=None):
+        self.users = users
+        self.groups = groups
+        self.projects = projects
+        self.datasets = datasets
+        self.images = images
+        self.screens = screens
+        self.plates = plates
+        self.fields = fields
+        self.days = days
+        self.size_z = size_z
+        self.size_t = size_t
+        self.size_c = size_c
+        self.size_xy = size_xy
+        self.tile_size = tile_size
+        self.levels = levels
+
+        # Seconds added to every query and rendering call, standing in for
+        # the round trip to a server
+        self.latency = latency
+
+        # Key by which names are ordered, standing in for the collation of
+        # the server's database, e.g. str.lower to ignore case. By default
+        # names are ordered by code point
+        self.collation = collation
+
+        self.project_images = projects * datasets * images
+        self.well_samples = screens * plates * WELLS * fields
+        self.total_images = self.project_images + self.well_samples
+
+        self.lock = threading.Lock()
+        self.rendered = {}
+        self.import_counts = None
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    # Owners. Each project and screen belongs to a user, as do their
+    # children, and each user to a group
+
+    def collate(self, name):
+        return name if self.collation is None else self.collation(name)
+
+    def user_name(self, user):
+        return 'user{}'.format(user)
+
+    def group_of(self, user):
+        return user % self.groups
+
+    def group_name(self, group):
+        return 'group{}'.format(group)
+
+    def project_owner(self, project):
+        return (project - 1) % self.users
+
+    def screen_owner(self, screen):
+        return (self.projects + screen - 1) % self.users
+
+    # Parents
+
+    def dataset_project(self, dataset):
+        return (dataset - 1) // self.datasets + 1
+
+    def image_dataset(self, image):
+        return (image - 1) // self.images + 1
+
+    def plate_screen(self, plate):
+        return (plate - 1) // self.plates + 1
+
+    def well_plate(self, well):
+        return (well - 1) // WELLS + 1
+
+    def image_owner(self, image):
+        if image <= self.project_images:
+            return self.project_owner(self.dataset_project(
+                self.image_dataset(image)))
+        well = (image - self.project_images - 1) // self.fields + 1
+        return self.screen_owner(self.plate_screen(self.well_plate(well)))
+
+    def well_sample_image(self, well, field):
+        return self.project_images + (well - 1) * self.fields + field + 1
+
+    def daily_imports(self):
+        ''' Number of images imported by each user on each day, counted from
+            the ranges of image IDs each owns '''
+
+        with self.lock:
+            if self.import_counts is not None:
+                return self.import_counts
+
+            counts = [[0] * self.days for _ in range(self.users)]
+
+            def count_range(user, first, last):
+                n = last - first + 1
+                whole, rest = divmod(n, self.days)
+                for day in range(self.days):
+                    counts[user][day] += whole
+                for i in range(rest):
+                    counts[user][(first - 1 + i) % self.days] += 1
+
+            per_project = self.datasets * self.images
+            for project in range(1, self.projects + 1):
+                count_range(self.project_owner(project),
+                            (project - 1) * per_project + 1,
+                            project * per_project)
+
+            per_screen = self.plates * WELLS * self.fields
+            for screen in range(1, self.screens + 1):
+                count_range(self.screen_owner(screen),
+                            self.project_images +
+                            (screen - 1) * per_screen + 1,
+                            self.project_images + screen * per_screen)
+
+            self.import_counts = counts
+            return counts
+
+    def plane(self, z, w, h):
+        ''' A rendered BGR plane of a cycle: smooth blobs, one per channel in
+            its own color, which move from cycle to cycle. Only a few
+            distinct planes are generated and reused, each drawn small and
+            scaled up so that generating them costs little time or memory '''
+
+        import cv2
+        import numpy
+
+        key = ('plane', z % 4, w, h)
+        with self.lock:
+            plane = self.rendered.get(key)
+        if plane is not None:
+            return plane
+
+        sw, sh = min(w, 256), min(h, 256)
+        yy, xx = numpy.mgrid[0:sh, 0:sw].astype(numpy.float32)
+        small = numpy.zeros((sh, sw, 3), dtype=numpy.float32)
+        colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255)]
+        for c in range(self.size_c):
+            cx = sw * ((c + 1 + z % 4 * 0.25) % (self.size_c + 1)) / (
+                self.size_c + 1)
+            cy = sh * (c + 1) / (self.size_c + 1)
+            blob = numpy.exp(-((xx - cx) ** 2 + (yy - cy) ** 2) /
+                             (2 * (min(sw, sh) / 8) ** 2))
+            small += blob[:, :, None] * colors[c % len(colors)]
+        small = numpy.clip(small, 0, 255).astype(numpy.uint8)
+        plane = cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+
+        with self.lock:
+            self.rendered[key] = plane
+        return plane
+
+    def jpeg(self, z, w, h):
+        ''' A rendered region of a plane as a JPEG '''
+
+        import cv2
+
+        key = ('jpeg', z % 4, w, h)
+        with self.lock:
+            jpeg = self.rendered.get(key)
+        if jpeg is not None:
+            return jpeg
+
+        jpeg = cv2.imencode('.jpg', self.plane(z, w, h))[1].tobytes()
+        with self.lock:
+            self.rendered[key] = jpeg
+        return jpeg
+
+
+def select_list(query):
+    ''' The expressions of a query's select list, lower cased and without
+        whitespace or aliases '''
+
+    match = re.search(r'\bselect\s+(?:distinct\s+)?(.*?)\bfrom\b', query,
+                      re.I | re.S)
+    if match is None:
+        raise FakeQueryError('No select list in {}'.format(query))
+
+    expressions = []
+    depth = 0
+    current = ''
+    for char in match.group(1):
+        if char == ',' and depth == 0:
+            expressions.append(current)
+            current = ''
+            continue
+        depth += char == '('
+        depth -= char == ')'
+        current += char
+    expressions.append(current)
+
+    return [re.sub(r'\s+', '', re.sub(r'\s+as\s+\w+\s*$', '', e,
+                                      flags=re.I)).lower()
+            for e in expressions]
+
+
+class FakeQueryService(object):
+    ''' Answers the projections made by the scripts from a Catalog '''
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def projection(self, query, params, ctx=None):
+        from omero.rtypes import unwrap
+
+        self.catalog.wait()
+
+        bound = {k: unwrap(v) for k, v in (params.map or {}).items()}
+        offset, limit = 0, None
+        if params.theFilter is not None:
+            offset = unwrap(params.theFilter.offset) or 0
+            limit = unwrap(params.theFilter.limit)
+
+        fields, rows = self.source(query, bound, offset)
+        wrap = self.wrappers(fields, select_list(query), query)
+
+        if limit is not None:
+            rows = islice(rows, limit)
+        return [[w(row[i]) for i, w in wrap] for row in rows]
+
+    def wrappers(self, fields, expressions, query):
+        ''' The position in the source's rows and rtype of each expression
+            selected '''
+
+        from omero.rtypes import rlong, rstring, rint, rtime
+
+        types = {'long': rlong, 'string': rstring, 'int': rint,
+                 'time': rtime}
+        names = [name for name, _ in fields]
+        wrap = []
+        for expression in expressions:
+            if expression not in names:
+                raise FakeQueryError('Can not select {} in {}'.format(
+                    expression, query))
+            i = names.index(expression)
+            wrap.append((i, types[fields[i][1]]))
+        return wrap
+
+    def source(self, query, bound, offset):
+        ''' The fields and rows, starting at offset, of the query '''
+
+        match = re.search(r'\bfrom\s+(\w+)\s+(\w+)(\s+join\s+\S+\s+obj\b)?',
+                          query, re.I)
+        if match is None:
+            raise FakeQueryError('No from clause in {}'.format(query))
+        entity, alias = match.group(1), match.group(2)
+        lower = query.lower()
+
+        if match.group(3) or alias == 'obj':
+            return self.objects(entity if not match.group(3)
+                                else 'WellSample', bound, offset)
+        if entity == 'Experimenter':
+            return self.experimenters(offset)
+        if entity == 'Event':
+            return [('max(e.id)', 'long')], iter([(EVENT_ID,)][offset:])
+        if entity == 'EventLog':
+            return [('log.entityid', 'long')], iter([])
+        if entity == 'Project' and 'imagelinks' in lower:
+            return self.project_images(bound, offset)
+        if entity == 'Project':
+            return self.project_datasets(bound, offset)
+        if entity == 'Plate':
+            return self.screen_plates(bound, offset)
+        if entity == 'Well':
+            return self.plate_images(bound, offset,
+                                     'screenlinks' in lower)
+        if entity == 'Image':
+            return self.imports(lower, bound, offset)
+
+        raise FakeQueryError('Unknown query {}'.format(query))
+
+    def experimenters(self, offset):
+        c = self.catalog
+        users = sorted(range(c.users), key=c.user_name, reverse=True)
+        fields = [('experimenter.omename', 'string'),
+                  ('experimenter.firstname', 'string'),
+                  ('experimenter.lastname', 'string'),
+                  ('experimenter.institution', 'string'),
+                  ('experimenter.email', 'string'),
+                  ('experimenter.id', 'long')]
+        rows = ((c.user_name(u), 'First{}'.format(u), 'Last{}'.format(u),
+                 'Institute', '{}@example.org'.format(c.user_name(u)), u + 1)
+                for u in users[offset:])
+        return fields, rows
+
+    def project_images(self, bound, offset):
+        c = self.catalog
+        projects = [p for p in sorted(set(bound.get('ids', [])))
+                    if 1 <= p <= c.projects]
+        fields = [('project.id', 'long'), ('project.name', 'string'),
+                  ('dataset.name', 'string'), ('dataset.id', 'long'),
+                  ('image.name', 'string'), ('image.id', 'long')]
+
+        def rows():
+            per_project = c.datasets * c.images
+            skip, within = divmod(offset, per_project)
+            for project in projects[skip:]:
+                pname = 'project-{}'.format(project)
+                first = (project - 1) * per_project + 1
+                for image in range(first + within, first + per_project):
+                    dataset = c.image_dataset(image)
+                    yield (project, pname, 'dataset-{}'.format(dataset),
+                           dataset, 'image-{}.tif'.format(image), image)
+                within = 0
+
+        return fields, rows()
+
+    def project_datasets(self, bound, offset):
+        c = self.catalog
+        fields = [('project.name', 'string'), ('project.id', 'long'),
+                  ('project.details.owner.omename', 'string'),
+                  ('dataset.name', 'string'), ('dataset.id', 'long'),
+                  ('dsowner.omename', 'string')]
+
+        # Everything was updated at once, before or after since
+        if bound.get('since', 0) > EVENT_TIME:
+            return fields, iter([])
+
+        # Keyset pagination after a project and dataset, or after the
+        # whole of a project if it had no datasets
+        key = (bound.get('pid', 0),
+               bound.get('did', float('inf') if 'pid' in bound else 0))
+
+        def rows():
+            for project in range(key[0], c.projects + 1):
+                owner = c.user_name(c.project_owner(project))
+                if project < 1 or bound.get('owner', owner) != owner:
+                    continue
+                pname = 'project-{}'.format(project)
+                first = (project - 1) * c.datasets + 1
+                for dataset in range(first, first + c.datasets):
+                    if (project, dataset) <= key:
+                        continue
+                    yield (pname, project, owner,
+                           'dataset-{}'.format(dataset), dataset, owner)
+
+        return fields, islice(rows(), offset, None)
+
+    def screen_plates(self, bound, offset):
+        c = self.catalog
+        screens = [s for s in sorted(set(bound.get('ids', [])))
+                   if 1 <= s <= c.screens]
+        fields = [('screen.id', 'long'), ('screen.name', 'string'),
+                  ('plate.name', 'string'), ('plate.id', 'long')]
+        rows = ((screen, 'screen-{}'.format(screen),
+                 'plate-{}'.format(plate), plate)
+                for screen in screens
+                for plate in range((screen - 1) * c.plates + 1,
+                                   screen * c.plates + 1))
+        return fields, islice(rows, offset, None)
+
+    def plate_images(self, bound, offset, by_screen):
+        c = self.catalog
+        ids = sorted(set(bound.get('ids', [])))
+        if by_screen:
+            plates = [plate for screen in ids if 1 <= screen <= c.screens
+                      for plate in range((screen - 1) * c.plates + 1,
+                                         screen * c.plates + 1)]
+        else:
+            plates = [p for p in ids if 1 <= p <= c.screens * c.plates]
+
+        fields = [('screen.id', 'long'), ('screen.name', 'string'),
+                  ('plate.name', 'string'), ('plate.id', 'long'),
+                  ('index(ws)', 'int'), ('well.row', 'int'),
+                  ('well.column', 'int'), ('ws.image.id', 'long')]
+
+        def rows():
+            per_plate = WELLS * c.fields
+            skip, within = divmod(offset, per_plate)
+            for plate in plates[skip:]:
+                screen = c.plate_screen(plate)
+                sname = 'screen-{}'.format(screen)
+                pname = 'plate-{}'.format(plate)
+                first_well = (plate - 1) * WELLS + 1
+                for k in range(within, per_plate):
+                    field, w = divmod(k, WELLS)
+                    row, column = divmod(w, WELL_COLUMNS)
+                    yield (screen, sname, pname, plate, field, row, column,
+                           c.well_sample_image(first_well + w, field))
+                within = 0
+
+        return fields, rows()
+
+    def imports(self, lower, bound, offset):
+        c = self.catalog
+        counts = c.daily_imports()
+
+        # Days within the bounds of the query
+        first = 0
+        last = c.days - 1
+        if 'dstart' in bound:
+            first = max(first, -int(-(bound['dstart'] - EVENT_TIME) // DAY))
+        if 'dend' in bound:
+            last = min(last, int((bound['dend'] - EVENT_TIME) // DAY))
+
+        period = re.search(r"to_char\(event\.time,\s*'([\w-]+)'\)", lower)
+        totals = {}
+        for user in range(c.users):
+            group = c.group_name(c.group_of(user))
+            name = c.user_name(user)
+            for day in range(max(0, first), last + 1):
+                count = counts[user][day]
+                if not count:
+                    continue
+                if period is None:
+                    key = (group, name)
+                else:
+                    key = (group, name, (EPOCH + datetime.timedelta(
+                        days=day)).strftime(PERIODS[period.group(1)]))
+                totals[key] = totals.get(key, 0) + count
+
+        if period is None:
+            fields = [('grp.name', 'string'),
+                      ('experimenter.omename', 'string'),
+                      ('count(event.time)', 'long')]
+            keys = sorted(totals, key=lambda k: (c.collate(k[0]),
+                                                 c.collate(k[1])))
+        else:
+            fields = [('grp.name', 'string'),
+                      ('experimenter.omename', 'string'),
+                      (period.group(0).replace(' ', ''), 'string'),
+                      ('count(event.time)', 'long')]
+            # Latest period first within each group and user
+            keys = sorted(totals, key=lambda k: k[2], reverse=True)
+            keys.sort(key=lambda k: (c.collate(k[0]), c.collate(k[1])))
+
+        return fields, iter([key + (totals[key],)
+                             for key in keys][offset:])
+
+    def objects(self, entity, bound, offset):
+        ''' The objects of a class updated since :last with IDs after :id,
+            as synced by HierarchyIndex '''
+
+        c = self.catalog
+        event = [('obj.details.updateevent.id', 'long'),
+                 ('obj.details.updateevent.time', 'time')]
+        named = [('obj.name', 'string'),
+                 ('obj.details.owner.omename', 'string'),
+                 ('obj.details.group.id', 'long')]
+        link = [('obj.parent.id', 'long'), ('obj.child.id', 'long')]
+
+        def owned(name, owner):
+            return lambda id: (name.format(id), c.user_name(owner(id)),
+                               c.group_of(owner(id)) + 1)
+
+        plates = c.screens * c.plates
+        tables = {
+            'Project': (c.projects, named, owned(
+                'project-{}', c.project_owner)),
+            'Dataset': (c.projects * c.datasets, named, owned(
+                'dataset-{}',
+                lambda id: c.project_owner(c.dataset_project(id)))),
+            'ProjectDatasetLink': (c.projects * c.datasets, link,
+                                   lambda id: (c.dataset_project(id), id)),
+            'Image': (c.total_images, named, owned(
+                'image-{}.tif', c.image_owner)),
+            'DatasetImageLink': (c.project_images, link,
+                                 lambda id: (c.image_dataset(id), id)),
+            'Screen': (c.screens, named, owned(
+                'screen-{}', c.screen_owner)),
+            'Plate': (plates, named, owned(
+                'plate-{}', lambda id: c.screen_owner(c.plate_screen(id)))),
+            'ScreenPlateLink': (plates, link,
+                                lambda id: (c.plate_screen(id), id)),
+            'Well': (plates * WELLS,
+                     [('obj.plate.id', 'long'), ('obj.row', 'int'),
+                      ('obj.column', 'int')],
+                     lambda id: (c.well_plate(id),) +
+                     divmod((id - 1) % WELLS, WELL_COLUMNS)),
+            'WellSample': (c.well_samples,
+                           [('well.id', 'long'), ('obj.image.id', 'long'),
+                            ('index(obj)', 'int')],
+                           lambda id: ((id - 1) // c.fields + 1,
+                                       c.project_images + id,
+                                       (id - 1) % c.fields))
+        }
+        if entity not in tables:
+            raise FakeQueryError('Unknown class {}'.format(entity))
+
+        count, columns, values = tables[entity]
+        fields = [('obj.id', 'long')] + columns + event
+
+        if bound.get('last', -1) >= EVENT_ID:
+            return fields, iter([])
+
+        start = max(1, bound.get('id', 0) + 1) + offset
+        rows = ((id,) + tuple(values(id)) + (EVENT_ID, EVENT_TIME)
+                for id in range(start, count + 1))
+        return fields, rows
+
+
+class FakeColor(object):
+
+    def __init__(self, rgb):
+        self.rgb = rgb
+
+    def getRed(self):
+        return self.rgb[0]
+
+    def getGreen(self):
+        return self.rgb[1]
+
+    def getBlue(self):
+        return self.rgb[2]
+
+    def getHtml(self):
+        return '{:02X}{:02X}{:02X}'.format(*self.rgb)
+
+
+class FakeChannel(object):
+
+    COLORS = [(0, 0, 255), (0, 255, 0), (255, 0, 0), (255, 255, 255)]
+
+    def __init__(self, index):
+        self.index = index
+
+    def getLabel(self):
+        return 'ch{}'.format(self.index)
+
+    def getColor(self):
+        return FakeColor(self.COLORS[self.index % len(self.COLORS)])
+
+    def isActive(self):
+        return True
+
+    def getWindowStart(self):
+        return 0
+
+    def getWindowEnd(self):
+        return 65535
+
+    def getLut(self):
+        return None
+
+
+class FakeValue(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+
+class FakeImage(object):
+    ''' An image of the catalog, rendered as a pyramid of tiles '''
+
+    def __init__(self, catalog, id):
+        self.catalog = catalog
+        self.id = id
+        self.active = None
+
+    def getId(self):
+        return self.id
+
+    def getName(self):
+        return 'image-{}.tif'.format(self.id)
+
+    def getSizeZ(self):
+        return self.catalog.size_z
+
+    def getSizeC(self):
+        return self.catalog.size_c
+
+    def getSizeT(self):
+        return self.catalog.size_t
+
+    def getSizeX(self):
+        return self.catalog.size_xy
+
+    def getSizeY(self):
+        return self.catalog.size_xy
+
+    def getChannels(self):
+        return [FakeChannel(c) for c in range(self.catalog.size_c)]
+
+    def getZoomLevelScaling(self):
+        if self.catalog.levels < 2:
+            return None
+        return {level: 0.5 ** level for level in range(self.catalog.levels)}
+
+    def getTileSize(self):
+        return self.catalog.tile_size, self.catalog.tile_size
+
+    def getRenderingDefId(self):
+        return self.id
+
+    def getRenderingModel(self):
+        return FakeValue('rgb')
+
+    def getProjection(self):
+        return 'normal'
+
+    def updateEventDate(self):
+        return EPOCH
+
+    def renderJpegRegion(self, z, t, x, y, w, h, level=None,
+                         compression=None):
+        self.catalog.wait()
+        return self.catalog.jpeg(z + t, w, h)
+
+    def renderImage(self, z, t, compression=None):
+        ''' The rendered plane as an RGB array, as the PIL image the real
+            gateway returns converts to '''
+        self.catalog.wait()
+        size = self.catalog.size_xy
+        return self.catalog.plane(z + t, size, size)[:, :, ::-1]
+
+    def set_active_channels(self, channels, windows=None, colors=None):
+        ''' Only records the channels, which are rendered regardless '''
+        self.catalog.wait()
+        self.active = channels
+        return True
+
+    def _closeRE(self):
+        self.active = None
+
+
+class FakeServiceOpts(object):
+
+    def setOmeroGroup(self, group):
+        self.group = group
+
+
+class FakeSession(object):
+
+    def __init__(self, suuid=None):
+        self.suuid = suuid or str(uuid.uuid4())
+
+    def getUuid(self):
+        from omero.rtypes import rstring
+        return rstring(self.suuid)
+
+    def detachOnDestroy(self):
+        pass
+
+
+class FakeClient(object):
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    def getSession(self):
+        return self.gateway.session
+
+
+class FakeUser(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def getName(self):
+        return self.name
+
+
+class FakeGateway(object):
+    ''' Stands in for BlitzGateway, connected to the catalog installed '''
+
+    catalog = None
+
+    def __init__(self, username=None, passwd=None, host=None, port=None,
+                 **kwargs):
+        self.username = username or FakeGateway.catalog.user_name(0)
+        self.SERVICE_OPTS = FakeServiceOpts()
+        self.c = FakeClient(self)
+        self.session = None
+
+    def connect(self, sUuid=None):
+        self.catalog.wait()
+        self.session = FakeSession(sUuid)
+        return True
+
+    def keepAlive(self):
+        return self.session is not None
+
+    def getSession(self):
+        return self.session
+
+    def getUser(self):
+        return FakeUser(self.username)
+
+    def getQueryService(self):
+        return FakeQueryService(self.catalog)
+
+    def getObject(self, obj_type, oid):
+        if obj_type == 'Image' and 1 <= oid <= self.catalog.total_images:
+            return FakeImage(self.catalog, oid)
+        return None
+
+    def close(self, hard=True):
+        self.session = None
+
+    def seppuku(self, softclose=False):
+        self.session = None
+
+
+def install(catalog):
+    ''' Make every new BlitzGateway a connection to the catalog '''
+    import omero.gateway
+    FakeGateway.catalog = catalog
+    omero.gateway.BlitzGateway = FakeGateway
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+''' Time each console entry point's --help in a fresh interpreter and check
+    that it stays within a budget without importing any of the heavy
+    dependencies, which should only load once a connection or rendering is
+    needed. Exits with status 1 if any entry point fails.
+
+    python benchmarks/startup.py [--budget SECONDS] [--runs N] '''
+
+import os
+import re
+import sys
+import json
+import time
+import subprocess
+from argparse import ArgumentParser
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Seconds allowed for an entry point's --help, including the interpreter's
+# own startup
+BUDGET = 0.5
+
+# Modules which must not be imported just to print help
+HEAVY = ['omero', 'Ice', 'numpy', 'cv2', 'asyncio', 'pyarrow', 'dateutil']
+
+# Run an entry point with --help and report the heavy modules it imported
+PROBE = '''
+import io, sys, json, runpy, contextlib
+sys.argv = [sys.argv[1], '--help']
+try:
+    with contextlib.redirect_stdout(io.StringIO()):
+        runpy.run_module(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+heavy = {heavy!r}
+print(json.dumps(sorted(set(
+    name.split('.')[0] for name in sys.modules
+    if name.split('.')[0] in heavy
+))))
+'''.format(heavy=HEAVY)
+
+
+def entry_points():
+    ''' The (name, module) of each console script in setup.py '''
+    with open(os.path.join(ROOT, 'setup.py')) as f:
+        return re.findall(r"'([\w-]+)=([\w.]+):main'", f.read())
+
+
+def probe(module):
+    ''' Run the probe in a fresh interpreter, returning the elapsed seconds
+        and the heavy modules imported '''
+    start = time.time()
+    output = subprocess.check_output(
+        [sys.executable, '-c', PROBE, module], cwd=ROOT,
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    )
+    return time.time() - start, json.loads(output.decode('utf-8'))
+
+
+def main(argv=sys.argv):
+
+    parser = ArgumentParser(description='Benchmark entry point startup')
+    parser.add_argument('--budget', type=float, default=BUDGET,
+                        help='''Seconds allowed for --help
+                                (Default: {})'''.format(BUDGET))
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args(argv[1:])
+
+    # The cost of starting an interpreter at all
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', 'pass'])
+    baseline = time.time() - start
+
+    print('entry point, seconds, heavy imports')
+    print('{}, {:.3f}, -'.format('(interpreter)', baseline))
+
+    failed = False
+    for name, module in entry_points():
+        try:
+            results = [probe(module) for _ in range(args.runs)]
+        except subprocess.CalledProcessError:
+            print('{}, failed, -'.format(name))
+            failed = True
+            continue
+        elapsed = min(seconds for seconds, _ in results)
+        heavy = results[0][1]
+        print('{}, {:.3f}, {}'.format(name, elapsed, ' '.join(heavy) or '-'))
+        if elapsed > args.budget or heavy:
+            failed = True
+
+    if failed:
+        sys.stderr.write('Some entry points exceeded {}s or imported heavy '
+                         'modules\n'.format(args.budget))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+''' Run each of the query scripts and zmovie against the fake server of
+    fake_omero.py and report rows per second, frames per second and peak
+    memory, so that performance regressions show up without an OMERO
+    server. Each case runs in a fresh interpreter with a throwaway home
+    directory. Requires omero-py, numpy and OpenCV. zmovie's frames are only
+    encoded if ffmpeg is on the path and are otherwise discarded. Exits with
+    status 1 if any case fails.
+
+    python benchmarks/suite.py [--scale N] [--latency MS] [--cases NAME...]
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import importlib
+import subprocess
+from argparse import ArgumentParser, SUPPRESS
+
+from fake_omero import Catalog, install
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from omero_scripts import profiling  # noqa: E402
+from omero_scripts.cli import COMMANDS  # noqa: E402
+
+
+def catalog(scale=1, latency=0.0):
+    ''' The synthetic catalog, with scale times the default images per
+        dataset and plates per screen. Latency is in milliseconds '''
+    return Catalog(images=1000 * scale, plates=20 * scale,
+                   latency=latency / 1000)
+
+
+def cases(c, workdir):
+    ''' The name, command and arguments of each case. Every project, screen
+        or plate of the catalog is listed '''
+
+    projects = [str(id) for id in range(1, c.projects + 1)]
+    screens = [str(id) for id in range(1, c.screens + 1)]
+    plates = [str(id) for id in range(1, c.screens * c.plates + 1)]
+    labels = os.path.join(workdir, 'labels.csv')
+    listing = ['-q', '--no-cache', '-c', '1']
+
+    return [
+        ('list_users', 'list_users', ['-q', '--no-cache']),
+        ('list_all_projects_with_datasets',
+         'list_all_projects_with_datasets', ['-q', '--no-cache']),
+        ('list_project_images', 'list_project_images', listing + projects),
+        ('list_screen_plates', 'list_screen_plates', listing + screens),
+        ('list_screen_images', 'list_screen_images', listing + screens),
+        ('list_plate_images', 'list_plate_images', listing + plates),
+        ('list_plate_images -c 4', 'list_plate_images',
+         ['-q', '--no-cache', '-c', '4'] + plates),
+        ('list_imports', 'list_imports', ['-q', '--no-cache']),
+        ('list_imports -a', 'list_imports',
+         ['-q', '--no-cache', '-a', '-p', 'day']),
+        ('sync_hierarchy', 'sync_hierarchy', ['-q', '--rebuild']),
+        ('zmovie', 'zmovie', ['--no-plane-cache', '--labels', labels]),
+        ('zmovie --level 1', 'zmovie',
+         ['--no-plane-cache', '--labels', labels, '--level', '1']),
+        ('zmovie -w 4', 'zmovie',
+         ['--no-plane-cache', '--labels', labels, '-w', '4']),
+        ('zmovie --axis t', 'zmovie',
+         ['--no-plane-cache', '--labels', labels, '--axis', 't']),
+        ('zmovie --grid', 'zmovie',
+         ['--no-plane-cache', '--labels', labels, '--level', '1', '--grid',
+          '--channels', ','.join(str(c) for c in range(c.size_c))])
+    ]
+
+
+class NullFrameWriter(object):
+    ''' Discards frames, standing in for ffmpeg when it is not installed '''
+
+    def __init__(self, output_file, framerate, encode_args):
+        pass
+
+    def write(self, frame):
+        pass
+
+    def close(self):
+        return 0
+
+
+def prepare_zmovie(c, argv, workdir):
+    ''' A function making a movie of the first image, which has already been
+        run once so that the fake's planes are generated and cached '''
+
+    from omero_scripts.analysis import zmovie
+    from omero_scripts.omero_basics import OMEROConnectionManager
+
+    parser = ArgumentParser()
+    zmovie.add_movie_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if shutil.which('ffmpeg') is None:
+        zmovie.FFmpegPipeWriter = NullFrameWriter
+
+    with open(args.labels, 'w') as f:
+        names = ['ch{}'.format(i) for i in range(c.size_c)]
+        f.write(','.join(names) + '\n')
+        frames = c.size_t if args.axis == 't' else c.size_z
+        for z in range(frames):
+            f.write(','.join('{}-{}'.format(name, z) for name in names) +
+                    '\n')
+
+    conn = OMEROConnectionManager().connect()
+
+    def make_movie():
+        zmovie.make_movie(conn, 1, os.path.join(workdir, 'movie.mp4'), args)
+
+    make_movie()
+    return make_movie
+
+
+def run_case(name, scale, latency, workdir):
+    ''' Run a case in this process, returning the rows or frames produced,
+        the seconds taken and the peak resident set size '''
+
+    c = catalog(scale, latency)
+    install(c)
+    _, command, argv = [case for case in cases(c, workdir)
+                        if case[0] == name][0]
+
+    if command == 'zmovie':
+        make_movie = prepare_zmovie(c, argv, workdir)
+
+    profile = profiling.enable(None, script=name)
+    start = time.time()
+
+    if command == 'zmovie':
+        make_movie()
+    else:
+        sys.argv = [command] + argv
+        try:
+            importlib.import_module(COMMANDS[command]).main(sys.argv)
+        except SystemExit as e:
+            if e.code:
+                raise
+
+    seconds = time.time() - start
+    report = profile.report()
+
+    def rows(phase):
+        return sum(p['rows'] for p in report['phases']
+                   if p['phase'] == phase)
+
+    if command == 'zmovie':
+        count, unit = rows('encode'), 'frames'
+    else:
+        count, unit = rows('write') or rows('unwrap'), 'rows'
+
+    return {
+        'count': count,
+        'unit': unit,
+        'seconds': seconds,
+        'peak_rss': report['peak_rss']
+    }
+
+
+def main(argv=sys.argv):
+
+    parser = ArgumentParser(description='Benchmark against a fake server')
+    parser.add_argument('--scale', type=int, default=1,
+                        help='''Multiply the images per dataset and plates
+                                per screen''')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Milliseconds added to every server call')
+    parser.add_argument('--cases', nargs='*', metavar='name',
+                        help='Only run these cases')
+    parser.add_argument('--case', help=SUPPRESS)
+    parser.add_argument('--workdir', help=SUPPRESS)
+    args = parser.parse_args(argv[1:])
+
+    if args.case:
+        print(json.dumps(run_case(args.case, args.scale, args.latency,
+                                  args.workdir)))
+        return
+
+    names = [name for name, _, _ in cases(catalog(args.scale), '')]
+    for name in args.cases or []:
+        if name not in names:
+            parser.error('Unknown case {}, choose from: {}'.format(
+                name, ', '.join(names)))
+
+    failed = False
+    with tempfile.TemporaryDirectory() as home:
+
+        # Credentials for the fake server, which accepts anything
+        os.makedirs(os.path.join(home, '.omero'))
+        config = os.path.join(home, '.omero', 'config')
+        with open(config, 'w') as f:
+            f.write('[OMEROCredentials]\nhost = localhost\nport = 4064\n'
+                    'username = user0\npassword = password\n')
+        os.chmod(config, 0o600)
+        env = dict(os.environ, HOME=home)
+
+        print('case, count, unit, seconds, per second, peak RSS MB')
+        for name in args.cases or names:
+            result = subprocess.run(
+                [sys.executable, __file__, '--case', name,
+                 '--scale', str(args.scale), '--latency', str(args.latency),
+                 '--workdir', home],
+                env=env, stdout=subprocess.PIPE
+            )
+            if result.returncode != 0:
+                print('{}, failed'.format(name))
+                failed = True
+                continue
+
+            r = json.loads(result.stdout.decode('utf-8').splitlines()[-1])
+            print('{}, {}, {}, {:.2f}, {:.0f}, {:.0f}'.format(
+                name, r['count'], r['unit'], r['seconds'],
+                r['count'] / r['seconds'],
+                (r['peak_rss'] or 0) / (1024 * 1024)
+            ))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
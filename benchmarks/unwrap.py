@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+''' Compare unwrapping projection results a row at a time through val, as
+    hql_query did, with unwrap_row, which reads _val, and with unwrapping them
+    a column at a time (unwrap_rows), as hql_query does, on synthetic pages
+    of rtypes shaped like the results of list_screen_images. Also counts the
+    distinct string objects held, which interning reduces to one per
+    distinct name. The rows are then held as typed columns by ResultSet.
+    Requires omero-py.
+
+    python benchmarks/unwrap.py [--rows N] [--page-size N] '''
+
+import gc
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+from omero.rtypes import rlong, rint, rstring
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from omero_scripts.omero_basics import (  # noqa: E402
+    unwrap_row, unwrap_rows, DEFAULT_PAGE_SIZE
+)
+
+
+def synthetic_page(start, size):
+    ''' A page of rows of screen ID and name, plate name and ID, field,
+        well row and column and image ID, with every string a separate
+        object as it is when received '''
+    page = []
+    for i in range(start, start + size):
+        plate, well = divmod(i, 1536)
+        screen = plate // 20
+        page.append([rlong(screen), rstring('screen-{}'.format(screen)),
+                     rstring('plate-{}'.format(plate)), rlong(plate),
+                     rint(0), rint(well // 48), rint(well % 48),
+                     rlong(i + 1)])
+    return page
+
+
+def val_loop(page):
+    return [[None if column is None else column.val for column in row]
+            for row in page]
+
+
+def per_row(page):
+    return [unwrap_row(row) for row in page]
+
+
+def string_objects(result):
+    ''' Number of distinct string objects in rows '''
+    return len({id(value) for values in result for value in values
+                if isinstance(value, str)})
+
+
+def main(argv=sys.argv):
+
+    parser = ArgumentParser(description='Benchmark rtype unwrapping')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE)
+    args = parser.parse_args(argv[1:])
+
+    pages = [synthetic_page(start, min(args.page_size, args.rows - start))
+             for start in range(0, args.rows, args.page_size)]
+
+    # Keep the collector from rescanning the pages during every timing
+    gc.collect()
+    gc.freeze()
+
+    print('method, rows, seconds, rows/s, string objects per page')
+    for name, unwrap in [
+        ('val loop', val_loop),
+        ('unwrap_row', per_row),
+        ('unwrap_rows', unwrap_rows)
+    ]:
+        # Only one page is kept, as when iterating over a query's results
+        first = unwrap(pages[0])
+        start = time.time()
+        for page in pages:
+            unwrap(page)
+        elapsed = time.time() - start
+
+        print('{}, {}, {:.2f}, {:.0f}, {}'.format(
+            name, args.rows, elapsed, args.rows / elapsed,
+            string_objects(first)
+        ))
+
+
+if __name__ == '__main__':
+    main()
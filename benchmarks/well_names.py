@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+''' Compare the per-row and batched Well designation transforms used by
+    list_plate_images and list_screen_images on synthetic 1536 well plate
+    rows. Requires numpy, but not omero-py, as omero_basics only imports
+    OMERO once it connects.
+
+    python benchmarks/well_names.py [--rows N] [--batch-size N] '''
+
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+# Imported up front so that the transforms' timings do not include it
+import numpy  # noqa: F401
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from omero_scripts.omero_basics import (  # noqa: E402
+    replace_row_col_with_well, DEFAULT_PAGE_SIZE
+)
+
+# Plate ID, Field, Row, Column, Image ID
+FIRST_WELL = 2
+
+
+def synthetic_rows(count):
+    ''' Rows of a listing of 1536 well plates with one field per well '''
+    for i in range(count):
+        plate, well = divmod(i, 1536)
+        row, column = divmod(well, 48)
+        yield [plate, 0, row, column, i]
+
+
+def per_row(rows, first_well):
+    ''' The transform as it was, formatting each Well and shifting the rest
+        of the row along '''
+    for row in rows:
+        row[first_well] = '%s%i' % (chr(65 + int(row[first_well])),
+                                    row[first_well + 1] + 1)
+        row.pop(first_well + 1)
+        yield row
+
+
+def consume(rows):
+    count = 0
+    for _ in rows:
+        count += 1
+    return count
+
+
+def main(argv=sys.argv):
+
+    parser = ArgumentParser(description='Benchmark Well designation')
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_PAGE_SIZE)
+    args = parser.parse_args(argv[1:])
+
+    start = time.time()
+    baseline = consume(synthetic_rows(args.rows))
+    generate = time.time() - start
+
+    print('transform, rows, seconds, rows/s')
+    for name, transform in [
+        ('per-row', lambda rows: per_row(rows, FIRST_WELL)),
+        ('batched', lambda rows: replace_row_col_with_well(
+            rows, FIRST_WELL, args.batch_size))
+    ]:
+        start = time.time()
+        count = consume(transform(synthetic_rows(args.rows)))
+        elapsed = time.time() - start - generate
+        assert count == baseline
+        print('{}, {}, {:.2f}, {:.0f}'.format(
+            name, count, elapsed, count / elapsed
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import cv2
+import numpy
+
+OFFSET = 10
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+# Antialiased text extends slightly beyond the size reported for it
+PADDING = 2
+
+# Text coordinate of the i-th label of the given (width, height) text size,
+# for each placement in a w x h frame
+PLACEMENTS = {
+    'tl': lambda i, size, w, h: (OFFSET,
+                                 (i + 1) * OFFSET + (i + 1) * size[1]),
+    'bl': lambda i, size, w, h: (OFFSET,
+                                 h - (i + 1) * OFFSET - i * size[1]),
+    'br': lambda i, size, w, h: (w - size[0] - OFFSET,
+                                 h - (i + 1) * OFFSET - i * size[1]),
+    'tr': lambda i, size, w, h: (w - size[0] - OFFSET,
+                                 (i + 1) * OFFSET + (i + 1) * size[1])
+}
+
+
+class LabelOverlay(object):
+    ''' Channel labels for each cycle, rendered ahead of time as sprites
+        which are alpha blended onto the frames. Each sprite only covers
+        the bounding box of its labels '''
+
+    def __init__(self, labels, channels, placement, font_size, w, h):
+
+        self.placement = placement or 'tl'
+        self.font_size = font_size
+
+        names = [channel.getLabel() for channel in channels]
+        colors = []
+        for channel in channels:
+            color = channel.getColor()
+            colors.append((color.getBlue(), color.getGreen(), color.getRed()))
+
+        self.sprites = [self.render_sprite([cycle[name] for name in names],
+                                           colors, w, h)
+                        for cycle in labels]
+
+    def render_sprite(self, texts, colors, w, h):
+        ''' Render the labels of one cycle for a w x h frame. Returns the
+            sprite's position, its color premultiplied by alpha and its alpha,
+            or None if no label falls within the frame '''
+
+        place = PLACEMENTS[self.placement]
+
+        layout = []
+        for i, text in enumerate(texts):
+            size, baseline = cv2.getTextSize(text, FONT, self.font_size, 1)
+            layout.append((text, place(i, size, w, h), size, baseline))
+
+        # Bounding box of all of the labels, clipped to the frame
+        x0 = max(0, min(x for _, (x, y), _, _ in layout) - PADDING)
+        y0 = max(0, min(y - size[1] for _, (x, y), size, _ in layout) -
+                 PADDING)
+        x1 = min(w, max(x + size[0] for _, (x, y), size, _ in layout) +
+                 PADDING)
+        y1 = min(h, max(y + baseline for _, (x, y), _, baseline in layout) +
+                 PADDING)
+
+        if x1 <= x0 or y1 <= y0:
+            return None
+
+        # Text drawn onto black is the color premultiplied by its coverage
+        premultiplied = numpy.zeros((y1 - y0, x1 - x0, 3), dtype=numpy.uint8)
+        alpha = numpy.zeros((y1 - y0, x1 - x0), dtype=numpy.uint8)
+
+        for (text, (x, y), _, _), color in zip(layout, colors):
+            coord = (x - x0, y - y0)
+            cv2.putText(premultiplied, text, coord, FONT, self.font_size,
+                        color, 1, cv2.LINE_AA)
+            cv2.putText(alpha, text, coord, FONT, self.font_size, 255, 1,
+                        cv2.LINE_AA)
+
+        return x0, y0, premultiplied, alpha[:, :, numpy.newaxis]
+
+    def composite(self, frame, index):
+        ''' Alpha blend the labels of the index-th cycle onto a frame, in
+            place '''
+
+        sprite = self.sprites[index]
+        if sprite is None:
+            return
+
+        x0, y0, premultiplied, alpha = sprite
+        sh, sw = alpha.shape[:2]
+        region = frame[y0:y0 + sh, x0:x0 + sw]
+
+        blended = premultiplied + (
+            region.astype(numpy.uint16) * (255 - alpha) + 127
+        ) // 255
+        region[:] = numpy.minimum(blended, 255)
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+
+# Location of the cache, alongside the OMERO configuration file
+DEFAULT_PLANE_CACHE_DIR = Path.home() / '.omero' / 'plane_cache'
+
+# Total size of cached planes before the least recently used are evicted
+DEFAULT_PLANE_CACHE_SIZE = 4 * 1024 * 1024 * 1024
+
+# Fraction of the maximum size the cache is reduced to when evicting, so
+# that it is not evicted from again for every plane added once full
+EVICT_TO = 0.9
+
+
+def rendering_settings(image):
+    ''' Describe everything about how an image is currently rendered, so that
+        a change to any rendering setting changes the cache key '''
+
+    channels = []
+    for channel in image.getChannels():
+        channels.append([
+            channel.isActive(),
+            channel.getWindowStart(),
+            channel.getWindowEnd(),
+            channel.getColor().getHtml(),
+            channel.getLut()
+        ])
+
+    return {
+        'rdef': image.getRenderingDefId(),
+        'model': image.getRenderingModel().getValue(),
+        'projection': image.getProjection(),
+        'channels': channels
+    }
+
+
+class PlaneCache(object):
+    ''' Content addressed cache of rendered planes, stored as uint8 NumPy
+        arrays on local disk which are memory mapped when read. The least
+        recently used planes are evicted once the cache grows beyond its
+        maximum size. The size is counted once and then kept as planes are
+        added, so the directory is only scanned again to evict '''
+
+    def __init__(self, path=DEFAULT_PLANE_CACHE_DIR,
+                 max_size=DEFAULT_PLANE_CACHE_SIZE):
+
+        self.path = str(path)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        # Total size of the cached planes, counted when first needed
+        self.total = None
+
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+
+    @staticmethod
+    def key(image_id, z, t, settings):
+        ''' Compute the cache key for a plane rendered with the given
+            settings '''
+
+        identity = json.dumps([image_id, z, t, settings], sort_keys=True,
+                              default=str)
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def get(self, key):
+        ''' Return the cached plane for key as a read-only memory mapped array,
+            or None if it is not in the cache '''
+
+        import numpy
+
+        filename = self._filename(key)
+        try:
+            plane = numpy.load(filename, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+
+        return plane
+
+    def put(self, key, plane):
+        ''' Store a plane in the cache under key '''
+
+        import numpy
+
+        # Write to a temporary file and then rename, so that readers never
+        # see a partially written plane
+        filename = self._filename(key)
+        tmp = '{}.{}.tmp'.format(filename, uuid.uuid4().hex)
+        with open(tmp, 'wb') as f:
+            numpy.save(f, numpy.ascontiguousarray(plane, dtype=numpy.uint8))
+            size = f.tell()
+
+        with self.lock:
+            if self.total is None:
+                self.total = self._scan()[1]
+            try:
+                # A plane replaced no longer counts
+                self.total -= os.stat(filename).st_size
+            except OSError:
+                pass
+            os.replace(tmp, filename)
+            self.total += size
+            full = self.total > self.max_size
+
+        if full:
+            self.evict()
+
+    def _scan(self):
+        ''' Return the modification time, size and filename of each cached
+            plane and their total size '''
+
+        entries = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith('.npy'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        return entries, total
+
+    def evict(self):
+        ''' Remove the least recently used planes until the cache is within its
+            maximum size, by EVICT_TO of it '''
+
+        with self.lock:
+
+            # Scan rather than trust the running total, as other processes
+            # may share the cache
+            entries, total = self._scan()
+
+            if total > self.max_size:
+                for mtime, size, filename in sorted(entries):
+                    if total <= self.max_size * EVICT_TO:
+                        break
+                    try:
+                        os.remove(filename)
+                    except OSError:
+                        pass
+                    total -= size
+
+            self.total = total
@@ -5,30 +5,451 @@ import os
 import shutil
 import subprocess
 import uuid
-from argparse import ArgumentParser
-import cv2
-import numpy
+import threading
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import csv
-from ..omero_basics import OMEROConnectionManager
+import json
+import math
+from .. import profiling
+from ..omero_basics import OMEROConnectionManager, add_connection_arguments
+from .plane_cache import DEFAULT_PLANE_CACHE_SIZE
 
-OFFSET = 10
-FONT = cv2.FONT_HERSHEY_SIMPLEX
 DEFAULT_FONT_SIZE = 1
 DEFAULT_DURATION = 1
+DEFAULT_WORKERS = 1
 TMP = '/tmp/'
 
+# Axes a movie may move along: through Z at one timepoint, through time at
+# one Z plane, or through Z at each timepoint in turn
+AXES = ['z', 't', 'zt']
+DEFAULT_AXIS = 'z'
 
-def main(argv=sys.argv):
+# JPEG quality the server renders at, as the gateway's default
+JPEG_COMPRESSION = 0.9
 
-    # Configure argument parsing
-    parser = ArgumentParser(description='''Produce images that can be encoded
-                                           into a movie with ffmpeg''')
-    parser.add_argument('image', type=int, help='Image ID')
-    parser.add_argument('output', type=str,
-                        help='Output directory (must exist)'),
+# Encoders available for each output format, the first being the default
+FORMATS = {
+    'mp4': ['libx264', 'libx265', 'libaom-av1', 'libsvtav1'],
+    'webm': ['libvpx-vp9', 'libaom-av1', 'libsvtav1'],
+    'webp': ['libwebp']
+}
+DEFAULT_FORMAT = 'mp4'
+
+# Default CRF of each encoder, the option used to set the encoder's speed
+# preset, and any further arguments it needs
+ENCODERS = {
+    'libx264': (25, '-preset', []),
+    'libx265': (28, '-preset', ['-tag:v', 'hvc1']),
+    'libvpx-vp9': (31, '-cpu-used', ['-b:v', '0', '-row-mt', '1']),
+    'libaom-av1': (30, '-cpu-used', ['-b:v', '0']),
+    'libsvtav1': (35, '-preset', []),
+    'libwebp': (None, '-preset', ['-lossless', '0', '-quality', '75',
+                                  '-loop', '0'])
+}
+
+# yuv420p requires even dimensions, so pad frames by a pixel if necessary
+EVEN_PAD = 'pad=ceil(iw/2)*2:ceil(ih/2)*2'
+
+
+def encode_args(codec, crf=None, preset=None, threads=None, fps=None):
+    ''' Build the ffmpeg output arguments for an encoder. Unless an output
+        frame rate is given, frames are encoded at their input rate rather
+        than being duplicated '''
+
+    default_crf, preset_option, extra = ENCODERS[codec]
+
+    args = ['-vcodec', codec, '-pix_fmt', 'yuv420p', '-vf', EVEN_PAD] + extra
+
+    if crf is None:
+        crf = default_crf
+    if crf is not None:
+        args += ['-crf', str(crf)]
+
+    if preset is not None:
+        args += [preset_option, str(preset)]
+
+    if threads is not None:
+        args += ['-threads', str(threads)]
+
+    if fps is not None:
+        args += ['-r', str(fps)]
+
+    return args
+
+
+def movie_encode_args(args):
+    ''' Build the ffmpeg output arguments from the add_movie_arguments
+        options '''
+    return encode_args(args.codec or FORMATS[args.format][0], args.crf,
+                       args.preset, args.threads, args.fps)
+
+
+def movie_filename(id, args):
+    ''' Name of the movie file for an image in the chosen format '''
+    return '{}.{}'.format(id, args.format)
+
+
+class FFmpegPipeWriter(object):
+    ''' Encode frames by streaming them to ffmpeg as raw BGR video on its
+        stdin, so that no intermediate files are written. ffmpeg is started
+        when the first frame, and so the frame size, is known '''
+
+    def __init__(self, output_file, framerate, encode_args):
+        self.output_file = output_file
+        self.framerate = framerate
+        self.encode_args = encode_args
+        self.process = None
+
+    def write(self, frame):
+        import numpy
+
+        if self.process is None:
+            h, w = frame.shape[:2]
+            self.process = subprocess.Popen(
+                ['ffmpeg', '-y', '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+                 '-s', '{}x{}'.format(w, h),
+                 '-framerate', str(self.framerate), '-i', '-'] +
+                self.encode_args + [self.output_file],
+                stdin=subprocess.PIPE
+            )
+
+        self.process.stdin.write(numpy.ascontiguousarray(frame).data)
+
+    def close(self):
+        ''' Finish encoding, returning ffmpeg's exit status '''
+        if self.process is None:
+            return 0
+        self.process.stdin.close()
+        return self.process.wait()
+
+
+class JPEGDirectoryWriter(object):
+    ''' Encode frames by writing each as a JPEG to a project directory and
+        running ffmpeg over them once all have been written '''
+
+    def __init__(self, project, output_file, framerate, encode_args):
+        self.project = project
+        self.output_file = output_file
+        self.framerate = framerate
+        self.encode_args = encode_args
+        self.count = 0
+
+        # Create unique name project directory
+        os.makedirs(project)
+
+    def write(self, frame):
+        import cv2
+        cv2.imwrite(os.path.join(self.project,
+                                 'img_{}.jpg'.format(self.count)), frame)
+        self.count += 1
+
+    def close(self):
+        ''' Encode the frames and cleanup, returning ffmpeg's exit status '''
+        try:
+            return subprocess.call(
+                ['ffmpeg', '-framerate', str(self.framerate), '-y',
+                 '-i', os.path.join(self.project, 'img_%d.jpg')] +
+                self.encode_args + [self.output_file]
+            )
+        finally:
+            shutil.rmtree(self.project)
+
+
+def region_type(value):
+    ''' Parse a region of interest given as x,y,width,height '''
+    try:
+        region = tuple(int(v) for v in value.split(','))
+    except ValueError:
+        region = ()
+
+    if len(region) != 4 or min(region) < 0 or 0 in region[2:]:
+        raise ArgumentTypeError('''Region must be x,y,width,height (note no
+                                   spaces)''')
+    return region
+
+
+def index_list_type(value):
+    ''' Parse a list of zero-based indices given as 0,1,2 '''
+    try:
+        indices = [int(v) for v in value.split(',')]
+    except ValueError:
+        indices = []
+
+    if not indices or min(indices) < 0:
+        raise ArgumentTypeError('''Indices must be given as 0,1,2 (note no
+                                   spaces)''')
+    return indices
+
+
+def choose_level(scales, width, height, level=None, max_size=None):
+    ''' Choose a resolution level, 0 being full resolution. Unless a level is
+        given, the highest resolution at which the given width and height
+        (at full resolution) fit within max_size is chosen, or the lowest
+        resolution if none fit '''
+
+    if level is not None:
+        if level >= len(scales):
+            raise ZMovieError('''Level {} is beyond the number of resolution
+                                 levels in the image ({})'''.format(
+                                     level, len(scales)))
+        return level
+
+    if max_size is not None:
+        for level, scale in enumerate(scales):
+            if max(width, height) * scale <= max_size:
+                return level
+        return len(scales) - 1
+
+    return 0
+
+
+class PlaneRenderer(object):
+    ''' Renders the planes of an image with one rendering engine, which is
+        kept for every plane rather than set up again for each. The
+        resolution level and compression are only sent with the first plane
+        rendered, and channel settings only when they change. Not safe to
+        share between threads, so each worker has its own.
+
+        Whether the engine has been set up is tracked here rather than read
+        from the gateway. The gateway only replaces its engine after an
+        error, so a plane failing to render, like closing, means it is set
+        up again for the next '''
+
+    def __init__(self, image, region=None, level=None):
+        self.image = image
+        self.region = region
+        self.level = level
+        self.tile_size = None
+        self.prepared = False
+        self.settings = None
+
+    def apply(self, settings):
+        ''' Render only the channels of settings, a list of the [index,
+            [window start, window end], color] of each, unless they are
+            already those rendered '''
+
+        if settings == self.settings and self.prepared:
+            return
+
+        with profiling.span('settings'):
+            self.image.set_active_channels(
+                [index + 1 for index, _, _ in settings],
+                windows=[window for _, window, _ in settings],
+                colors=[color for _, _, color in settings]
+            )
+        self.settings = settings
+
+    def render(self, z, t):
+        ''' Render a plane as a BGR frame '''
+
+        import cv2
+        import numpy
+
+        first = not self.prepared
+        compression = JPEG_COMPRESSION if first else None
+
+        # Until a plane has rendered, the engine may not have been set up
+        self.prepared = False
+
+        if self.region is not None:
+            frame = self.render_region(z, t, first, compression)
+        else:
+            # The server renders the plane and it is decoded as it arrives
+            with profiling.span('fetch'):
+                rendered_image = self.image.renderImage(
+                    z, t, compression=compression)
+                if rendered_image is None:
+                    raise ZMovieError('''Failed to render plane z={}
+                                         t={}'''.format(z, t))
+            with profiling.span('render'):
+                plane = numpy.array(rendered_image)
+                frame = cv2.cvtColor(plane, cv2.COLOR_BGR2RGB)
+
+        self.prepared = True
+        return frame
+
+    def render_region(self, z, t, first, compression):
+        ''' Render the region (at the resolution level) of a plane tile by
+            tile, decoding each directly into a preallocated BGR frame '''
+
+        import cv2
+        import numpy
+
+        if self.tile_size is None:
+            self.tile_size = self.image.getTileSize()
+
+        x, y, w, h = self.region
+        tile_w, tile_h = self.tile_size
+        frame = numpy.empty((h, w, 3), dtype=numpy.uint8)
+        level = self.level if first else None
+
+        for ty in range(y, y + h, tile_h):
+            th = min(tile_h, y + h - ty)
+            for tx in range(x, x + w, tile_w):
+                tw = min(tile_w, x + w - tx)
+
+                with profiling.span('fetch') as span:
+                    jpeg = self.image.renderJpegRegion(
+                        z, t, tx, ty, tw, th, level=level,
+                        compression=compression)
+                    if jpeg is None:
+                        raise ZMovieError('''Failed to render region of
+                                             plane z={} t={}'''.format(z, t))
+                    span.bytes = len(jpeg)
+
+                # The engine keeps the level and compression once set
+                level = compression = None
+
+                with profiling.span('render'):
+                    frame[ty - y:ty - y + th,
+                          tx - x:tx - x + tw] = cv2.imdecode(
+                              numpy.frombuffer(jpeg, dtype=numpy.uint8),
+                              cv2.IMREAD_COLOR)
+
+        return frame
+
+    def close(self):
+        ''' Close the rendering engine. The gateway has no public method to
+            do so, so this calls the one it uses itself, which fails rather
+            than leaving the engine open should it ever be removed '''
+        self.image._closeRE()
+        self.prepared = False
+        self.settings = None
+
+
+def fit_size(w, h, max_size=None):
+    ''' Size of a w x h frame once downscaled to fit within max_size '''
+    if max_size is None or max(w, h) <= max_size:
+        return w, h
+    factor = max_size / max(w, h)
+    return max(1, int(w * factor)), max(1, int(h * factor))
+
+
+def frame_planes(axis, size_z, size_t, z=0, t=0):
+    ''' The (z, t) of the plane of each frame when moving along an axis:
+        through Z at timepoint t, through time at plane z, or through Z at
+        each timepoint in turn '''
+
+    if axis == 'z':
+        return [(z, t) for z in range(size_z)]
+    if axis == 't':
+        return [(z, t) for t in range(size_t)]
+    return [(z, t) for t in range(size_t) for z in range(size_z)]
+
+
+def grid_shape(count, columns=None):
+    ''' Rows and columns of a grid of count tiles, as near square as possible
+        unless the number of columns is given '''
+    columns = min(columns or int(math.ceil(math.sqrt(count))), count)
+    return int(math.ceil(count / columns)), columns
+
+
+def tile_grid(tiles, rows, columns):
+    ''' Arrange equally sized frames into a grid, left to right then top to
+        bottom, leaving any cells beyond the last tile black '''
+
+    import numpy
+
+    h, w = tiles[0].shape[:2]
+    frame = numpy.zeros((rows * h, columns * w, 3), dtype=numpy.uint8)
+    for i, tile in enumerate(tiles):
+        row, column = divmod(i, columns)
+        frame[row * h:(row + 1) * h, column * w:(column + 1) * w] = tile
+    return frame
+
+
+def channel_settings(channels, selected=None, frame_settings=None):
+    ''' The channels rendered in each frame, each as a list of the [index,
+        [window start, window end], color] of its channels. Channels are
+        those selected, or those active in the image's rendering settings,
+        with their windows and colors unless frame_settings overrides them.
+        frame_settings has an entry per frame with any of "channels" (indices
+        from zero), "windows" and "colors", the last two having an item per
+        channel. Returns a single list for every frame if there are no
+        frame_settings '''
+
+    defaults = [[index, [channel.getWindowStart(), channel.getWindowEnd()],
+                 channel.getLut() or channel.getColor().getHtml()]
+                for index, channel in enumerate(channels)]
+
+    if selected is None:
+        selected = [index for index, channel in enumerate(channels)
+                    if channel.isActive()]
+
+    def check(indices):
+        for index in indices:
+            if not isinstance(index, int) or not 0 <= index < len(channels):
+                raise ZMovieError('''Channel ({}) beyond number of channels
+                                     in the image ({})'''.format(
+                                         index, len(channels)))
+
+    check(selected)
+    if frame_settings is None:
+        return [defaults[index] for index in selected]
+
+    settings = []
+    for i, entry in enumerate(frame_settings):
+
+        unknown = set(entry) - {'channels', 'windows', 'colors'}
+        if unknown:
+            raise ZMovieError('''Unknown setting ({}) of frame {}, settings
+                                 are channels, windows and
+                                 colors'''.format(', '.join(sorted(unknown)),
+                                                  i))
+
+        indices = entry.get('channels', selected)
+        check(indices)
+
+        windows = entry.get('windows')
+        colors = entry.get('colors')
+        for name, values in (('windows', windows), ('colors', colors)):
+            if values is not None and len(values) != len(indices):
+                raise ZMovieError('''Number of {} of frame {} ({}) must equal
+                                     its number of channels ({})'''.format(
+                                         name, i, len(values), len(indices)))
+
+        settings.append([
+            [index,
+             windows[j] if windows is not None else defaults[index][1],
+             colors[j] if colors is not None else defaults[index][2]]
+            for j, index in enumerate(indices)
+        ])
+
+    return settings
+
+
+def ordered_map(func, items, workers, in_flight):
+    ''' Like map, but calls func on the items concurrently from a pool of
+        worker threads. Results are yielded in the order of the items and no
+        more than in_flight items are ever pending at once '''
+
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= in_flight:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+class ZMovieError(Exception):
+    ''' Raised when a movie can not be produced for an image '''
+
+
+def add_movie_arguments(parser):
+    ''' Add the options controlling how movies are produced to a parser '''
     parser.add_argument('-l', '--labels', metavar='labels', type=str,
                         help='''Decorate images with labels from CSV file.
-                                Format should be one row per cycle. The first
+                                Format should be one row per frame. The first
                                 row is expected to be a header containing the
                                 labels embedded in the image. Subsequent rows
                                 represent the labels for each of the channels
@@ -41,18 +462,95 @@ def main(argv=sys.argv):
                                 (Default: {})'''.format(DEFAULT_FONT_SIZE))
     parser.add_argument('-d', '--duration', metavar='duration', type=float,
                         default=DEFAULT_DURATION,
-                        help='''Seconds per cycle
+                        help='''Seconds per frame
                                 (Default: {})'''.format(DEFAULT_DURATION))
     parser.add_argument('-i', '--ignore', metavar='ignore', type=str,
-                        help='''Ignore cycles, e.g. 0,1 (note no spaces). Note
-                                that the first channel is zero, not one''')
+                        help='''Ignore frames, e.g. 0,1 (note no spaces). Note
+                                that the first frame is zero, not one''')
+    parser.add_argument('--axis', metavar='axis', choices=AXES,
+                        default=DEFAULT_AXIS,
+                        help='''Axis the frames move along: z, t, or zt for
+                                through Z at each timepoint in turn
+                                (Default: {})'''.format(DEFAULT_AXIS))
+    parser.add_argument('--z', metavar='z', type=int, default=0,
+                        help='''Z plane rendered when moving through time
+                                (Default: 0)''')
+    parser.add_argument('--t', metavar='t', type=int, default=0,
+                        help='''Timepoint rendered when moving through Z
+                                (Default: 0)''')
+    parser.add_argument('--channels', metavar='channels',
+                        type=index_list_type,
+                        help='''Channels to render, e.g. 0,2 (note no
+                                spaces). Note that the first channel is zero,
+                                not one (Default: the active channels)''')
+    parser.add_argument('--frame-settings', metavar='frame_settings',
+                        help='''Render each frame with its own settings from
+                                a JSON file. This is a list with an object
+                                per frame, of any of "channels" (from zero),
+                                "windows" ([start, end] per channel) and
+                                "colors" (e.g. "FF0000" per channel)''')
+    parser.add_argument('--grid', metavar='columns', type=int, nargs='?',
+                        const=0,
+                        help='''Render each channel separately and tile them
+                                into a grid, with the given number of
+                                columns or as near square as possible''')
     parser.add_argument('--tmp', metavar='tmp',
                         help='Temporary directory (Default: {})'.format(TMP))
-    args = parser.parse_args()
-
-    id = args.image
-    output = args.output
-    tmp = args.tmp or TMP
+    parser.add_argument('--no-stream', action='store_const', const=True,
+                        default=False,
+                        help='''Write frames as JPEGs to the temporary
+                                directory before encoding, instead of
+                                streaming them to ffmpeg''')
+    parser.add_argument('--level', metavar='level', type=int,
+                        help='''Resolution level to render for pyramidal
+                                images, 0 being full resolution''')
+    parser.add_argument('--max-size', metavar='max_size', type=int,
+                        help='''Maximum width or height of the movie. The
+                                highest resolution level that fits is
+                                rendered, and downscaled if still larger''')
+    parser.add_argument('--region', metavar='region', type=region_type,
+                        help='''Region of interest x,y,width,height (note no
+                                spaces) in full resolution pixels. Only the
+                                tiles covering it are fetched''')
+    parser.add_argument('--no-plane-cache', action='store_const', const=True,
+                        default=False,
+                        help='''Do not read or write the local cache of
+                                rendered planes''')
+    parser.add_argument('--plane-cache-size', metavar='plane_cache_size',
+                        type=int,
+                        default=DEFAULT_PLANE_CACHE_SIZE // (1024 * 1024),
+                        help='''Size in MB of the local cache of rendered
+                                planes (Default: {})'''.format(
+                                    DEFAULT_PLANE_CACHE_SIZE // (1024 * 1024)))
+    parser.add_argument('--format', metavar='format', choices=list(FORMATS),
+                        default=DEFAULT_FORMAT,
+                        help='''Movie format, one of {} (Default:
+                                {})'''.format(', '.join(sorted(FORMATS)),
+                                              DEFAULT_FORMAT))
+    parser.add_argument('--codec', metavar='codec', choices=list(ENCODERS),
+                        help='''ffmpeg encoder, which must suit the format
+                                (Default: libx264 for mp4, libvpx-vp9 for
+                                webm and libwebp for webp)''')
+    parser.add_argument('--crf', metavar='crf', type=int,
+                        help='Constant rate factor (Default: per encoder)')
+    parser.add_argument('--preset', metavar='preset',
+                        help='''Encoder speed preset, e.g. veryfast for
+                                libx264 or 4 for libvpx-vp9''')
+    parser.add_argument('--threads', metavar='threads', type=int,
+                        help='Encoder threads (Default: chosen by ffmpeg)')
+    parser.add_argument('--fps', metavar='fps', type=float,
+                        help='''Output frame rate. By default, frames are
+                                encoded at one per frame duration''')
+    parser.add_argument('-w', '--workers', metavar='workers', type=int,
+                        default=DEFAULT_WORKERS,
+                        help='''Number of planes to fetch and render
+                                concurrently (Default: {})'''.format(
+                                    DEFAULT_WORKERS))
+
+
+def check_movie_arguments(args):
+    ''' Check the options added by add_movie_arguments and that ffmpeg is
+        available, exiting if not '''
 
     # Make sure that ffmpeg is accessible
     try:
@@ -64,27 +562,16 @@ def main(argv=sys.argv):
                             available on the path\n''')
         sys.exit(1)
 
-    # Ensure that tmp directory exists and is a directory
-    if not (os.path.exists(tmp) and
-            os.path.isdir(tmp) and
-            os.access(tmp, os.W_OK)):
-        sys.stderr.write('''Temporary directory {} must exist, be a directory
-                            and be writeable\n'''.format(tmp))
+    # A temporary project directory is only needed when not streaming
+    tmp = args.tmp or TMP
+    if args.no_stream:
 
-    # Expand any user directory in output directory
-    output = os.path.expanduser(output)
-
-    # Configure project directory location
-    project = os.path.join(args.tmp or TMP,
-                           'zmovie',
-                           str(uuid.uuid1()))
-
-    # Ensure that project directory does not exist
-    if os.path.exists(project):
-        sys.stderr.write(
-            'Project directory {} exists. Failing for safety\n'.format(project)
-        )
-        sys.exit(1)
+        # Ensure that tmp directory exists and is a directory
+        if not (os.path.exists(tmp) and
+                os.path.isdir(tmp) and
+                os.access(tmp, os.W_OK)):
+            sys.stderr.write('''Temporary directory {} must exist, be a
+                                directory and be writeable\n'''.format(tmp))
 
     # Placement requires labels
     if args.placement and not args.labels:
@@ -95,142 +582,345 @@ def main(argv=sys.argv):
         sys.stderr.write('Placement must be one of: tl, bl, br, tr\n')
         sys.exit(1)
 
-    # Check output directory exists
-    if not (os.path.exists(output) and os.path.isdir(output)):
-        sys.stderr.write('Output directory {} must '
-                         'exist\n'.format(output))
+    if args.workers < 1:
+        sys.stderr.write('Workers must be at least 1\n')
         sys.exit(1)
 
-    conn_manager = OMEROConnectionManager()
-    conn = conn_manager.connect()
+    if args.codec and args.codec not in FORMATS[args.format]:
+        sys.stderr.write('Codec {} can not be used with format {}, use one '
+                         'of: {}\n'.format(args.codec, args.format,
+                                           ', '.join(FORMATS[args.format])))
+        sys.exit(1)
 
-    conn.SERVICE_OPTS.setOmeroGroup('-1')
-    image = conn.getObject('Image', id)
+    if args.level is not None and args.max_size is not None:
+        sys.stderr.write('Only one of level and max size may be specified\n')
+        sys.exit(1)
 
-    if not image:
-        sys.stderr.write('Image {} not found or inaccessible!\n'.format(id))
+    if ((args.level is not None and args.level < 0) or
+            (args.max_size is not None and args.max_size < 1)):
+        sys.stderr.write('Level and max size must be positive\n')
         sys.exit(1)
 
+    if args.z < 0 or args.t < 0 or (args.grid is not None and args.grid < 0):
+        sys.stderr.write('Z, t and grid columns must be positive\n')
+        sys.exit(1)
+
+
+def make_movie(conn, id, output_file, args, image=None):
+    ''' Render each frame of an image and encode them as a movie in
+        output_file, as configured by the add_movie_arguments options. The
+        image's wrapper is fetched unless given. Raises ZMovieError if the
+        movie can not be produced '''
+
+    # Rendering dependencies are only imported once a movie is made, so that
+    # --help and argument errors are quick
+    import cv2
+    import numpy
+    from .overlay import LabelOverlay
+    from .plane_cache import PlaneCache, rendering_settings
+
+    if image is None:
+        conn.SERVICE_OPTS.setOmeroGroup('-1')
+        image = conn.getObject('Image', id)
+
+    if not image:
+        raise ZMovieError('Image {} not found or inaccessible!'.format(id))
+
     sizeZ = image.getSizeZ()
+    sizeT = image.getSizeT()
 
     channels = image.getChannels()
 
-    # Check ignored cycles
-    ignored_cycles = []
+    # The plane of each frame
+    if args.axis != 'z' and args.z >= sizeZ:
+        raise ZMovieError('''Z plane ({}) beyond number of z-stacks in the
+                             image ({})'''.format(args.z, sizeZ))
+    if args.axis != 't' and args.t >= sizeT:
+        raise ZMovieError('''Timepoint ({}) beyond number of timepoints in
+                             the image ({})'''.format(args.t, sizeT))
+    planes = frame_planes(args.axis, sizeZ, sizeT, args.z, args.t)
+
+    # Choose the resolution level and the region of it to render. Scales
+    # are None for images which are not pyramidal
+    sizeX = image.getSizeX()
+    sizeY = image.getSizeY()
+    scales = image.getZoomLevelScaling()
+    scales = [1.0] if scales is None else [scales[level]
+                                           for level in sorted(scales)]
+
+    region = args.region or (0, 0, sizeX, sizeY)
+    x, y, w, h = region
+    if x + w > sizeX or y + h > sizeY:
+        raise ZMovieError('''Region {} is beyond the bounds of the image
+                             ({}x{})'''.format(region, sizeX, sizeY))
+
+    level = choose_level(scales, w, h, args.level, args.max_size)
+    scale = scales[level]
+    level_region = (int(x * scale), int(y * scale),
+                    max(1, int(w * scale)), max(1, int(h * scale)))
+
+    # The rendering engine numbers levels from lowest resolution
+    re_level = len(scales) - 1 - level
+
+    # Render tile by tile unless the whole full resolution plane is needed
+    tiled = args.region is not None or level != 0
+
+    # Rendered planes are cached locally so that reruns which only change
+    # how frames are decorated or encoded do not fetch them again
+    plane_cache = None
+    if not args.no_plane_cache:
+        plane_cache = PlaneCache(max_size=args.plane_cache_size * 1024 * 1024)
+        settings = rendering_settings(image)
+        settings.update({
+            'level': level,
+            'region': level_region if tiled else None,
+            'max_size': args.max_size
+        })
+
+    # Check ignored frames
+    ignored_frames = []
     if args.ignore:
         try:
-            ignored_cycles = [int(c) for c in args.ignore.split(',')]
+            ignored_frames = [int(c) for c in args.ignore.split(',')]
         except ValueError:
-            sys.stderr.write('Ignored cycles must be integers\n')
-            sys.exit(1)
+            raise ZMovieError('Ignored frames must be integers')
+
+        for c in ignored_frames:
+            if c >= len(planes) or c < 0:
+                raise ZMovieError('''Ignored frame ({}) beyond number of
+                                     frames of the image ({})'''.format(
+                                         c, len(planes)))
 
-        for c in ignored_cycles:
-            if c >= sizeZ or c < 0:
-                sys.stderr.write('''Ignored cycle ({}) beyond number of
-                                    z-stacks in the image
-                                    ({})\n'''.format(c, sizeZ))
-                sys.exit(1)
+    # Skip ignored frames
+    planes = [plane for i, plane in enumerate(planes)
+              if i not in ignored_frames]
 
     # Check labels
     labels = None
     if args.labels:
 
-        with open(args.labels, 'rb') as csvfile:
+        with open(args.labels, newline='') as csvfile:
             labels = [row for row in csv.DictReader(csvfile)]
 
-        if len(labels) != sizeZ - len(ignored_cycles):
-            sys.stderr.write('''Number of rows (1-per-cycle) in the CSV labels
-                                file ({}) must equal the number of z-stacks in
-                                the image ({}) after excluding ignored cycles
-                                \n'''.format(len(labels),
-                                             sizeZ - len(ignored_cycles)))
-            sys.exit(1)
-
-        for cycle in labels:
-            if len(cycle) != len(channels):
-                sys.stderr.write('''Number of columns (1-per-channel) in the
-                                    CSV labels file ({}) must equal the number
-                                    of channels in the image
-                                    ()\n'''.format(len(cycle), len(channels)))
-                sys.exit(1)
-
-    # Create unique name project directory
-    os.makedirs(project)
-
+        if len(labels) != len(planes):
+            raise ZMovieError('''Number of rows (1-per-frame) in the CSV
+                                 labels file ({}) must equal the number of
+                                 frames of the image ({}) after excluding
+                                 ignored frames'''.format(
+                len(labels), len(planes)
+            ))
+
+        for row in labels:
+            if len(row) != len(channels):
+                raise ZMovieError('''Number of columns (1-per-channel) in the
+                                     CSV labels file ({}) must equal the
+                                     number of channels in the image
+                                     ({})'''.format(len(row),
+                                                    len(channels)))
+
+    # Channels are only chosen here if asked to, and are otherwise those of
+    # the image's rendering settings
+    frame_settings = [None] * len(planes)
+    if args.frame_settings:
+        try:
+            with open(args.frame_settings) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            raise ZMovieError('''Failed to read frame settings from {}:
+                                 {}'''.format(args.frame_settings, e))
+
+        if (not isinstance(entries, list) or
+                not all(isinstance(entry, dict) for entry in entries)):
+            raise ZMovieError('''Frame settings must be a list of an object
+                                 per frame''')
+        if len(entries) != len(planes):
+            raise ZMovieError('''Number of frame settings ({}) must equal the
+                                 number of frames of the image ({}) after
+                                 excluding ignored frames'''.format(
+                                     len(entries), len(planes)))
+
+        frame_settings = channel_settings(channels, args.channels, entries)
+
+    elif args.channels is not None or args.grid is not None:
+        frame_settings = [channel_settings(channels, args.channels)] * len(
+            planes)
+
+    # Each channel of a grid is rendered as a tile, the grid having a cell
+    # for the most channels of any frame
+    rows = columns = 1
+    grid = None
+    if args.grid is not None and planes:
+        counts = [len(active) for active in frame_settings]
+        if min(counts) == 0:
+            raise ZMovieError('Every frame of a grid must render a channel')
+        rows, columns = grid_shape(max(counts), args.grid)
+        grid = [rows, columns]
+
+    if args.no_stream:
+
+        # Configure project directory location
+        project = os.path.join(args.tmp or TMP, 'zmovie', str(uuid.uuid1()))
+
+        # Ensure that project directory does not exist
+        if os.path.exists(project):
+            raise ZMovieError('''Project directory {} exists. Failing for
+                                 safety'''.format(project))
+
+        frame_writer = JPEGDirectoryWriter(project, output_file,
+                                           1 / args.duration,
+                                           movie_encode_args(args))
+    else:
+        frame_writer = FFmpegPipeWriter(output_file, 1 / args.duration,
+                                        movie_encode_args(args))
+
+    # Render the labels for every frame ahead of time, as the size of the
+    # frames is known before any are fetched. Only the labels of the
+    # channels rendered are shown
+    overlay = None
     if labels:
-        labels_iter = iter(labels)
-
-    for z in range(sizeZ):
-
-        # Skip ignored cycles
-        if z in ignored_cycles:
-            continue
-
-        rendered_image = image.renderImage(z, 0)
-        plane = numpy.array(rendered_image)
-        h, w, c = plane.shape
-
-        RGB_plane = cv2.cvtColor(plane, cv2.COLOR_BGR2RGB)
-
-        if labels:
-            current_labels = next(labels_iter)
-            for i, channel in enumerate(channels):
-                label = current_labels[channel.getLabel()]
-                color = channel.getColor()
-
-                text_size = cv2.getTextSize(label, FONT,
-                                            args.font_size, 1)[0]
-
-                # Calculate text coordinate
-                if args.placement is None or args.placement == 'tl':
-                    text_coord = (
-                        OFFSET,
-                        (i + 1) * OFFSET + (i + 1) * text_size[1]
-                    )
-                elif args.placement == 'bl':
-                    text_coord = (
-                        OFFSET,
-                        plane.shape[0] - (i + 1) * OFFSET - i * text_size[1]
-                    )
-                elif args.placement == 'br':
-                    text_coord = (
-                        plane.shape[1] - text_size[0] - OFFSET,
-                        plane.shape[0] - (i + 1) * OFFSET - i * text_size[1]
-                    )
-                elif args.placement == 'tr':
-                    text_coord = (
-                        plane.shape[1] - text_size[0] - OFFSET,
-                        (i + 1) * OFFSET + (i + 1) * text_size[1]
-                    )
-
-                cv2.putText(RGB_plane, label,
-                            text_coord, FONT, args.font_size,
-                            (
-                                color.getBlue(),
-                                color.getGreen(),
-                                color.getRed()
-                            ),
-                            1, cv2.LINE_AA)
-
-        # Write image
-        cv2.imwrite(os.path.join(project, 'img_{}.jpg').format(z),
-                    RGB_plane)
-
-    # ffmpeg -framerate 1 -i color_img_%d.jpg -vcodec libx264 -crf 25 \
-    #   -pix_fmt yuv420p -r 60 test.mp4
+        shown = channels
+        if args.channels is not None:
+            shown = [channels[index] for index in args.channels]
+        overlay = LabelOverlay(labels, shown, args.placement, args.font_size,
+                               *fit_size(level_region[2] * columns,
+                                         level_region[3] * rows,
+                                         args.max_size))
+
+    # Each worker thread renders with its own image wrapper, and so its own
+    # rendering engine, as these are not safe to share between threads. The
+    # engines are kept for every frame and closed once all are rendered
+    local = threading.local()
+    renderers = []
+    lock = threading.Lock()
+
+    def worker_renderer():
+        if not hasattr(local, 'renderer'):
+            local.renderer = PlaneRenderer(
+                image if args.workers == 1 else conn.getObject('Image', id),
+                level_region if tiled else None, re_level)
+            with lock:
+                renderers.append(local.renderer)
+        return local.renderer
+
+    def render_frame(plane):
+        z, t, active = plane
+
+        if plane_cache is not None:
+            key = PlaneCache.key(id, z, t, settings if active is None else
+                                 dict(settings, active=active, grid=grid))
+            with profiling.span('plane_cache') as span:
+                frame = plane_cache.get(key)
+                if frame is not None:
+                    # Copy, as frames are decorated in place
+                    frame = numpy.array(frame)
+                    span.rows = 1
+            if frame is not None:
+                return frame
+
+        renderer = worker_renderer()
+        if grid is None:
+            if active is not None:
+                renderer.apply(active)
+            frame = renderer.render(z, t)
+        else:
+            # Start from the channel already being rendered, saving a change
+            # of settings per frame
+            tiles = [None] * len(active)
+            start = next((i for i, channel in enumerate(active)
+                          if [channel] == renderer.settings), 0)
+            for i in list(range(start, len(active))) + list(range(start)):
+                renderer.apply([active[i]])
+                tiles[i] = renderer.render(z, t)
+            with profiling.span('render'):
+                frame = tile_grid(tiles, rows, columns)
+
+        # Downscale if the chosen level is still larger than the maximum
+        fh, fw = frame.shape[:2]
+        size = fit_size(fw, fh, args.max_size)
+        if size != (fw, fh):
+            with profiling.span('render'):
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+        if plane_cache is not None:
+            plane_cache.put(key, frame)
+
+        return frame
+
+    # Fetch and render frames concurrently, keeping at most two frames per
+    # worker in flight, but process them in order. Frames are only
+    # generated as they are submitted, however long the series
+    frames = ordered_map(render_frame,
+                         ((z, t, active) for (z, t), active
+                          in zip(planes, frame_settings)),
+                         args.workers, 2 * args.workers)
+
     try:
-        subprocess.call(['ffmpeg', '-framerate', 1 / args.duration, '-y',
-                         '-i', os.path.join(project, 'img_%d.jpg'), '-vcodec',
-                         'libx264', '-crf', '25', '-pix_fmt', 'yuv420p',
-                         '-r', '60',
-                         os.path.join(output, '{}.mp4'.format(id))])
-    except:
-        sys.stderr.write('''Failed to process video with ffmpeg. Ensure it is
-                            installed with the correct codecs\n''')
+        for i, RGB_plane in enumerate(frames):
+
+            if overlay is not None:
+                with profiling.span('overlay'):
+                    overlay.composite(RGB_plane, i)
+
+            # Write image
+            try:
+                with profiling.span('encode') as span:
+                    frame_writer.write(RGB_plane)
+                    span.rows = 1
+                    span.bytes = RGB_plane.nbytes
+            except (OSError, IOError):
+                # ffmpeg exited early, its exit status is reported below
+                break
+
+    finally:
+        frames.close()
+        for renderer in renderers:
+            renderer.close()
+
+    try:
+        with profiling.span('encode'):
+            returncode = frame_writer.close()
+    except (OSError, IOError):
+        returncode = 1
+
+    if returncode != 0:
+        raise ZMovieError('''Failed to process video with ffmpeg. Ensure it is
+                             installed with the correct codecs''')
+
+
+def main(argv=sys.argv):
+
+    # Configure argument parsing
+    parser = ArgumentParser(description='''Produce images that can be encoded
+                                           into a movie with ffmpeg''')
+    parser.add_argument('image', type=int, help='Image ID')
+    parser.add_argument('output', type=str,
+                        help='Output directory (must exist)'),
+    add_movie_arguments(parser)
+    add_connection_arguments(parser)
+    args = parser.parse_args(argv[1:])
+
+    id = args.image
+
+    check_movie_arguments(args)
+
+    # Expand any user directory in output directory
+    output = os.path.expanduser(args.output)
+
+    # Check output directory exists
+    if not (os.path.exists(output) and os.path.isdir(output)):
+        sys.stderr.write('Output directory {} must '
+                         'exist\n'.format(output))
         sys.exit(1)
 
-    # Cleanup
-    shutil.rmtree(project)
+    conn_manager = OMEROConnectionManager(detach=args.keep_session)
+    conn = conn_manager.connect()
+
+    try:
+        make_movie(conn, id, os.path.join(output, movie_filename(id, args)),
+                   args)
+    except ZMovieError as e:
+        sys.stderr.write('{}\n'.format(e))
+        sys.exit(1)
 
 
 if __name__ == '__main__':
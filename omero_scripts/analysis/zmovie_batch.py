@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import csv
+import time
+import datetime
+import multiprocessing
+import multiprocessing.util
+from argparse import ArgumentParser
+from .. import profiling
+from ..omero_basics import (OMEROConnectionManager, add_connection_arguments,
+                            write_rows)
+from .zmovie import (add_movie_arguments, check_movie_arguments, make_movie,
+                     movie_filename, ZMovieError)
+
+DEFAULT_JOBS = 2
+
+# State of each worker process, which holds its own connection
+worker = {}
+
+
+def image_ids_from_csv(filename):
+    ''' Read image IDs from a CSV file. Uses the 'Image ID' column if there is
+        one, as written by the list_* scripts, otherwise the first column '''
+
+    with open(filename, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, [])
+
+        if 'Image ID' in header:
+            column = header.index('Image ID')
+            return [int(row[column]) for row in reader if row]
+
+        # No header, so the first row is also an image ID
+        return [int(row[0]) for row in [header] + list(reader) if row]
+
+
+def image_ids_from_container(conn_manager, container, id):
+    ''' List the images in a Dataset or Project '''
+
+    if container == 'Dataset':
+        q = """
+            select image.id
+            from Dataset dataset
+            join dataset.imageLinks ilink
+            join ilink.child image
+            where dataset.id = :id
+            order by image.id
+            """
+    else:
+        q = """
+            select distinct image.id
+            from Project project
+            join project.datasetLinks dlink
+            join dlink.child dataset
+            join dataset.imageLinks ilink
+            join ilink.child image
+            where project.id = :id
+            order by image.id
+            """
+
+    from omero.sys import ParametersI
+
+    params = ParametersI()
+    params.addId(id)
+
+    return [row[0] for row in conn_manager.iter_hql_query(q, params)]
+
+
+def init_worker(conn_params, args, profile):
+    ''' Join the existing session in a newly started worker process. If
+        profiling, the worker's profile is collected with each job's result
+        rather than written by the worker. The connection is closed when the
+        worker exits, leaving the session open for the rest '''
+    if profile:
+        profiling.enable(None)
+    worker['conn_manager'] = OMEROConnectionManager(params=conn_params)
+    worker['conn'] = worker['conn_manager'].connect()
+    worker['args'] = args
+    multiprocessing.util.Finalize(None, close_worker, exitpriority=10)
+
+
+def close_worker():
+    ''' Close the connection of a worker process as it exits '''
+    conn_manager = worker.pop('conn_manager', None)
+    worker.pop('conn', None)
+    if conn_manager is not None:
+        conn_manager.disconnect()
+
+
+def is_up_to_date(image, output_file):
+    ''' Check if the movie for an image is newer than the image's last
+        modification '''
+
+    if not os.path.exists(output_file):
+        return False
+
+    updated = image.updateEventDate()
+    modified = datetime.datetime.fromtimestamp(os.path.getmtime(output_file))
+    return updated is not None and modified > updated
+
+
+def run_job(id):
+    ''' Produce the movie for an image in a worker process, returning a
+        summary row and what was profiled, if profiling '''
+    return produce_movie(id), profiling.collect()
+
+
+def produce_movie(id):
+    ''' Produce the movie for an image, returning a summary row of image ID,
+        status, seconds taken and message '''
+
+    conn = worker['conn']
+    args = worker['args']
+    output_file = os.path.join(args.output, movie_filename(id, args))
+    start = time.time()
+
+    try:
+        conn.SERVICE_OPTS.setOmeroGroup('-1')
+        image = conn.getObject('Image', id)
+
+        if image and not args.force and is_up_to_date(image, output_file):
+            return [id, 'skipped', 0, 'Movie is up to date']
+
+        make_movie(conn, id, output_file, args, image)
+
+    except ZMovieError as e:
+        return [id, 'failed', round(time.time() - start, 1), str(e)]
+
+    except Exception as e:
+        return [id, 'failed', round(time.time() - start, 1),
+                '{}: {}'.format(type(e).__name__, e)]
+
+    return [id, 'success', round(time.time() - start, 1), '']
+
+
+def main(argv=sys.argv):
+
+    # Configure argument parsing
+    parser = ArgumentParser(description='''Produce movies for many images in
+                                           parallel''')
+    parser.add_argument('output', type=str,
+                        help='Output directory (must exist)')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--images', metavar='image', type=int, nargs='+',
+                        help='Image IDs')
+    source.add_argument('--dataset', metavar='dataset', type=int,
+                        help='Produce movies for all images in a dataset')
+    source.add_argument('--project', metavar='project', type=int,
+                        help='Produce movies for all images in a project')
+    source.add_argument('--csv', metavar='csv',
+                        help='''CSV file of image IDs, e.g. as written by
+                                list_project_images''')
+    parser.add_argument('-j', '--jobs', metavar='jobs', type=int,
+                        default=DEFAULT_JOBS,
+                        help='''Number of images to process in parallel
+                                (Default: {})'''.format(DEFAULT_JOBS))
+    parser.add_argument('--force', action='store_const', const=True,
+                        default=False,
+                        help='''Produce movies even if they are newer than
+                                the image''')
+    parser.add_argument('-s', '--summary', metavar='summary',
+                        help='Destination CSV file for the summary')
+    add_movie_arguments(parser)
+    add_connection_arguments(parser)
+    args = parser.parse_args(argv[1:])
+
+    check_movie_arguments(args)
+
+    if args.jobs < 1:
+        sys.stderr.write('Jobs must be at least 1\n')
+        sys.exit(1)
+
+    # Expand any user directory in output directory
+    args.output = os.path.expanduser(args.output)
+
+    # Check output directory exists
+    if not (os.path.exists(args.output) and os.path.isdir(args.output)):
+        sys.stderr.write('Output directory {} must '
+                         'exist\n'.format(args.output))
+        sys.exit(1)
+
+    conn_manager = OMEROConnectionManager(detach=args.keep_session)
+    conn = conn_manager.connect()
+
+    if args.images:
+        ids = args.images
+    elif args.csv:
+        try:
+            ids = image_ids_from_csv(args.csv)
+        except (IOError, ValueError, IndexError):
+            sys.stderr.write('Unable to read image IDs from {}\n'.format(
+                args.csv
+            ))
+            sys.exit(1)
+    elif args.dataset is not None:
+        ids = image_ids_from_container(conn_manager, 'Dataset', args.dataset)
+    else:
+        ids = image_ids_from_container(conn_manager, 'Project', args.project)
+
+    # Workers join this session rather than each logging in. It is kept
+    # open by this process until all workers are finished
+    conn_params = dict(conn_manager.get_params())
+    conn_params['suuid'] = conn.getSession().getUuid().val
+    conn_params['password'] = None
+
+    # Spawn, rather than fork, worker processes as Ice does not survive a fork
+    context = multiprocessing.get_context('spawn')
+    summary = []
+    pool = context.Pool(args.jobs, initializer=init_worker,
+                        initargs=(conn_params, args,
+                                  profiling.current is not None))
+    try:
+        for row, collected in pool.imap(run_job, ids):
+            profiling.merge(collected)
+            summary.append(row)
+
+        # Let the workers exit in their own time, so that they close their
+        # connections
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+    conn_manager.disconnect()
+
+    header = ['Image ID', 'Status', 'Seconds', 'Message']
+    write_rows(summary, header, filename=args.summary)
+
+    if any(row[1] == 'failed' for row in summary):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
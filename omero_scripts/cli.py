@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+''' omero-scripts: run any of the scripts as a subcommand, through the daemon
+    if one is running so that it starts in milliseconds
+
+    omero-scripts [--socket path] [--no-daemon] <command> [arguments]
+    omero-scripts daemon [--socket path] [--idle-timeout seconds]
+
+    Only the standard library is imported here, as the client is started
+    afresh for every command '''
+
+import os
+import sys
+import json
+import socket
+import importlib
+from pathlib import Path
+from . import profiling
+
+# Location of the daemon's socket, alongside the OMERO configuration file
+DEFAULT_SOCKET = Path.home() / '.omero' / 'omero-scripts.sock'
+
+# The module of each command, whose main is run with the command's arguments
+COMMANDS = {
+    'zmovie': 'omero_scripts.analysis.zmovie',
+    'zmovie_batch': 'omero_scripts.analysis.zmovie_batch',
+    'list_all_projects_with_datasets':
+        'omero_scripts.queries.list_all_projects_with_datasets',
+    'list_plate_images': 'omero_scripts.queries.list_plate_images',
+    'list_project_images': 'omero_scripts.queries.list_project_images',
+    'list_screen_images': 'omero_scripts.queries.list_screen_images',
+    'list_screen_plates': 'omero_scripts.queries.list_screen_plates',
+    'list_imports': 'omero_scripts.queries.list_imports',
+    'list_users': 'omero_scripts.queries.list_users',
+    'sync_hierarchy': 'omero_scripts.queries.sync_hierarchy',
+    'csv2yaml': 'omero_scripts.conversion.csv2yaml',
+    'daemon': 'omero_scripts.daemon'
+}
+
+# Frames exchanged with the daemon: a type byte and a 4 byte length, then the
+# data. The client sends the request and answers requests for its stdin; the
+# daemon sends output, stdin requests and finally the exit status
+REQUEST = b'r'
+STDOUT = b'o'
+STDERR = b'e'
+STDIN_REQUEST = b'i'
+STDIN_DATA = b'I'
+EXIT = b'x'
+
+# Bytes of stdin sent to the daemon at a time
+STDIN_CHUNK = 65536
+
+
+def send_frame(sock, kind, data=b''):
+    sock.sendall(kind + len(data).to_bytes(4, 'big') + data)
+
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed by the other end')
+        data += chunk
+    return data
+
+
+def recv_frame(sock):
+    ''' Receive a frame, returning its type and data '''
+    header = recv_exactly(sock, 5)
+    return header[:1], recv_exactly(sock, int.from_bytes(header[1:], 'big'))
+
+
+def run(argv, profile=None):
+    ''' Run a command in this process. argv is the command's name and its
+        arguments. Returns the exit status. If profiling, the report is
+        written to profile, or that named by OMERO_SCRIPTS_PROFILE, once
+        the command finishes '''
+
+    module = importlib.import_module(COMMANDS[argv[0]])
+
+    # Usage messages name the command, as if it had been run directly
+    sys.argv = list(argv)
+
+    profile = profile or os.environ.get(profiling.PROFILE_ENV)
+    if profile and argv[0] != 'daemon':
+        profiling.enable(profile)
+
+    try:
+        module.main(argv)
+    except SystemExit as e:
+        return exit_status(e)
+    finally:
+        profiling.finish()
+    return 0
+
+
+def exit_status(e):
+    ''' The exit status of a SystemExit, printing its message if it has
+        one instead of a status, as the interpreter would '''
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    sys.stderr.write('{}\n'.format(e.code))
+    return 1
+
+
+def connect_daemon(path):
+    ''' A connection to the daemon at the given socket, or None if there is
+        none running '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def run_remote(sock, argv):
+    ''' Run a command in the daemon, relaying its output and stdin. Returns
+        the exit status '''
+
+    with sock:
+        send_frame(sock, REQUEST, json.dumps({
+            'argv': argv,
+            'cwd': os.getcwd(),
+            'profile': os.environ.get(profiling.PROFILE_ENV)
+        }).encode('utf-8'))
+
+        while True:
+            kind, data = recv_frame(sock)
+            if kind == STDOUT:
+                sys.stdout.buffer.write(data)
+            elif kind == STDERR:
+                sys.stdout.flush()
+                sys.stderr.buffer.write(data)
+                sys.stderr.flush()
+            elif kind == STDIN_REQUEST:
+                send_frame(sock, STDIN_DATA,
+                           os.read(sys.stdin.fileno(), STDIN_CHUNK))
+            elif kind == EXIT:
+                sys.stdout.flush()
+                return int.from_bytes(data, 'big', signed=True)
+
+
+def usage():
+    return ('usage: omero-scripts [--socket path] [--no-daemon] <command> '
+            '[arguments]\n\ncommands:\n  {}\n'.format(
+                '\n  '.join(sorted(COMMANDS))))
+
+
+def main(argv=sys.argv):
+
+    # Options of omero-scripts itself come before the command, everything
+    # after it belongs to the command
+    args = argv[1:]
+    path = Path(os.environ.get('OMERO_SCRIPTS_SOCKET', str(DEFAULT_SOCKET)))
+    use_daemon = True
+    while args and args[0].startswith('-'):
+        option = args.pop(0)
+        if option == '--socket' and args:
+            path = Path(args.pop(0))
+        elif option == '--no-daemon':
+            use_daemon = False
+        elif option in ('-h', '--help'):
+            sys.stdout.write(usage())
+            sys.exit(0)
+        else:
+            sys.stderr.write(usage())
+            sys.exit(2)
+
+    if not args or args[0] not in COMMANDS:
+        sys.stderr.write(usage())
+        sys.exit(2)
+
+    if args[0] == 'daemon':
+        if '--socket' not in args:
+            args += ['--socket', str(path)]
+        sys.exit(run(args))
+
+    sock = connect_daemon(path) if use_daemon else None
+    if sock is None:
+        sys.exit(run(args))
+
+    try:
+        status = run_remote(sock, args)
+    except BrokenPipeError:
+        # The reader of our output has gone, as with head. Anything still
+        # buffered is discarded rather than failing again on exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        status = 1
+    except ConnectionError:
+        sys.stderr.write('Error: Lost the connection to the daemon\n')
+        status = 1
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
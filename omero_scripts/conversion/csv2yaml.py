@@ -3,8 +3,6 @@
 import sys
 import argparse
 import csv
-import yaml
-from colour import Color
 
 MANDATORY_COLS = ['Cycle', 'Channel', 'Layer', 'Marker', 'Cycle Color',
                   'Failed']
@@ -17,6 +15,8 @@ def eprint(*args, **kwargs):
 
 
 def get_cycle_color(row):
+    from colour import Color
+
     value = row['Cycle Color'].strip()
 
     if len(value) == 0:
@@ -53,10 +53,6 @@ def Ystr_representer(dumper, data):
     return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='\'')
 
 
-yaml.add_representer(Color, color_representer)
-yaml.add_representer(Ystr, Ystr_representer)
-
-
 def main(argv=sys.argv):
 
     parser = argparse.ArgumentParser(
@@ -65,7 +61,14 @@ def main(argv=sys.argv):
     parser.add_argument('infile', help='The CSV file to convert.')
     parser.add_argument('outfile', help='The YAML file to output.')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv[1:])
+
+    # Only imported once the arguments are parsed, so that --help is quick
+    import yaml
+    from colour import Color
+
+    yaml.add_representer(Color, color_representer)
+    yaml.add_representer(Ystr, Ystr_representer)
 
     with open(args.infile, 'rb') as csvfile:
         reader = csv.DictReader(csvfile)
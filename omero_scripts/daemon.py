@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+''' Daemon which runs the commands of omero-scripts in one long running
+    process, so that the libraries stay imported and the connection to
+    OMERO stays logged in between commands. Commands are received over a
+    Unix domain socket only accessible to the user, and run one at a time
+    with their output and stdin relayed over it '''
+
+import io
+import os
+import sys
+import json
+import signal
+import socket
+import importlib
+import traceback
+from argparse import ArgumentParser
+from .cli import (DEFAULT_SOCKET, COMMANDS, REQUEST, STDOUT, STDERR,
+                  STDIN_REQUEST, STDIN_DATA, EXIT, STDIN_CHUNK, send_frame,
+                  recv_frame, run, connect_daemon)
+
+# Libraries imported once on starting, rather than by the first command
+PRELOAD = ['omero.gateway', 'omero.rtypes', 'omero.sys', 'numpy']
+
+# Bytes of output buffered before being sent to the client
+OUTPUT_BUFFER_SIZE = 65536
+
+
+class SocketOutput(io.RawIOBase):
+    ''' Output sent to the client as frames of the given type '''
+
+    def __init__(self, sock, kind):
+        self.sock = sock
+        self.kind = kind
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        send_frame(self.sock, self.kind, bytes(data))
+        return len(data)
+
+
+class SocketInput(io.RawIOBase):
+    ''' Input read from the client's stdin, requested only when read '''
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        send_frame(self.sock, STDIN_REQUEST)
+        kind, data = recv_frame(self.sock)
+        if kind != STDIN_DATA:
+            raise ConnectionError('Expected stdin from the client')
+        data = data[:len(buffer)]
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def handle(sock):
+    ''' Run the command requested on a connection, with the client's working
+        directory, arguments and standard streams '''
+
+    kind, data = recv_frame(sock)
+    if kind != REQUEST:
+        return
+    request = json.loads(data.decode('utf-8'))
+    argv = request['argv']
+
+    if not argv or argv[0] not in COMMANDS or argv[0] == 'daemon':
+        send_frame(sock, STDERR, 'Unknown command: {}\n'.format(
+            ' '.join(argv)).encode('utf-8'))
+        send_frame(sock, EXIT, (2).to_bytes(4, 'big', signed=True))
+        return
+
+    stdout = io.TextIOWrapper(io.BufferedWriter(SocketOutput(sock, STDOUT),
+                                                OUTPUT_BUFFER_SIZE),
+                              encoding='utf-8')
+    stderr = io.TextIOWrapper(io.BufferedWriter(SocketOutput(sock, STDERR)),
+                              encoding='utf-8', write_through=True)
+    stdin = io.TextIOWrapper(io.BufferedReader(SocketInput(sock),
+                                               STDIN_CHUNK),
+                             encoding='utf-8')
+
+    saved = sys.argv, sys.stdin, sys.stdout, sys.stderr
+    cwd = os.getcwd()
+    try:
+        os.chdir(request['cwd'])
+        sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+        try:
+            status = run(argv, request.get('profile'))
+        except (BrokenPipeError, ConnectionError):
+            # The client has gone, so there is no one to report to
+            return
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        stdout.flush()
+        stderr.flush()
+    finally:
+        sys.argv, sys.stdin, sys.stdout, sys.stderr = saved
+        os.chdir(cwd)
+
+    send_frame(sock, EXIT, status.to_bytes(4, 'big', signed=True))
+
+
+def preload():
+    ''' Import the libraries used by the commands, skipping any that are
+        not installed '''
+    for name in PRELOAD + sorted(set(COMMANDS.values())):
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+
+def serve(path=DEFAULT_SOCKET, idle_timeout=None):
+    ''' Listen for commands on the socket until terminated, or until idle
+        for idle_timeout seconds '''
+
+    from .omero_basics import keep_connections_resident
+
+    path = str(path)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+
+    if os.path.exists(path):
+        sock = connect_daemon(path)
+        if sock is not None:
+            sock.close()
+            sys.stderr.write('Error: A daemon is already listening on '
+                             '{}\n'.format(path))
+            sys.exit(1)
+
+        # Left behind by a daemon which did not exit cleanly
+        os.remove(path)
+
+    # Only the user may connect
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+    server.settimeout(idle_timeout)
+
+    resident = keep_connections_resident()
+    preload()
+
+    # Terminate as if interrupted, so that the socket is removed and the
+    # connections closed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    sys.stderr.write('Listening on {}\n'.format(path))
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                break
+
+            # Requests are handled one at a time, as the commands share the
+            # process' working directory and standard streams
+            conn.settimeout(None)
+            with conn:
+                try:
+                    handle(conn)
+                except (BrokenPipeError, ConnectionError):
+                    pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(path)
+        resident.close()
+
+
+def main(argv=sys.argv):
+
+    # Configure argument parsing
+    parser = ArgumentParser(description='''Run omero-scripts commands in a
+                                           long running process, keeping
+                                           libraries imported and the
+                                           connection to OMERO logged in''')
+    parser.add_argument('--socket', metavar='path',
+                        default=str(DEFAULT_SOCKET),
+                        help='''Unix domain socket to listen on
+                                (Default: {})'''.format(DEFAULT_SOCKET))
+    parser.add_argument('--idle-timeout', metavar='seconds', type=float,
+                        help='Exit after this long without a command')
+    args = parser.parse_args(argv[1:])
+
+    serve(args.socket, args.idle_timeout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+import os
+import io
+import gzip
+import json
+from csv import writer, QUOTE_ALL, QUOTE_MINIMAL
+
+# Size of the write buffer used for output files
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Output compression inferred from the output file extension
+COMPRESSION_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.zst': 'zstd'
+}
+
+# Output formats, the default and those inferred from the file extension
+FORMATS = ['csv', 'tsv', 'parquet', 'arrow', 'jsonl']
+DEFAULT_FORMAT = 'csv'
+
+# Formats which can be appended to, e.g. to resume an export
+APPEND_FORMATS = ['csv', 'tsv', 'jsonl']
+FORMAT_EXTENSIONS = {
+    '.csv': 'csv',
+    '.tsv': 'tsv',
+    '.parquet': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.jsonl': 'jsonl'
+}
+
+# Number of rows written to each Parquet row group or Arrow record batch.
+# Only this many rows are held in memory at any time
+ROW_GROUP_SIZE = 100000
+
+# Column types of the typed output formats
+INT = 'int'
+STRING = 'string'
+CATEGORY = 'category'
+TIMESTAMP = 'timestamp'
+
+# Types of the columns of the query scripts that cannot be told from their
+# names alone
+COLUMN_TYPES = {
+    'Count': INT,
+    'Field': INT,
+    'Period': TIMESTAMP,
+    'Well': CATEGORY,
+    'Group': CATEGORY,
+    'Username': CATEGORY,
+    'Institution': CATEGORY
+}
+
+
+def column_type(name):
+    ''' Return the type of a column from its name. IDs are integers, names
+        and owners are categories and anything else is a string '''
+
+    if name in COLUMN_TYPES:
+        return COLUMN_TYPES[name]
+    if name == 'ID' or name.endswith(' ID'):
+        return INT
+    if name.endswith(' Name') or name.endswith(' Owner'):
+        return CATEGORY
+    return STRING
+
+
+def split_extensions(filename):
+    ''' Return the format and compression inferred from a filename such as
+        images.jsonl.gz, either of which may be None '''
+
+    base, ext = os.path.splitext(filename)
+    compression = COMPRESSION_EXTENSIONS.get(ext.lower())
+    if compression is not None:
+        ext = os.path.splitext(base)[1]
+    return FORMAT_EXTENSIONS.get(ext.lower()), compression
+
+
+def resolve_format(filename, output_format=None):
+    ''' Return the format of a file, as given or otherwise inferred from its
+        extension, by default CSV '''
+    if output_format is None:
+        output_format = split_extensions(filename)[0] or DEFAULT_FORMAT
+    return output_format
+
+
+def open_output(filename, compression=None, append=False):
+    ''' Open a text file for writing, or appending, through a large buffer.
+        Optionally compress the output with gzip or zstd. If no compression
+        is given it is inferred from the file extension (.gz or .zst) '''
+
+    mode = 'a' if append else 'w'
+
+    if compression is None:
+        compression = split_extensions(filename)[1]
+
+    if compression is None:
+        return open(filename, mode, newline='', buffering=WRITE_BUFFER_SIZE)
+
+    if compression == 'gzip':
+        raw = gzip.open(filename, mode + 'b')
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('zstd compression requires the zstandard '
+                             'package')
+        raw = zstandard.ZstdCompressor().stream_writer(
+            open(filename, mode + 'b')
+        )
+    else:
+        raise ValueError('Unknown compression: {}'.format(compression))
+
+    return io.TextIOWrapper(io.BufferedWriter(raw, WRITE_BUFFER_SIZE),
+                            newline='')
+
+
+def open_row_writer(filename, header=None, output_format=None,
+                    compression=None, types=None, append=False):
+    ''' Open a writer of rows to a file in the given format. If no format is
+        given it is inferred from the file extension, otherwise CSV. Column
+        types are inferred from the header if not given. Only the text
+        formats can be appended to, in which case the header is not
+        written again '''
+
+    output_format = resolve_format(filename, output_format)
+
+    if output_format == 'csv':
+        return CSVRowWriter(filename, header, compression, append=append)
+    if output_format == 'tsv':
+        return CSVRowWriter(filename, header, compression, delimiter='\t',
+                            quoting=QUOTE_MINIMAL, append=append)
+
+    if header is None:
+        raise ValueError('{} output requires a header'.format(output_format))
+    if types is None:
+        types = [column_type(name) for name in header]
+
+    if output_format == 'jsonl':
+        return JSONLinesRowWriter(filename, header, compression, types,
+                                  append)
+
+    if append:
+        raise ValueError('Cannot append to {} output'.format(output_format))
+    if output_format == 'parquet':
+        return ParquetRowWriter(filename, header, compression, types)
+    if output_format == 'arrow':
+        return ArrowRowWriter(filename, header, compression, types)
+
+    raise ValueError('Unknown format: {}'.format(output_format))
+
+
+class CSVRowWriter(object):
+    ''' Writes rows to a delimited text file, every value quoted by default
+        '''
+
+    def __init__(self, filename, header, compression, delimiter=',',
+                 quoting=QUOTE_ALL, append=False):
+        self.file = open_output(filename, compression, append)
+        self.writer = writer(self.file, delimiter=delimiter, quoting=quoting)
+        if header is not None and not append:
+            self.writer.writerow(header)
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class JSONLinesRowWriter(object):
+    ''' Writes each row as a JSON object keyed by the header '''
+
+    def __init__(self, filename, header, compression, types, append=False):
+        self.file = open_output(filename, compression, append)
+        self.header = header
+        self.timestamps = [i for i, t in enumerate(types) if t == TIMESTAMP]
+
+    def write(self, row):
+        row = list(row)
+        for i in self.timestamps:
+            if row[i] is not None:
+                row[i] = str(to_timestamps([row[i]])[0])
+        self.file.write(json.dumps(dict(zip(self.header, row))))
+        self.file.write('\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class Categories(object):
+    ''' Assigns each distinct value of a column a stable code, so that the
+        dictionary of each batch extends that of the batch before '''
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def encode(self, values):
+        indices = []
+        for value in values:
+            if value is None:
+                indices.append(None)
+                continue
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.values)
+                self.values.append(str(value))
+            indices.append(code)
+        return indices
+
+
+def to_timestamps(values):
+    ''' Return an array of millisecond timestamps from values which are
+        either milliseconds since the epoch or dates such as 2017, 2017-03
+        or 2017-03-21 '''
+    import numpy
+    return numpy.array(values, dtype='datetime64[ms]')
+
+
+class ArrowRowWriter(object):
+    ''' Writes rows to an Arrow IPC (Feather version 2) file a record batch
+        at a time. Record batches of columns, such as those of a ResultSet,
+        may be written instead of rows '''
+
+    # Compression supported within the file
+    CODECS = ['zstd']
+
+    def __init__(self, filename, header, compression, types):
+
+        try:
+            import pyarrow
+        except ImportError:
+            raise ValueError('Arrow and Parquet output require the pyarrow '
+                             'package')
+        self.pa = pyarrow
+
+        if compression is None:
+            compression = split_extensions(filename)[1]
+        if compression is not None and compression not in self.CODECS:
+            raise ValueError('Unsupported compression for this format: '
+                             '{}'.format(compression))
+
+        self.types = types
+        self.categories = [Categories() for _ in types]
+        self.schema = pyarrow.schema([
+            (name, self.arrow_type(t)) for name, t in zip(header, types)
+        ])
+        self.rows = []
+        self.batches = []
+        self.pending = 0
+        self.sink = self.open_sink(filename, compression)
+
+    def arrow_type(self, t):
+        pa = self.pa
+        return {
+            INT: pa.int64(),
+            STRING: pa.string(),
+            CATEGORY: pa.dictionary(pa.int32(), pa.string()),
+            TIMESTAMP: pa.timestamp('ms')
+        }[t]
+
+    def open_sink(self, filename, compression):
+        options = self.pa.ipc.IpcWriteOptions(compression=compression,
+                                              emit_dictionary_deltas=True)
+        return self.pa.ipc.new_file(filename, self.schema, options=options)
+
+    def write(self, row):
+        self.rows.append(row)
+        if self.pending + len(self.rows) >= ROW_GROUP_SIZE:
+            self.flush()
+
+    def write_arrow(self, batch):
+        ''' Write a pyarrow RecordBatch with the columns of the file, only
+            converting those whose type differs from the file's '''
+
+        self.encode_rows()
+        arrays = [self.convert(column, t, categories)
+                  for column, t, categories
+                  in zip(batch.columns, self.types, self.categories)]
+        self.batches.append(self.pa.record_batch(arrays, schema=self.schema))
+        self.pending += batch.num_rows
+        if self.pending >= ROW_GROUP_SIZE:
+            self.flush()
+
+    def encode_rows(self):
+        ''' Encode the rows written so far as a record batch '''
+        if not self.rows:
+            return
+        columns = zip(*self.rows)
+        self.pending += len(self.rows)
+        self.rows = []
+        arrays = [self.arrow_array(values, t, categories)
+                  for values, t, categories
+                  in zip(columns, self.types, self.categories)]
+        self.batches.append(self.pa.record_batch(arrays, schema=self.schema))
+
+    def flush(self):
+        self.encode_rows()
+        if self.batches:
+            self.write_batches(self.batches)
+        self.batches = []
+        self.pending = 0
+
+    def arrow_array(self, values, t, categories):
+        pa = self.pa
+        if t == INT:
+            return pa.array(values, type=pa.int64())
+        if t == CATEGORY:
+            indices = pa.array(categories.encode(values), type=pa.int32())
+            return pa.DictionaryArray.from_arrays(
+                indices, self.dictionary(categories)
+            )
+        if t == TIMESTAMP:
+            return pa.array(to_timestamps(values), from_pandas=True)
+        return pa.array([None if value is None else str(value)
+                         for value in values], type=pa.string())
+
+    def convert(self, array, t, categories):
+        ''' Convert an Arrow array to the type of its column, without
+            reading its values into Python where the types allow. The codes
+            of dictionary arrays are mapped to those of the categories, so
+            that the dictionary of each batch extends that of the batch
+            before '''
+
+        import numpy
+
+        pa = self.pa
+        types = pa.types
+
+        if types.is_null(array.type) and t == CATEGORY:
+            return pa.DictionaryArray.from_arrays(
+                pa.nulls(len(array), type=pa.int32()),
+                self.dictionary(categories)
+            )
+        if types.is_null(array.type):
+            return pa.nulls(len(array), type=self.arrow_type(t))
+
+        if t == INT and types.is_int64(array.type):
+            return array
+        if t == STRING and types.is_string(array.type):
+            return array
+        if t == STRING and types.is_dictionary(array.type):
+            return array.dictionary_decode()
+        if t == TIMESTAMP and types.is_int64(array.type):
+            return array.cast(pa.timestamp('ms'))
+
+        if t == CATEGORY and types.is_dictionary(array.type):
+            # Nulls index a placeholder after the dictionary, and are masked
+            dictionary = array.dictionary.to_pylist()
+            mapping = numpy.array(categories.encode(dictionary) + [0],
+                                  dtype=numpy.int32)
+            codes = mapping[array.indices.fill_null(len(dictionary))
+                            .to_numpy()]
+            indices = pa.array(codes, mask=array.is_null().to_numpy(
+                zero_copy_only=False))
+            return pa.DictionaryArray.from_arrays(
+                indices, self.dictionary(categories)
+            )
+
+        return self.arrow_array(array.to_pylist(), t, categories)
+
+    def dictionary(self, categories):
+        ''' Return the dictionary of a category column. The first dictionary
+            written to an IPC file can only be extended by later batches,
+            and an empty one would be replaced instead, so a column without
+            values yet is given the empty string '''
+        if not categories.values:
+            categories.encode([''])
+        return self.pa.array(categories.values, type=self.pa.string())
+
+    def write_batches(self, batches):
+        for batch in batches:
+            self.sink.write_batch(batch)
+
+    def close(self):
+        self.flush()
+        self.sink.close()
+
+
+class ParquetRowWriter(ArrowRowWriter):
+    ''' Writes rows to a Parquet file a row group at a time '''
+
+    CODECS = ['gzip', 'zstd']
+
+    def open_sink(self, filename, compression):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(
+            filename, self.schema, compression=compression or 'snappy'
+        )
+
+    def write_batches(self, batches):
+        self.sink.write_table(self.pa.Table.from_batches(batches))
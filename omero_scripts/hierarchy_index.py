@@ -0,0 +1,240 @@
+import os
+import sqlite3
+from pathlib import Path
+
+# Directory of the indexes, one per server and user, alongside the OMERO
+# configuration file
+DEFAULT_INDEX_DIR = Path.home() / '.omero' / 'index'
+
+# Number of rows fetched per round trip while syncing
+SYNC_PAGE_SIZE = 10000
+
+# Columns of the containers, with the HQL selecting them from the object
+NAMED = [
+    ('name', 'obj.name'),
+    ('owner', 'obj.details.owner.omeName'),
+    ('grp', 'obj.details.group.id')
+]
+
+# Columns of the links between containers and their children
+LINK = [
+    ('parent', 'obj.parent.id'),
+    ('child', 'obj.child.id')
+]
+
+# Tables of the index: the OMERO class of their objects, the HQL from clause
+# with the object as obj, and their columns besides the ID and update event
+TABLES = [
+    ('project', 'ome.model.containers.Project', 'Project obj', NAMED),
+    ('dataset', 'ome.model.containers.Dataset', 'Dataset obj', NAMED),
+    ('project_dataset', 'ome.model.containers.ProjectDatasetLink',
+     'ProjectDatasetLink obj', LINK),
+    ('image', 'ome.model.core.Image', 'Image obj', NAMED),
+    ('dataset_image', 'ome.model.containers.DatasetImageLink',
+     'DatasetImageLink obj', LINK),
+    ('screen', 'ome.model.screen.Screen', 'Screen obj', NAMED),
+    ('plate', 'ome.model.screen.Plate', 'Plate obj', NAMED),
+    ('screen_plate', 'ome.model.screen.ScreenPlateLink',
+     'ScreenPlateLink obj', LINK),
+    ('well', 'ome.model.screen.Well', 'Well obj', [
+        ('plate', 'obj.plate.id'),
+        ('row', 'obj.row'),
+        ('col', 'obj.column')
+    ]),
+    ('well_sample', 'ome.model.screen.WellSample',
+     'Well well join well.wellSamples obj', [
+        ('well', 'well.id'),
+        ('image', 'obj.image.id'),
+        ('idx', 'index(obj)')
+     ])
+]
+
+# Lookups made by the listing scripts
+INDEXES = [
+    ('project_dataset', 'parent'),
+    ('project_dataset', 'child'),
+    ('dataset_image', 'parent'),
+    ('screen_plate', 'parent'),
+    ('well', 'plate'),
+    ('well_sample', 'well')
+]
+
+
+class HierarchyIndexError(Exception):
+    pass
+
+
+class HierarchyIndex(object):
+    ''' Local SQLite mirror of the Project-Dataset-Image and
+        Screen-Plate-Well-Image hierarchies visible to a user, with the IDs,
+        names, owners and update events of each object. Syncing only fetches
+        the objects updated since the last sync and removes those deleted '''
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.db = None
+
+    @staticmethod
+    def path_for(host, username, directory=DEFAULT_INDEX_DIR):
+        ''' Location of the index of a server and user '''
+        return Path(directory) / '{}@{}.sqlite'.format(username, host)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def open(self):
+        ''' Open (creating if necessary) the index database '''
+
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=30)
+            self.create()
+
+        return self.db
+
+    def create(self):
+        for table, _, _, columns in TABLES:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY, {}, '
+                'update_event INTEGER, updated INTEGER)'.format(
+                    table, ', '.join(name for name, _ in columns)
+                )
+            )
+        for table, column in INDEXES:
+            self.db.execute(
+                'CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})'.format(
+                    table, column
+                )
+            )
+        self.db.execute('CREATE TABLE IF NOT EXISTS sync '
+                        '(tbl TEXT PRIMARY KEY, event INTEGER NOT NULL)')
+        self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def sync(self, conn_manager, rebuild=False, page_size=SYNC_PAGE_SIZE):
+        ''' Bring the index up to date with the server, fetching only the
+            objects whose update event is later than the last sync and
+            removing those with deletion events since. Yields the table, the
+            number of objects updated and the number deleted as each table
+            is synced '''
+
+        db = self.open()
+
+        # Anything changed while syncing will be after this event, so will
+        # be fetched again next time
+        event = conn_manager.hql_query('select max(e.id) from Event e')[0][0]
+
+        for table, entity, source, columns in TABLES:
+
+            row = None
+            if not rebuild:
+                row = db.execute('SELECT event FROM sync WHERE tbl = ?',
+                                 (table,)).fetchone()
+
+            # A table never synced in full, e.g. because the first sync was
+            # interrupted, is fetched again from scratch
+            if row is None:
+                db.execute('DELETE FROM {}'.format(table))
+                last = -1
+            else:
+                last = row[0]
+
+            updated = self._sync_updated(conn_manager, table, source, columns,
+                                         last, page_size)
+
+            # A table fetched from scratch has nothing deleted to remove
+            deleted = 0
+            if last != -1:
+                deleted = self._sync_deleted(conn_manager, table, entity,
+                                             last)
+
+            db.execute('INSERT OR REPLACE INTO sync (tbl, event) '
+                       'VALUES (?, ?)', (table, event))
+            db.commit()
+
+            yield table, updated, deleted
+
+    def _sync_updated(self, conn_manager, table, source, columns, last,
+                      page_size):
+        from omero.sys import ParametersI
+        from omero.rtypes import rlong
+
+        q = '''
+            select obj.id,
+                   {columns},
+                   obj.details.updateEvent.id,
+                   obj.details.updateEvent.time
+            from {source}
+            where obj.details.updateEvent.id > :last
+            and obj.id > :id
+            order by obj.id
+            '''.format(columns=', '.join(hql for _, hql in columns),
+                       source=source)
+
+        insert = 'INSERT OR REPLACE INTO {} VALUES ({})'.format(
+            table, ', '.join('?' * (len(columns) + 3))
+        )
+
+        # Page through the objects by ID rather than offset
+        count = 0
+        last_id = -1
+        while True:
+            params = ParametersI()
+            params.map = {'last': rlong(last), 'id': rlong(last_id)}
+            params.page(0, page_size)
+
+            rows = conn_manager.hql_query(q, params)
+            self.db.executemany(insert, rows)
+            self.db.commit()
+            count += len(rows)
+
+            if len(rows) < page_size:
+                return count
+            last_id = rows[-1][0]
+
+    def _sync_deleted(self, conn_manager, table, entity, last):
+        from omero.sys import ParametersI
+        from omero.rtypes import rlong, rstring
+
+        q = '''
+            select log.entityId
+            from EventLog log
+            where log.action = 'DELETE'
+            and log.entityType = :type
+            and log.event.id > :last
+            order by log.id
+            '''
+
+        params = ParametersI()
+        params.map = {'type': rstring(entity), 'last': rlong(last)}
+
+        count = 0
+        for row in conn_manager.iter_hql_query(q, params):
+            count += self.db.execute('DELETE FROM {} WHERE id = ?'.format(
+                table), row).rowcount
+        self.db.commit()
+        return count
+
+    def query(self, sql, params=(), ids=None):
+        ''' Run a query against the index and yield the rows. IDs given are
+            put in the temporary table ids, for "in (select id from ids)" '''
+
+        if not self.exists():
+            raise HierarchyIndexError('There is no local index at {}. '
+                                      'Run sync_hierarchy to create it'
+                                      .format(self.path))
+        db = self.open()
+
+        if ids is not None:
+            db.execute('CREATE TEMP TABLE IF NOT EXISTS ids '
+                       '(id INTEGER PRIMARY KEY)')
+            db.execute('DELETE FROM ids')
+            db.executemany('INSERT OR IGNORE INTO ids VALUES (?)',
+                           ((id,) for id in ids))
+
+        for row in db.execute(sql, params):
+            yield list(row)
@@ -1,24 +1,143 @@
 import sys
 import os
+import json
+import argparse
 import configparser
-from omero.util.sessions import SessionsStore
-from omero.gateway import BlitzGateway
-from omero.sys import ParametersI
-from csv import writer, QUOTE_ALL
+import queue
+import threading
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from operator import attrgetter, itemgetter
 from pathlib import Path
+from . import profiling
+from .query_cache import QueryCache, DEFAULT_CACHE_TTL
+from .hierarchy_index import HierarchyIndex
+from .formats import (open_output, open_row_writer, column_type,  # noqa
+                      resolve_format, FORMATS, APPEND_FORMATS,
+                      COMPRESSION_EXTENSIONS, WRITE_BUFFER_SIZE)
+
+# Number of rows fetched per round trip by iter_hql_query
+DEFAULT_PAGE_SIZE = 10000
+
+# Maximum number of IDs bound to a single "in (:ids)" query
+MAX_IDS_PER_QUERY = 1000
+
+# Number of connections held by an OMEROConnectionPool
+DEFAULT_POOL_SIZE = 4
+
+# Seconds between keepalive pings of idle pooled connections
+DEFAULT_KEEPALIVE = 60
+
+
+class ResidentConnections(object):
+    ''' Connections kept open between the scripts run by one long running
+        process, such as the daemon, so that they need not log in again.
+        Keyed by server and user, each is used by one connection manager at
+        a time '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    @staticmethod
+    def key(params):
+        return params['host'], str(params['port']), params.get('username')
+
+    def take(self, params):
+        ''' Return an idle connection for the server and user, or None if
+            there is none or it has expired '''
+
+        with self.lock:
+            conn = self.idle.pop(self.key(params), None)
+
+        if conn is not None:
+            try:
+                if conn.keepAlive():
+                    return conn
+            except Exception:
+                pass
+            conn.seppuku(softclose=True)
+
+        return None
+
+    def give(self, params, conn):
+        ''' Return a connection to be kept open for the next script '''
+
+        with self.lock:
+            key = self.key(params)
+            if key not in self.idle:
+                self.idle[key] = conn
+                return
+
+        conn.seppuku(softclose=True)
+
+    def close(self):
+        with self.lock:
+            conns = list(self.idle.values())
+            self.idle = {}
+        for conn in conns:
+            conn.seppuku(softclose=True)
+
+
+# Connections kept open by this process, if enabled with
+# keep_connections_resident
+resident_connections = None
+
+
+def keep_connections_resident():
+    ''' Keep the connections of connection managers open when they
+        disconnect, for the next connection manager in this process to
+        reuse '''
+    global resident_connections
+    if resident_connections is None:
+        resident_connections = ResidentConnections()
+    return resident_connections
+
 
 class OMEROConnectionManager(object):
     ''' Basic management of an OMERO Connection. Methods which make use of
         a connection will attempt to connect if connection was not already
         successfuly executed '''
 
-    def __init__(self, config_file=Path.home() / '.omero' / 'config'):
+    def __init__(self, config_file=Path.home() / '.omero' / 'config',
+                 cache=None, params=None, detach=False, resident=True):
 
         self.config_file = config_file
 
+        # Optional QueryCache used to answer repeated queries locally
+        self.cache = cache
+
+        # OMERO Group used for queries, -1 to query across all available data
+        self.group = -1
+
+        # Connection parameters, e.g. to join an existing session by its
+        # suuid. If not given they are read when first needed
+        self.params = params
+
+        # If detaching, the session is left open when disconnecting so that
+        # the next process can join it
+        self.detach = detach
+
+        # If connections are kept resident in this process, reuse one and
+        # leave it open on disconnecting
+        self.resident = resident
+
         # Set the connection as not established
         self.conn = None
 
+    def get_params(self):
+        ''' Get the connection parameters from the current OMERO CLI session
+            or, failing that, the configuration file '''
+
+        if self.params is None:
+            self.params = get_params_from_session()
+
+        if self.params is None:
+            self.params = get_params_from_config_file(self.config_file)
+
+        return self.params
+
     def connect(self):
         ''' Create an OMERO Connection '''
 
@@ -26,22 +145,34 @@ class OMEROConnectionManager(object):
         if self.conn is not None:
             return self.conn
 
-        params = get_params_from_session()
+        # OMERO and Ice are only imported once they are needed, so that
+        # scripts start quickly
+        from omero.gateway import BlitzGateway
 
-        if params is None:
-            params = get_params_from_config_file(self.config_file)
+        params = self.get_params()
+
+        # Reuse a connection left open by an earlier script in this process
+        if self.resident and resident_connections is not None:
+            with profiling.span('connect', source='resident') as span:
+                self.conn = resident_connections.take(params)
+                span.rows = int(self.conn is not None)
+            if self.conn is not None:
+                return self.conn
 
-        # Initialize the connection. At least HOST and PORT will be defined,
-        # but USERNAME and PASSWORD may be None if we are connecting to an
-        # existing session via its uuid.
-        self.conn = BlitzGateway(username=params.get('username'),
-                                 passwd=params.get('password'),
-                                 host=params['host'],
-                                 port=params['port'])
+        with profiling.span('connect', source='login') as span:
 
-        # Connect. If USERNAME and PASSWORD are None then SUUID must be
-        # defined.
-        connected = self.conn.connect(sUuid=params.get('suuid'))
+            # Initialize the connection. At least HOST and PORT will be
+            # defined, but USERNAME and PASSWORD may be None if we are
+            # connecting to an existing session via its uuid.
+            self.conn = BlitzGateway(username=params.get('username'),
+                                     passwd=params.get('password'),
+                                     host=params['host'],
+                                     port=params['port'])
+
+            # Connect. If USERNAME and PASSWORD are None then SUUID must be
+            # defined.
+            connected = self.conn.connect(sUuid=params.get('suuid'))
+            span.rows = int(bool(connected))
 
         # Check that the connection was established
         if not connected:
@@ -50,51 +181,569 @@ class OMEROConnectionManager(object):
             sys.exit(1)
         return self.conn
 
-    def disconnect(self):
-        ''' Terminate the OMERO Connection '''
+    def disconnect(self, detach=None):
+        ''' Terminate the OMERO Connection. If detaching, the session is kept
+            open and made the current session, so that the next connection
+            can join it by its suuid instead of logging in again '''
+
+        if detach is None:
+            detach = self.detach
+
+        if self.conn and self.resident and resident_connections is not None:
+            resident_connections.give(self.get_params(), self.conn)
+            self.conn = None
+
         if self.conn:
-            self.conn.seppuku(softclose=True)
+            if detach:
+                try:
+                    self.conn.c.getSession().detachOnDestroy()
+                    params = self.get_params()
+                    set_current_session(params['host'], params['port'],
+                                        self.conn.getUser().getName(),
+                                        self.session_uuid())
+                    self.conn.close(hard=False)
+                except Exception:
+                    self.conn.seppuku(softclose=True)
+            else:
+                self.conn.seppuku(softclose=True)
             self.conn = None
 
+    def session_uuid(self):
+        ''' The uuid of the session, by which other connections can join it '''
+        return self.connect().getSession().getUuid().val
+
+    def is_alive(self):
+        ''' Check that the connection is established and its session has not
+            expired '''
+        if self.conn is None:
+            return False
+        try:
+            return self.conn.keepAlive()
+        except Exception:
+            return False
+
     def hql_query(self, query, params=None):
         ''' Execute the given HQL query and return the results. Optionally
             accepts a parameters object.
             For conveniance, will unwrap the OMERO types '''
 
+        if params is None:
+            from omero.sys import ParametersI
+            params = ParametersI()
+
+        # Answer from the cache if possible
+        if self.cache is not None:
+            key = self.cache_key(query, params)
+            with profiling.span('cache_read') as span:
+                rows = self.cache.get(key)
+                if rows is not None:
+                    rows = list(rows)
+                    span.rows = len(rows)
+            if rows is None:
+                rows = list(self.cache.store(key,
+                                             self._hql_query(query, params)))
+            return rows
+
+        return self._hql_query(query, params)
+
+    def _hql_query(self, query, params):
+
         # Connect if not already connected
         if self.conn is None:
             self.connect()
 
+        # Set OMERO Group, by default -1 to query across all available data
+        self.conn.SERVICE_OPTS.setOmeroGroup(self.group)
+
+        # Get the Query Service
+        qs = self.conn.getQueryService()
+
+        # Execute the query
+        return self._projection(qs, query, params)
+
+    def _projection(self, qs, query, params):
+        ''' Execute a query and unwrap the results, recording the time spent
+            on the server and transferring the results separately from that
+            spent unwrapping them, if profiling '''
+
+        with profiling.span('query') as span:
+            rows = qs.projection(query, params, self.conn.SERVICE_OPTS)
+            span.rows = len(rows)
+
+        with profiling.span('unwrap') as span:
+            rows = unwrap_rows(rows)
+            span.rows = len(rows)
+
+        if profiling.current is not None:
+            profiling.count('query', bytes=profiling.payload_size(rows))
+
+        return rows
+
+    def iter_hql_query(self, query, params=None, page_size=DEFAULT_PAGE_SIZE):
+        ''' Execute the given HQL query a page at a time and yield the
+            unwrapped rows as they arrive. Optionally accepts a parameters
+            object. Only one page of results is held in memory at any time.
+            The query should have a deterministic ordering so that pages
+            do not overlap '''
+
         if params is None:
+            from omero.sys import ParametersI
             params = ParametersI()
 
-        # Set OMERO Group to -1 to query across all available data
-        self.conn.SERVICE_OPTS.setOmeroGroup(-1)
+        # Answer from the cache if possible
+        if self.cache is not None:
+            key = self.cache_key(query, params)
+            rows = self.cache.get(key)
+            if rows is None:
+                return self.cache.store(
+                    key, self._iter_hql_query(query, params, page_size)
+                )
+            return profiling.span('cache_read').iterate(rows)
+
+        return self._iter_hql_query(query, params, page_size)
+
+    def _iter_hql_query(self, query, params, page_size):
+
+        # Connect if not already connected
+        if self.conn is None:
+            self.connect()
+
+        # Set OMERO Group, by default -1 to query across all available data
+        self.conn.SERVICE_OPTS.setOmeroGroup(self.group)
 
         # Get the Query Service
         qs = self.conn.getQueryService()
 
-        # Execute the query
-        rows = qs.projection(query, params, self.conn.SERVICE_OPTS)
+        offset = 0
+        while True:
+
+            # Execute the query for the current page
+            params.page(offset, page_size)
+            rows = self._projection(qs, query, params)
+
+            for row in rows:
+                yield row
+
+            # A short page means that there are no more results
+            if len(rows) < page_size:
+                break
 
-        # Unwrap the query results
-        unwrapped_rows = []
-        for row in rows:
-            unwrapped_row=[]
-            for column in row:
-                if column is None:
-                    unwrapped_row.append(None)
-                else:
-                    unwrapped_row.append(column.val)
-            unwrapped_rows.append(unwrapped_row)
+            offset += page_size
 
-        return unwrapped_rows
+    def cache_key(self, query, params):
+        ''' Key a query on the server, user and group it is run as and its
+            text and bound parameters '''
+
+        from omero.rtypes import unwrap
+
+        conn_params = self.get_params()
+
+        bound = {k: unwrap(v) for k, v in (params.map or {}).items()}
+        if params.theFilter is not None:
+            bound['__filter__'] = [unwrap(params.theFilter.offset),
+                                   unwrap(params.theFilter.limit)]
+
+        return QueryCache.key(conn_params['host'], conn_params['username'],
+                              self.group, query, bound)
 
     def __del__(self):
         self.disconnect()
 
 
+class OMEROConnectionPool(object):
+    ''' A pool of up to size OMEROConnectionManagers. The first logs in and
+        the rest join its session, so only one login is ever needed. Idle
+        connections are pinged to keep their session alive and any found
+        to have expired are reconnected when next acquired '''
+
+    def __init__(self, size=DEFAULT_POOL_SIZE,
+                 config_file=Path.home() / '.omero' / 'config', params=None,
+                 keepalive=DEFAULT_KEEPALIVE, cache=None, detach=False):
+
+        self.size = size
+        self.config_file = config_file
+        self.params = params
+        self.keepalive = keepalive
+        self.cache = cache
+        self.detach = detach
+
+        self.condition = threading.Condition()
+        self.managers = []
+        self.idle = []
+        self.closed = threading.Event()
+
+        # Threads in which queries are run concurrently, each on a pooled
+        # connection
+        self.executor = ThreadPoolExecutor(max_workers=size)
+
+        # Ping idle connections in the background
+        self.keepalive_thread = None
+        if keepalive:
+            self.keepalive_thread = threading.Thread(target=self._keepalive)
+            self.keepalive_thread.daemon = True
+            self.keepalive_thread.start()
+
+    def _new_manager(self):
+        ''' Create a connection, joining the session of an existing one if
+            there is one '''
+
+        params = self.params
+        for manager in self.managers:
+            if manager.is_alive():
+                params = dict(manager.get_params(), password=None,
+                              suuid=manager.session_uuid())
+                break
+
+        # Pooled connections are used concurrently, so are not shared with
+        # the resident connections
+        manager = OMEROConnectionManager(self.config_file, cache=self.cache,
+                                         params=params, resident=False)
+        manager.connect()
+        return manager
+
+    def acquire(self):
+        ''' Take a connection from the pool, waiting for one to become free
+            if all size connections are in use '''
+
+        with self.condition:
+            while not self.idle and len(self.managers) >= self.size:
+                self.condition.wait()
+
+            if self.idle:
+                manager = self.idle.pop()
+            else:
+                manager = None
+
+        # Connect outside the lock, as this is slow
+        if manager is None:
+            manager = self._new_manager()
+            with self.condition:
+                self.managers.append(manager)
+
+        # Health check, replacing the connection if its session has expired
+        elif not manager.is_alive():
+            replacement = self._new_manager()
+            with self.condition:
+                self.managers[self.managers.index(manager)] = replacement
+            manager.conn = None
+            manager = replacement
+
+        return manager
+
+    def release(self, manager):
+        ''' Return a connection to the pool '''
+        with self.condition:
+            self.idle.append(manager)
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self):
+        ''' Context manager which acquires and releases a connection '''
+        manager = self.acquire()
+        try:
+            yield manager
+        finally:
+            self.release(manager)
+
+    def _keepalive(self):
+        while not self.closed.wait(self.keepalive):
+            with self.condition:
+                idle = list(self.idle)
+            for manager in idle:
+                manager.is_alive()
+
+    def close(self):
+        ''' Disconnect all the connections. If detaching, the shared session
+            is left open for the next process to join '''
+        self.closed.set()
+        self.executor.shutdown(wait=False)
+        with self.condition:
+            managers = self.managers
+            self.managers = []
+            self.idle = []
+
+        # Detach only the last connection, as the others share its session
+        for i, manager in enumerate(managers):
+            manager.disconnect(
+                detach=self.detach and i == len(managers) - 1
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+def iter_paged_hql_queries(pool, queries, page_size=DEFAULT_PAGE_SIZE):
+    ''' Execute many (query, params) pairs concurrently over the connections
+        of a pool, each a page at a time, yielding their rows in the same
+        order. Each query runs at most one page ahead of the reader, so only
+        about two pages per connection are held in memory '''
+
+    stop = threading.Event()
+    done = object()
+
+    def put(pages, item):
+        # Wait for the reader to take the last page, unless it has stopped
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(query, params, pages):
+        if stop.is_set():
+            return
+        try:
+            with pool.connection() as manager:
+                rows = manager.iter_hql_query(query, params, page_size)
+                try:
+                    for page in iter_batches(rows, page_size):
+                        if not put(pages, page):
+                            return
+                finally:
+                    # Close in this thread, so that an abandoned result is
+                    # discarded from the cache here rather than when
+                    # collected
+                    getattr(rows, 'close', lambda: None)()
+            put(pages, done)
+        except BaseException as e:
+            put(pages, e)
+
+    # Queries are started in order and each connection runs one until it
+    # has been read, so the one being read is always running
+    runs = []
+    for query, params in queries:
+        pages = queue.Queue(maxsize=1)
+        runs.append((pool.executor.submit(run, query, params, pages), pages))
+
+    try:
+        for _, pages in runs:
+            while True:
+                page = pages.get()
+                if page is done:
+                    break
+                if isinstance(page, BaseException):
+                    raise page
+                for row in page:
+                    yield row
+    finally:
+        # Stop any queries still running, and wait for them to return their
+        # connections to the pool
+        stop.set()
+        for future, _ in runs:
+            future.cancel()
+        futures.wait([future for future, _ in runs])
+
+
+def iter_hql_query_ids(conn_manager, query, ids, pool=None,
+                       chunk_size=MAX_IDS_PER_QUERY, connections=1):
+    ''' Execute the given HQL query, which must bind the IDs as :ids, for
+        many IDs. The IDs are deduplicated, sorted and bound a chunk at a time
+        so that the query text is the same for every chunk and the server's
+        limits on the number of parameters are respected. If there are
+        several chunks they are run concurrently over a pool, the one given
+        or otherwise one of connections connections which is created for
+        them and closed once they have been read, if there is more than one.
+        Otherwise they are run one after another with conn_manager. Either
+        way they are run a page at a time. Yields the unwrapped rows chunk
+        by chunk '''
+
+    from omero.sys import ParametersI
+
+    ids = sorted(set(ids))
+    chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+
+    queries = []
+    for chunk in chunks:
+        params = ParametersI()
+        params.addIds(chunk)
+        queries.append((query, params))
+
+    if len(queries) < 2 or (pool is None and connections < 2):
+        for query, params in queries:
+            for row in conn_manager.iter_hql_query(query, params):
+                yield row
+
+    elif pool is not None:
+        yield from iter_paged_hql_queries(pool, queries)
+
+    else:
+        with OMEROConnectionPool(connections,
+                                 config_file=conn_manager.config_file,
+                                 params=conn_manager.params,
+                                 cache=conn_manager.cache,
+                                 detach=conn_manager.detach) as pool:
+            yield from iter_paged_hql_queries(pool, queries)
+
+
+def ids_from_args(ids):
+    ''' Return the IDs given on the command line or, if there are none,
+        read them from stdin separated by whitespace or commas '''
+
+    if ids:
+        return ids
+
+    try:
+        ids = [int(id) for id in sys.stdin.read().replace(',', ' ').split()]
+    except ValueError:
+        sys.stderr.write('IDs read from stdin must be integers\n')
+        sys.exit(1)
+
+    if not ids:
+        sys.stderr.write('No IDs were given\n')
+        sys.exit(1)
+
+    return ids
+
+
+class ProfileAction(argparse.Action):
+    ''' Start profiling as soon as --profile is parsed '''
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, self.dest, values)
+        profiling.enable(values)
+
+
+def add_connection_arguments(parser, pool=False):
+    ''' Add the options controlling the OMERO session to a parser. If pool,
+        also add the option controlling the size of a connection pool.
+        Profiling is started if OMERO_SCRIPTS_PROFILE is set '''
+
+    profiling.enable_from_environment()
+
+    parser.add_argument('--keep-session', action='store_const', const=True,
+                        default=False,
+                        help='''Leave the OMERO session open on exit so that
+                                the next script can join it instead of
+                                logging in again''')
+    parser.add_argument('--profile', metavar='file', action=ProfileAction,
+                        help='''Record the time spent in each phase and
+                                write it to this file on exit, as JSON if it
+                                ends in .json (appended as a line if .jsonl)
+                                or otherwise Prometheus text. Also enabled
+                                by setting {}'''.format(
+                                    profiling.PROFILE_ENV))
+    if pool:
+        parser.add_argument('-c', '--connections', metavar='connections',
+                            type=int, default=DEFAULT_POOL_SIZE,
+                            help='''Number of connections used to run
+                                    queries concurrently
+                                    (Default: {})'''.format(
+                                        DEFAULT_POOL_SIZE))
+
+
+def add_cache_arguments(parser, ttl=DEFAULT_CACHE_TTL):
+    ''' Add the options controlling the local query cache to a parser. The
+        cache is only used if asked for, so that results are never stale
+        unless that is acceptable '''
+    group = parser.add_argument_group('cache')
+    group.add_argument('--cache', dest='cache', action='store_const',
+                       const=True, default=False,
+                       help='''Answer repeated queries from the local query
+                               cache and store the results in it''')
+    group.add_argument('--no-cache', dest='cache', action='store_const',
+                       const=False,
+                       help='Do not read or write the local query cache '
+                            '(Default)')
+    group.add_argument('--refresh', action='store_const', const=True,
+                       default=False,
+                       help='''Ignore cached results and refresh the cache.
+                               Implies --cache''')
+    group.add_argument('--cache-ttl', metavar='seconds', type=int,
+                       default=ttl,
+                       help='''Seconds for which cached results are used
+                               (Default: {})'''.format(ttl))
+
+
+def add_format_arguments(parser):
+    ''' Add the option choosing the format of the destination file to a
+        parser '''
+    parser.add_argument('--format', choices=FORMATS,
+                        help='''Format of the destination file. Inferred from
+                                its extension if not given, otherwise
+                                CSV''')
+
+
+def add_local_arguments(parser):
+    ''' Add the option answering from the local hierarchy index to a
+        parser '''
+    parser.add_argument('-l', '--local', action='store_const', const=True,
+                        default=False,
+                        help='''Answer from the local index of the hierarchy
+                                built by sync_hierarchy instead of the
+                                server''')
+
+
+def local_query(conn_manager, sql, params=(), ids=None):
+    ''' Run an SQL query against the local hierarchy index of the server and
+        user of a connection manager, returning an iterator over the rows.
+        Exits if there is no index '''
+
+    conn_params = conn_manager.get_params()
+    index = HierarchyIndex(HierarchyIndex.path_for(conn_params['host'],
+                                                   conn_params['username']))
+    if not index.exists():
+        sys.stderr.write('There is no local index of {}. Run sync_hierarchy '
+                         'to create it\n'.format(conn_params['host']))
+        sys.exit(1)
+
+    return profiling.span('local_query').iterate(index.query(sql, params,
+                                                             ids))
+
+
+def cache_from_args(args):
+    ''' Create the QueryCache configured by add_cache_arguments options, or
+        None if it is not used '''
+    if not (args.cache or args.refresh):
+        return None
+    return QueryCache(ttl=args.cache_ttl, refresh=args.refresh)
+
+
+def unwrap_row(row):
+    ''' Unwrap the OMERO types in a single projection row. Their values are
+        read from _val, as val is looked up by a __getattr__ which is an
+        order of magnitude slower '''
+    return [None if column is None else column._val for column in row]
+
+
+def unwrap_column(cells):
+    ''' Unwrap a column of OMERO types into a list. Strings are interned, so
+        that repeated names, such as those of owners and groups, are only
+        stored once '''
+
+    try:
+        values = list(map(attrgetter('_val'), cells))
+    except AttributeError:
+        # There are nulls, e.g. from an outer join
+        values = [None if cell is None else cell._val for cell in cells]
+
+    first = next((value for value in values if value is not None), None)
+    if isinstance(first, str):
+        try:
+            values = list(map(sys.intern, values))
+        except TypeError:
+            values = [None if value is None else sys.intern(value)
+                      for value in values]
+
+    return values
+
+
+def unwrap_rows(rows):
+    ''' Unwrap the OMERO types in projection rows a column at a time,
+        interning their strings '''
+    columns = [unwrap_column(cells) for cells in zip(*rows)]
+    return list(map(list, zip(*columns)))
+
+
 def get_params_from_session():
+    from omero.util.sessions import SessionsStore
     store = SessionsStore()
     session_props = store.get_current()
     host, username, suuid, port = session_props
@@ -111,6 +760,15 @@ def get_params_from_session():
     }
 
 
+def set_current_session(host, port, username, suuid):
+    ''' Record a session as the current session, as the OMERO CLI does, so
+        that get_params_from_session finds it '''
+    from omero.util.sessions import SessionsStore
+    store = SessionsStore()
+    store.add(host, username, suuid, {'omero.port': str(port)})
+    store.set_current(host, username, suuid)
+
+
 def get_params_from_config_file(config_file):
     '''Set parameters from config_file.'''
 
@@ -142,28 +800,631 @@ def get_params_from_config_file(config_file):
     }
 
 
-def write_csv(rows, filename, header=None):
-    ''' Write a CSV File with the given header and rows '''
+def write_rows(rows, header=None, filename=None, quiet=False,
+               compression=None, output_format=None, types=None,
+               append=False, checkpoint=None,
+               checkpoint_rows=DEFAULT_PAGE_SIZE):
+    ''' Print (if not quieted) and write to a file (if specified) the given
+        header and rows in a single pass. Rows may be any iterable, including
+        a generator, and are output as they are read. The header and column
+        types of a ResultSet are those it has, unless given. The file is CSV
+        unless another format is given or inferred from its extension, with
+        column types inferred from the header unless given. A ResultSet
+        written to a columnar format is written a batch of columns at a time,
+        without converting its rows to Python values unless they are also
+        printed. Returns the number of rows written.
+
+        If a checkpoint function is given it is called with the number of
+        rows written and the last of them every checkpoint_rows rows, once
+        they have been flushed to the file, and again when writing stops
+        whether or not all of the rows were written '''
 
-    # If there is a header to be written, ensure that it is the same length
-    # as the first row.
-    if header is not None and len(rows) > 0 and len(rows[0]) != len(header):
+    if isinstance(rows, ResultSet):
+        header = rows.names if header is None else header
+        types = rows.types if types is None else types
+
+    row_writer = None
+    count = 0
+
+    # Only a row which was printed and written is checkpointed, not one
+    # which failed to be
+    last_written = None
+
+    # Only the time spent writing is recorded, not that spent producing the
+    # rows, if profiling
+    with profiling.span('write') as span:
+
+        if filename is not None:
+            row_writer = open_row_writer(filename, header, output_format,
+                                         compression, types, append)
+
+        try:
+            if header is not None and not quiet and not append:
+                print(', '.join(header))
+
+            if (isinstance(rows, ResultSet) and checkpoint is None
+                    and hasattr(row_writer, 'write_arrow')):
+                count = write_arrow_batches(rows, header, row_writer, quiet,
+                                            span)
+            else:
+                for row in span.exclude(rows):
+
+                    # If there is a header, ensure that it is the same length
+                    # as the first row.
+                    if (count == 0 and header is not None
+                            and len(row) != len(header)):
+                        raise ValueError('Header does not have the same '
+                                         'number of columns as the rows')
+
+                    if not quiet:
+                        print(', '.join([str(item) for item in row]))
+                    if row_writer is not None:
+                        row_writer.write(row)
+
+                    count += 1
+                    last_written = row
+
+                    if (checkpoint is not None
+                            and count % checkpoint_rows == 0):
+                        if row_writer is not None:
+                            row_writer.flush()
+                        checkpoint(count, last_written)
+
+        finally:
+            if row_writer is not None:
+                row_writer.close()
+            if checkpoint is not None and count > 0:
+                checkpoint(count, last_written)
+            span.rows = count
+
+    return count
+
+
+def write_arrow_batches(result, header, row_writer, quiet, span):
+    ''' Write a ResultSet to a columnar row writer a batch of columns at a
+        time, printing its rows (if not quieted). Returns the number of rows
+        written '''
+
+    if header is not None and len(header) != len(result.names):
         raise ValueError('Header does not have the same number of columns '
                          'as the rows')
 
-    # Write the CSV File
-    with open(filename, 'w') as csvfile:
-        row_writer = writer(csvfile, quoting=QUOTE_ALL)
-        if header is not None:
-            row_writer.writerow(header)
-        row_writer.writerows(rows)
+    count = 0
+    for batch in span.exclude(result.iter_batches()):
+        if not quiet:
+            for row in result.rows(batch):
+                print(', '.join([str(item) for item in row]))
+        row_writer.write_arrow(result.arrow_batch(batch))
+        count += batch.length
+
+    return count
+
+
+def write_csv(rows, filename, header=None, compression=None):
+    ''' Write a CSV File with the given header and rows. Returns the number
+        of rows written '''
+    return write_rows(rows, header, filename=filename, quiet=True,
+                      compression=compression, output_format='csv')
+
+
+def report_written(count, filename):
+    ''' Report the number of rows written to a file (if specified) '''
+    if filename is not None:
+        sys.stderr.write('Wrote {} rows to {}\n'.format(count, filename))
+
+
+def iter_batches(rows, size=DEFAULT_PAGE_SIZE):
+    ''' Group an iterable of rows into lists of at most size rows '''
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def encode_strings(values):
+    ''' Dictionary encode a list of strings, returning an array of codes,
+        -1 for nulls, and the list of the distinct strings they index in the
+        order first seen '''
+
+    import numpy
+
+    index = {None: -1}
+    dictionary = []
+    for value in dict.fromkeys(values):
+        if value is not None:
+            index[value] = len(dictionary)
+            dictionary.append(value)
+
+    return (numpy.fromiter(map(index.__getitem__, values), dtype=numpy.int32,
+                           count=len(values)),
+            dictionary)
+
+
+def decode_strings(codes, dictionary):
+    ''' Return an object array of the strings of an array of codes '''
+    import numpy
+    # The null is last, so that -1 indexes it
+    strings = numpy.empty(len(dictionary) + 1, dtype=object)
+    strings[:-1] = dictionary
+    return strings[codes]
+
+
+class ResultBatch(object):
+    ''' Some of the rows of a result set, a column at a time. Each column is
+        a pair of an array of its values and a boolean array masking the
+        nulls, or None if there are none. String columns are instead the
+        pair of an array of codes and the list of strings they index. A
+        column is None if it was entirely null before the kind of its values
+        was known '''
+
+    def __init__(self, length, columns):
+        self.length = length
+        self.columns = columns
+
+
+def value_kind(value):
+    ''' How a column whose first value is this is stored: as int64 or
+        float64 arrays, dictionary encoded strings or an object array.
+        None if the value is null and so tells nothing '''
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return 'string'
+    if isinstance(value, bool):
+        return 'object'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    return 'object'
+
+
+class ResultSet(object):
+    ''' Query results held a column at a time: integers and floats in
+        arrays, with a mask of any nulls, and strings dictionary encoded so
+        that each distinct string is stored once. The header names and types
+        each column, the types being those of the typed output formats, by
+        default inferred from the names.
+
+        Rows are held in batches, each string column with a dictionary of
+        its own. A streamed result set encodes a batch at a time from an
+        iterable of rows as it is read, so that it can be written in a
+        single pass in bounded memory, and can only be read once unless
+        collected first. Accessing its columns or length collects it.
+        Collected result sets are held as a single batch, which converts to
+        NumPy, pandas or Arrow without copying the integer columns or the
+        codes of the strings '''
+
+    def __init__(self, names, types=None):
+        self.names = list(names)
+        if types is None:
+            types = [column_type(name) for name in self.names]
+        self.types = list(types)
+        self.kinds = [None] * len(self.names)
+        self.batches = []
+        self.pending = None
+        self.consumed = False
+
+    @classmethod
+    def from_rows(cls, names, rows, types=None,
+                  batch_size=DEFAULT_PAGE_SIZE):
+        ''' A result set of all of the rows of an iterable '''
+        result = cls(names, types)
+        result.batches = [result.encode(batch)
+                          for batch in iter_batches(rows, batch_size)]
+        return result.collect()
+
+    @classmethod
+    def stream(cls, names, rows, types=None, batch_size=DEFAULT_PAGE_SIZE):
+        ''' A streamed result set of the rows of an iterable, which is only
+            read as the result set is '''
+        result = cls(names, types)
+        result.pending = (result.encode(batch)
+                          for batch in iter_batches(rows, batch_size))
+        return result
+
+    @property
+    def streamed(self):
+        return self.pending is not None
+
+    def encode(self, rows):
+        ''' Encode a list of rows as a batch '''
+
+        if rows and len(rows[0]) != len(self.names):
+            raise ValueError('Header does not have the same number of '
+                             'columns as the rows')
+
+        columns = [self.encode_column(i, values)
+                   for i, values in enumerate(zip(*rows))]
+        return ResultBatch(len(rows), columns or [None] * len(self.names))
+
+    def encode_column(self, i, values):
+        ''' Encode a list of the values of the i-th column '''
+
+        import numpy
+
+        kind = self.kinds[i]
+        if kind is None:
+            first = next((value for value in values if value is not None),
+                         None)
+            kind = self.kinds[i] = value_kind(first)
+
+        if kind is None:
+            return None
+
+        if kind == 'string':
+            return encode_strings(values)
+
+        if kind == 'object':
+            data = numpy.empty(len(values), dtype=object)
+            for j, value in enumerate(values):
+                data[j] = value
+            return data, None
+
+        dtype = numpy.int64 if kind == 'int' else numpy.float64
+        if None not in values:
+            return numpy.array(values, dtype=dtype), None
+        mask = numpy.fromiter((value is None for value in values),
+                              dtype=bool, count=len(values))
+        data = numpy.array([0 if value is None else value
+                            for value in values], dtype=dtype)
+        return data, mask
+
+    def iter_batches(self):
+        ''' Iterate over the batches, reading those of a streamed result
+            set as they are encoded without keeping them '''
+
+        if self.consumed:
+            raise ValueError('A streamed result set can only be read once')
+
+        yield from self.batches
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            self.consumed = True
+            yield from pending
+
+    def __iter__(self):
+        ''' Iterate over the rows as tuples of Python values '''
+        for batch in self.iter_batches():
+            yield from self.rows(batch)
+
+    def rows(self, batch):
+        ''' The rows of a batch as tuples of Python values '''
+        return zip(*[self.array(batch, i).tolist()
+                     for i in range(len(self.names))])
+
+    def array(self, batch, i):
+        ''' The values of the i-th column of a batch as a NumPy array: int64
+            or float64, masked if there are nulls, or objects. Numeric arrays
+            are not copies '''
+
+        import numpy
+
+        column = batch.columns[i]
+        if column is None:
+            return numpy.full(batch.length, None, dtype=object)
+
+        if self.kinds[i] == 'string':
+            return decode_strings(*column)
+
+        data, mask = column
+        if mask is not None:
+            return numpy.ma.MaskedArray(data, mask=mask)
+        return data
+
+    def collect(self):
+        ''' Read all of the rows of a streamed result set and join the
+            batches into one. Returns the result set '''
+
+        if self.consumed:
+            raise ValueError('A streamed result set can only be read once')
+
+        if self.pending is not None:
+            self.batches.extend(self.pending)
+            self.pending = None
+
+        if len(self.batches) != 1:
+            self.batches = [self.concatenate(self.batches)]
+        return self
+
+    def concatenate(self, batches):
+        ''' Join batches into one, merging the dictionaries of their string
+            columns '''
+
+        import numpy
+
+        length = sum(batch.length for batch in batches)
+        columns = []
+        for i, kind in enumerate(self.kinds):
+            parts = [batch.columns[i] for batch in batches]
+
+            if kind is None:
+                columns.append(None)
+
+            elif kind == 'string':
+                index = {}
+                codes = []
+                for batch, part in zip(batches, parts):
+                    if part is None:
+                        codes.append(numpy.full(batch.length, -1,
+                                                dtype=numpy.int32))
+                        continue
+                    # Map the batch's codes to those of the merged
+                    # dictionary, with the null last
+                    mapping = [index.setdefault(value, len(index))
+                               for value in part[1]]
+                    codes.append(numpy.array(mapping + [-1],
+                                             dtype=numpy.int32)[part[0]])
+                columns.append((numpy.concatenate(codes) if codes else
+                                numpy.empty(0, dtype=numpy.int32),
+                                list(index)))
+
+            else:
+                # Batches entirely null before the kind was known are
+                # filled with nulls, or masked zeros
+                dtype = {'int': numpy.int64,
+                         'float': numpy.float64}.get(kind, object)
+                fill = None if dtype is object else 0
+                data = [numpy.full(batch.length, fill, dtype=dtype)
+                        if part is None else part[0]
+                        for batch, part in zip(batches, parts)]
+                masks = [numpy.full(batch.length, part is None and
+                                    dtype is not object, dtype=bool)
+                         if part is None or part[1] is None else part[1]
+                         for batch, part in zip(batches, parts)]
+                mask = numpy.concatenate(masks) if masks else None
+                columns.append((
+                    numpy.concatenate(data) if data else
+                    numpy.empty(0, dtype=dtype),
+                    mask if mask is not None and mask.any() else None
+                ))
+
+        return ResultBatch(length, columns)
+
+    def __len__(self):
+        return self.collect().batches[0].length
+
+    def index(self, name):
+        ''' Position of the named column '''
+        try:
+            return self.names.index(name)
+        except ValueError:
+            raise KeyError(name)
+
+    def column(self, name):
+        ''' The values of the named column as a NumPy array '''
+        return self.array(self.collect().batches[0], self.index(name))
+
+    def codes(self, name):
+        ''' The codes of the named string column, -1 for nulls, and the list
+            of strings they index '''
+        i = self.index(name)
+        if self.kinds[i] != 'string':
+            raise TypeError('{} is not a string column'.format(name))
+        return self.collect().batches[0].columns[i]
+
+    def to_numpy(self):
+        ''' A dict of the columns as NumPy arrays, by name '''
+        return {name: self.column(name) for name in self.names}
+
+    def to_pandas(self):
+        ''' A pandas DataFrame of the columns. String columns are
+            categorical and integer columns with nulls are nullable '''
+
+        import pandas
+
+        batch = self.collect().batches[0]
+        data = {}
+        for i, name in enumerate(self.names):
+            column = batch.columns[i]
+            kind = self.kinds[i]
+            if column is None or kind == 'object':
+                data[name] = self.array(batch, i)
+            elif kind == 'string':
+                data[name] = pandas.Categorical.from_codes(*column)
+            elif column[1] is None:
+                data[name] = column[0]
+            elif kind == 'int':
+                data[name] = pandas.arrays.IntegerArray(*column)
+            else:
+                data[name] = pandas.arrays.FloatingArray(*column)
+
+        return pandas.DataFrame(data, columns=self.names, copy=False)
+
+    def to_arrow(self):
+        ''' A pyarrow Table of the columns. String columns are dictionary
+            arrays and the header's types are kept in the schema metadata '''
+
+        import pyarrow
+
+        batch = self.arrow_batch(self.collect().batches[0])
+        return pyarrow.Table.from_batches([batch]).replace_schema_metadata({
+            'types': json.dumps(self.types)
+        })
+
+    def iter_arrow(self):
+        ''' Iterate over the batches as pyarrow RecordBatches, reading those
+            of a streamed result set as they are encoded '''
+        for batch in self.iter_batches():
+            yield self.arrow_batch(batch)
+
+    def arrow_batch(self, batch):
+        ''' A batch as a pyarrow RecordBatch, with string columns as
+            dictionary arrays. The integer and float columns and the codes of
+            the strings are not copied '''
+
+        import pyarrow
+
+        arrays = []
+        for i, name in enumerate(self.names):
+            column = batch.columns[i]
+            kind = self.kinds[i]
+            if column is None:
+                arrays.append(pyarrow.nulls(batch.length))
+            elif kind == 'string':
+                codes, dictionary = column
+                arrays.append(pyarrow.DictionaryArray.from_arrays(
+                    pyarrow.array(codes, mask=codes < 0),
+                    pyarrow.array(dictionary, type=pyarrow.string())
+                ))
+            elif kind == 'object':
+                arrays.append(pyarrow.array(column[0].tolist()))
+            else:
+                arrays.append(pyarrow.array(column[0], mask=column[1]))
+
+        return pyarrow.RecordBatch.from_arrays(arrays, names=self.names)
+
+    def replace_columns(self, names, name, function, type=None):
+        ''' A result set with the named columns replaced by one, at the
+            position of the first of them, computed a batch at a time by
+            function from arrays of their values. Streamed if this is '''
+
+        indices = [self.index(column) for column in names]
+        order = [i for i in range(len(self.names))
+                 if i == indices[0] or i not in indices]
+        position = order.index(indices[0])
+
+        result = ResultSet(
+            [name if i == indices[0] else self.names[i] for i in order],
+            [type or column_type(name) if i == indices[0] else self.types[i]
+             for i in order]
+        )
+
+        def batches():
+            for batch in self.iter_batches():
+
+                # The kinds of a streamed result set are known once its
+                # values are
+                for j, i in enumerate(order):
+                    if j != position:
+                        result.kinds[j] = self.kinds[i]
+
+                values = function(*[self.array(batch, i) for i in indices])
+                columns = [batch.columns[i] for i in order]
+                columns[position] = result.encode_column(position, values)
+                yield ResultBatch(batch.length, columns)
+
+        if self.streamed:
+            result.pending = batches()
+        else:
+            result.batches = list(batches())
+        return result
+
+
+def replace_row_col_with_well(rows, first_well=None,
+                              batch_size=DEFAULT_PAGE_SIZE):
+    ''' Replace Row+Column IDs with a more meaningful Well designation,
+        E.g. Row 3, Column 2: D3. The Well is assigned to the position that
+        row was in and the column field is removed altogether.
+
+        Rows are transformed a batch at a time, looking the Wells of the
+        whole batch up in a table rather than formatting each one. A
+        ResultSet is returned as one with its Row and Column columns
+        replaced, for iterables of rows first_well is the index of the row
+        field '''
+
+    wells = WellNames()
+    if isinstance(rows, ResultSet):
+        return rows.replace_columns(['Row', 'Column'], 'Well', wells.lookup)
+    return _replace_row_col_with_well(rows, first_well, batch_size, wells)
+
+
+def _replace_row_col_with_well(rows, first_well, batch_size, wells):
+    for batch in iter_batches(rows, batch_size):
+        well = wells.lookup(int_column(batch, first_well),
+                            int_column(batch, first_well + 1))
+        for row, name in zip(batch, well):
+            row[first_well] = name
+            del row[first_well + 1]
+        yield from batch
+
+
+def int_column(rows, index):
+    ''' Return the index-th field of each of a list of rows as an array of
+        integers '''
+    import numpy
+    return numpy.fromiter(map(itemgetter(index), rows), dtype=numpy.int64,
+                          count=len(rows))
+
+
+class WellNames(object):
+    ''' Table of Well designations indexed by well row and column, grown
+        as larger plates are seen '''
+
+    def __init__(self):
+        import numpy
+        self.table = numpy.empty((0, 0), dtype=object)
+
+    def lookup(self, rows, columns):
+        ''' Return a list of the Wells of the given arrays of well rows and
+            columns, None where either is null, masked or None '''
+
+        import numpy
+
+        if len(rows) == 0:
+            return []
+
+        null = numpy.zeros(len(rows), dtype=bool)
+        indices = []
+        for values in (rows, columns):
+            if values.dtype == object:
+                mask = numpy.array([value is None for value in values],
+                                   dtype=bool)
+                values = numpy.where(mask, 0, values).astype(numpy.int64)
+            else:
+                mask = numpy.ma.getmaskarray(values)
+                values = numpy.ma.getdata(values)
+            null |= mask
+            indices.append(values)
+
+        if null.all():
+            return [None] * len(rows)
+
+        rows, columns = indices
+        shape = (max(int(rows[~null].max()) + 1, self.table.shape[0]),
+                 max(int(columns[~null].max()) + 1, self.table.shape[1]))
+        if shape != self.table.shape:
+            self.table = well_table(*shape)
+
+        wells = self.table[numpy.where(null, 0, rows),
+                           numpy.where(null, 0, columns)]
+        wells[null] = None
+        return wells.tolist()
+
+
+def well_table(rows, columns):
+    ''' Return a rows x columns array of the Well designations of a plate '''
+    import numpy
+    table = numpy.empty((rows, columns), dtype=object)
+    for row in range(rows):
+        name = well_row_name(row)
+        for column in range(columns):
+            table[row, column] = '%s%i' % (name, column + 1)
+    return table
+
+
+def well_row_name(row):
+    ''' Return the letters of a well row indexed from zero. Rows beyond Z
+        continue AA, AB, ... as on 1536 well plates '''
+
+    # Bijective base 26, making use of ASCII character set numbering, where
+    # A-Z is 65-90
+    row = int(row) + 1
+    name = ''
+    while row > 0:
+        row, remainder = divmod(row - 1, 26)
+        name = chr(65 + remainder) + name
+    return name
 
 
 def well_from_row_col(row, column):
     ''' Return a meaningful Well from a well row and column. E.g.
         Row=4, Column=3 will result in a Well of D2 '''
 
-    # Convert row to character, Making use of ASCII character set numbering,
-    # where A-Z is 65-90. Also increment column as it is indexed from zero
-    # in the database, but not in the Well designation
-    return '%s%i' % (chr(65 + int(row)), column + 1)
+    # Increment column as it is indexed from zero in the database, but not in
+    # the Well designation
+    return '%s%i' % (well_row_name(row), column + 1)
@@ -0,0 +1,107 @@
+import os
+import sqlite3
+from pathlib import Path
+
+# Location of the store, alongside the OMERO configuration file
+DEFAULT_STORE_FILE = Path.home() / '.omero' / 'period_counts.sqlite'
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS aggregates (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        host TEXT NOT NULL,
+        username TEXT NOT NULL,
+        name TEXT NOT NULL,
+        closed TEXT NOT NULL,
+        UNIQUE (host, username, name)
+    );
+    CREATE TABLE IF NOT EXISTS counts (
+        aggregate INTEGER NOT NULL,
+        grp TEXT,
+        owner TEXT,
+        period TEXT NOT NULL,
+        count INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS counts_aggregate ON counts (aggregate);
+'''
+
+
+class PeriodCountStore(object):
+    ''' Local store of counts per group, owner and calendar period for
+        periods which have closed and so will not change. Each aggregate is
+        identified by a name and the server and user it was counted as, and
+        records the first period which is not yet closed '''
+
+    def __init__(self, path=DEFAULT_STORE_FILE):
+        self.path = str(path)
+        self.db = None
+
+    def open(self):
+        ''' Open (creating if necessary) the store database '''
+
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=30)
+            self.db.executescript(SCHEMA)
+            self.db.commit()
+
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def _aggregate(self, host, username, name):
+        row = self.open().execute(
+            'SELECT id, closed FROM aggregates '
+            'WHERE host = ? AND username = ? AND name = ?',
+            (host, username, name)
+        ).fetchone()
+        return row if row is not None else (None, None)
+
+    def load(self, host, username, name):
+        ''' Return the first period which is not closed and the stored
+            (group, owner, period, count) rows of the closed periods before
+            it, or None and no rows if nothing is stored '''
+
+        aggregate, closed = self._aggregate(host, username, name)
+        if aggregate is None:
+            return None, []
+
+        rows = self.db.execute(
+            'SELECT grp, owner, period, count FROM counts '
+            'WHERE aggregate = ?', (aggregate,)
+        )
+        return closed, [list(row) for row in rows]
+
+    def save(self, host, username, name, closed, rows):
+        ''' Add the counts of newly closed periods, all of which are before
+            closed, and record closed as the first period not yet closed '''
+
+        db = self.open()
+        aggregate = self._aggregate(host, username, name)[0]
+        if aggregate is None:
+            aggregate = db.execute(
+                'INSERT INTO aggregates (host, username, name, closed) '
+                'VALUES (?, ?, ?, ?)', (host, username, name, closed)
+            ).lastrowid
+        else:
+            db.execute('UPDATE aggregates SET closed = ? WHERE id = ?',
+                       (closed, aggregate))
+
+        db.executemany(
+            'INSERT INTO counts (aggregate, grp, owner, period, count) '
+            'VALUES (?, ?, ?, ?, ?)',
+            ([aggregate] + list(row) for row in rows)
+        )
+        db.commit()
+
+    def clear(self, host, username, name):
+        ''' Remove an aggregate so that it is counted again in full '''
+
+        db = self.open()
+        aggregate = self._aggregate(host, username, name)[0]
+        if aggregate is not None:
+            db.execute('DELETE FROM counts WHERE aggregate = ?', (aggregate,))
+            db.execute('DELETE FROM aggregates WHERE id = ?', (aggregate,))
+            db.commit()
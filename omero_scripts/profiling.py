@@ -0,0 +1,396 @@
+''' Opt-in instrumentation of where the time of a script goes: logging in,
+    running queries on the server, unwrapping their results, reading the
+    query cache and writing output, or fetching, rendering, overlaying and
+    encoding the planes of a movie. Each phase records its calls, seconds,
+    rows, bytes and the peak resident set size.
+
+    Enabled by setting OMERO_SCRIPTS_PROFILE, or passing --profile, to the
+    file the report is written to on exit. Files ending in .json get a JSON
+    trace, those ending in .jsonl have the trace appended as a line so that
+    runs accumulate, and anything else gets Prometheus text format, as read
+    by node_exporter's textfile collector. Disabled, the instrumented code
+    only pays for a function call per phase '''
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Environment variable naming the file to write the report to
+PROFILE_ENV = 'OMERO_SCRIPTS_PROFILE'
+
+# Individual spans kept for the JSON trace, beyond which phases are only
+# aggregated
+MAX_SPANS = 100000
+
+# Prefix of the names of the Prometheus metrics
+METRIC_PREFIX = 'omero_scripts'
+
+# Profile being recorded, if enabled
+current = None
+
+_registered = False
+
+
+def peak_rss():
+    ''' Peak resident set size of this process in bytes, or None if it can
+        not be determined '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes, except on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def payload_size(rows):
+    ''' Approximate size in bytes of the values of unwrapped rows, counting
+        the encoded length of strings and eight bytes for anything else '''
+    size = 0
+    for row in rows:
+        for value in row:
+            if isinstance(value, str):
+                size += len(value.encode('utf-8'))
+            elif value is not None:
+                size += 8
+    return size
+
+
+class Span(object):
+    ''' A timed call of a phase, as a context manager. The rows and bytes it
+        processed may be set while it runs '''
+
+    def __init__(self, profile, name, labels):
+        self.profile = profile
+        self.name = name
+        self.labels = labels
+        self.rows = 0
+        self.bytes = 0
+        self.excluded = 0.0
+
+    def __enter__(self):
+        self.start = time.time()
+        self.clock = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.add(self, time.perf_counter() - self.clock -
+                         self.excluded)
+        return False
+
+    def exclude(self, items):
+        ''' Iterate over the items, excluding the time spent producing them
+            from the span, e.g. fetching rows from the time writing them '''
+
+        clock = time.perf_counter
+        items = iter(items)
+        while True:
+            start = clock()
+            try:
+                item = next(items)
+            except StopIteration:
+                self.excluded += clock() - start
+                return
+            self.excluded += clock() - start
+            yield item
+
+    def iterate(self, items):
+        ''' Iterate over the items, timing only the production of them as
+            the span and counting them as its rows, e.g. rows read lazily
+            from a database '''
+
+        self.start = time.time()
+        clock = time.perf_counter
+        seconds = 0.0
+        items = iter(items)
+        try:
+            while True:
+                start = clock()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    seconds += clock() - start
+                    return
+                seconds += clock() - start
+                self.rows += 1
+                yield item
+        finally:
+            self.profile.add(self, seconds)
+
+
+class NullSpan(object):
+    ''' Stands in for a span when profiling is disabled '''
+
+    rows = 0
+    bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def exclude(self, items):
+        return items
+
+    def iterate(self, items):
+        return items
+
+
+NULL_SPAN = NullSpan()
+
+
+class Profile(object):
+    ''' The phases of a run of a script, written to path when finished. With
+        no path, the profile is only collected to be merged into another '''
+
+    def __init__(self, path=None, script=None):
+        self.path = path
+        self.script = script or os.path.basename(sys.argv[0])
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+        # Calls, seconds, rows and bytes of each phase, by name and labels
+        self.phases = {}
+        self.spans = []
+        self.dropped = 0
+
+        # Peak resident set size of any worker processes merged in
+        self.workers_peak_rss = None
+
+    def span(self, name, **labels):
+        return Span(self, name, labels)
+
+    def add(self, span, seconds):
+        rss = peak_rss()
+        key = (span.name, tuple(sorted(span.labels.items())))
+        with self.lock:
+            phase = self.phases.setdefault(key, [0, 0.0, 0, 0])
+            phase[0] += 1
+            phase[1] += seconds
+            phase[2] += span.rows
+            phase[3] += span.bytes
+
+            if len(self.spans) < MAX_SPANS:
+                self.spans.append({
+                    'phase': span.name,
+                    'labels': span.labels,
+                    'start': span.start,
+                    'seconds': seconds,
+                    'rows': span.rows,
+                    'bytes': span.bytes,
+                    'peak_rss': rss
+                })
+            else:
+                self.dropped += 1
+
+    def count(self, name, rows=0, bytes=0, **labels):
+        ''' Add rows or bytes to a phase without timing a call of it '''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            phase = self.phases.setdefault(key, [0, 0.0, 0, 0])
+            phase[2] += rows
+            phase[3] += bytes
+
+    def collect(self):
+        ''' Take what has been recorded so far, to be merged into the
+            profile of another process '''
+        with self.lock:
+            collected = {
+                'phases': [[name, list(labels), totals]
+                           for (name, labels), totals
+                           in self.phases.items()],
+                'spans': self.spans,
+                'dropped': self.dropped,
+                'peak_rss': peak_rss()
+            }
+            self.phases = {}
+            self.spans = []
+            self.dropped = 0
+        return collected
+
+    def merge(self, collected):
+        ''' Add what was collected from another process' profile '''
+        with self.lock:
+            for name, labels, totals in collected['phases']:
+                key = (name, tuple(tuple(label) for label in labels))
+                phase = self.phases.setdefault(key, [0, 0.0, 0, 0])
+                for i, value in enumerate(totals):
+                    phase[i] += value
+
+            room = MAX_SPANS - len(self.spans)
+            self.spans.extend(collected['spans'][:room])
+            self.dropped += (collected['dropped'] +
+                             max(0, len(collected['spans']) - room))
+
+            if collected['peak_rss'] is not None:
+                self.workers_peak_rss = max(self.workers_peak_rss or 0,
+                                            collected['peak_rss'])
+
+    def report(self):
+        ''' The profile as a JSON serializable trace '''
+        with self.lock:
+            return {
+                'script': self.script,
+                'argv': sys.argv[1:],
+                'start': self.start,
+                'seconds': time.time() - self.start,
+                'peak_rss': peak_rss(),
+                'workers_peak_rss': self.workers_peak_rss,
+                'phases': [{
+                    'phase': name,
+                    'labels': dict(labels),
+                    'calls': calls,
+                    'seconds': seconds,
+                    'rows': rows,
+                    'bytes': bytes
+                } for (name, labels), (calls, seconds, rows, bytes)
+                    in sorted(self.phases.items())],
+                'spans': list(self.spans),
+                'spans_dropped': self.dropped
+            }
+
+    def prometheus(self):
+        ''' The profile in Prometheus text format '''
+
+        report = self.report()
+        script = [('script', self.script)]
+        lines = []
+
+        def metric(name, kind, description, samples):
+            name = '{}_{}'.format(METRIC_PREFIX, name)
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                if value is not None:
+                    lines.append('{}{{{}}} {}'.format(name, ','.join(
+                        '{}="{}"'.format(k, escape_label(v))
+                        for k, v in labels
+                    ), value))
+
+        for field, description in [
+            ('calls', 'Number of calls of each phase'),
+            ('seconds', 'Seconds spent in each phase'),
+            ('rows', 'Rows processed by each phase'),
+            ('bytes', 'Bytes processed by each phase')
+        ]:
+            metric('phase_{}_total'.format(field), 'counter', description, [
+                (script + [('phase', phase['phase'])] +
+                 sorted(phase['labels'].items()), phase[field])
+                for phase in report['phases']
+            ])
+
+        metric('run_start_timestamp_seconds', 'gauge',
+               'When the run started', [(script, report['start'])])
+        metric('run_seconds', 'gauge', 'Seconds the run took',
+               [(script, report['seconds'])])
+        metric('peak_rss_bytes', 'gauge',
+               'Peak resident set size of the process',
+               [(script, report['peak_rss'])])
+        metric('workers_peak_rss_bytes', 'gauge',
+               'Largest peak resident set size of a worker process',
+               [(script, report['workers_peak_rss'])])
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        ''' Write the report to the profile's path '''
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        if self.path.endswith('.jsonl'):
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(self.report()) + '\n')
+            return
+
+        if self.path.endswith('.json'):
+            content = json.dumps(self.report(), indent=2) + '\n'
+        else:
+            content = self.prometheus()
+
+        # Replaced atomically, as collectors may read it at any time
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(content)
+        os.replace(tmp, self.path)
+
+
+def escape_label(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def enable(path, script=None):
+    ''' Start profiling, writing the report to path when finished, or on
+        exit. With no path, the profile is only collected '''
+
+    global current, _registered
+
+    if path is not None:
+        path = os.path.abspath(path)
+
+    if current is not None and current.path == path:
+        return current
+
+    finish()
+    current = Profile(path, script)
+
+    if not _registered:
+        atexit.register(finish)
+        _registered = True
+
+    return current
+
+
+def enable_from_environment():
+    ''' Start profiling if OMERO_SCRIPTS_PROFILE is set and it has not
+        already been started '''
+    path = os.environ.get(PROFILE_ENV)
+    if path and current is None:
+        enable(path)
+    return current
+
+
+def finish():
+    ''' Stop profiling and write the report '''
+    global current
+    profile, current = current, None
+    if profile is not None and profile.path is not None:
+        profile.write()
+
+
+def span(name, **labels):
+    ''' A span timing a call of a phase, if profiling '''
+    profile = current
+    if profile is None:
+        return NULL_SPAN
+    return profile.span(name, **labels)
+
+
+def count(name, rows=0, bytes=0, **labels):
+    ''' Add rows or bytes to a phase, if profiling '''
+    profile = current
+    if profile is not None:
+        profile.count(name, rows, bytes, **labels)
+
+
+def collect():
+    ''' Take what has been recorded so far, if profiling '''
+    profile = current
+    return None if profile is None else profile.collect()
+
+
+def merge(collected):
+    ''' Add what was collected from another process, if profiling '''
+    profile = current
+    if profile is not None and collected is not None:
+        profile.merge(collected)
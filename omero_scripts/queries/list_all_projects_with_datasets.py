@@ -1,8 +1,94 @@
 #!/usr/bin/env python
 
+import os
 import sys
+import json
 from argparse import ArgumentParser
-from ..omero_basics import OMEROConnectionManager, write_csv
+from ..omero_basics import (OMEROConnectionManager, add_connection_arguments,
+                            add_cache_arguments, add_format_arguments,
+                            cache_from_args, write_rows, report_written,
+                            add_local_arguments, local_query,
+                            resolve_format, DEFAULT_PAGE_SIZE,
+                            APPEND_FORMATS, ResultSet)
+
+
+class ExportState(object):
+    ''' Position of an export in (project ID, dataset ID) order, saved to a
+        state file as rows are written so that an interrupted export can be
+        resumed after the last row written. A state is only valid for the
+        query it was saved for '''
+
+    def __init__(self, path, query):
+        self.path = path
+        self.query = query
+        self.key = None
+        self.rows = 0
+
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state['query'] != query:
+                raise ValueError('State file {} was saved for a different '
+                                 'query'.format(path))
+            self.key = state['key']
+            self.rows = state['rows']
+
+    @property
+    def resumed(self):
+        return self.key is not None
+
+    def save(self, key, rows):
+        ''' Atomically replace the state file '''
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'query': self.query, 'key': key, 'rows': rows}, f)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def iter_keyset(conn_manager, query, conditions, params, key_columns,
+                key=None, page_size=DEFAULT_PAGE_SIZE):
+    ''' Run the query a page at a time, yielding the rows. Each page starts
+        after the (project ID, dataset ID) key of the last row of the page
+        before, which the server finds with the index instead of counting
+        past an offset. The conditions are formatted into the query as
+        {where}, along with that of the key '''
+
+    from omero.sys import ParametersI
+    from omero.rtypes import rlong
+
+    pid, did = key_columns
+
+    while True:
+        page_params = ParametersI()
+        page_params.map = dict(params.map)
+        page_params.page(0, page_size)
+
+        where = list(conditions)
+        if key is not None:
+            page_params.map['pid'] = rlong(key[0])
+            if key[1] is None:
+                # A project without datasets only has the one row
+                where.append('project.id > :pid')
+            else:
+                page_params.map['did'] = rlong(key[1])
+                where.append('(project.id > :pid or '
+                             '(project.id = :pid and dataset.id > :did))')
+
+        rows = conn_manager.hql_query(query.format(
+            where='where ' + ' and '.join(where) if where else ''
+        ), page_params)
+
+        for row in rows:
+            yield row
+
+        if len(rows) < page_size:
+            break
+
+        key = [rows[-1][pid], rows[-1][did]]
 
 
 def main(argv=sys.argv):
@@ -16,52 +102,181 @@ def main(argv=sys.argv):
     parser.add_argument('-n', '--nonames', action='store_const', const=True,
                         default=False, help='Do not print names')
     parser.add_argument('-f', '--file', metavar='file',
-                        help='Destination CSV file')
-    args = parser.parse_args()
+                        help='''Destination file. Compressed if it ends
+                                in .gz or .zst''')
+    add_format_arguments(parser)
+    parser.add_argument('-g', '--group', type=int, metavar='group',
+                        help='Only list projects in the group with this ID')
+    parser.add_argument('-o', '--owner', metavar='username',
+                        help='Only list projects owned by this user')
+    parser.add_argument('-m', '--modified-since', metavar='timestamp',
+                        help='''Only list projects or datasets modified since
+                                this timestamp''')
+    parser.add_argument('-s', '--state', metavar='file',
+                        help='''State file recording the progress of the
+                                export. If it exists the export is resumed,
+                                appending to the destination file. It is
+                                removed once the export is complete''')
+    add_local_arguments(parser)
+    add_connection_arguments(parser)
+    add_cache_arguments(parser)
+    args = parser.parse_args(argv[1:])
+
+    # A resumed export is appended to the destination file, which not every
+    # format allows
+    if (args.state is not None and args.file is not None
+            and resolve_format(args.file, args.format) not in APPEND_FORMATS):
+        parser.error('--state requires a destination file format which can '
+                     'be appended to: {}'.format(', '.join(APPEND_FORMATS)))
+
+    # OMERO is only imported once the arguments are parsed, so that --help
+    # and argument errors are quick
+    from omero.sys import ParametersI
+    from omero.rtypes import rstring, rtime
+    import dateutil.parser
 
-    # Create an OMERO Connection with our basic connection manager
-    conn_manager = OMEROConnectionManager()
+    # Create an OMERO Connection with our basic connection manager, answering
+    # repeated queries from the local cache if asked to
+    conn_manager = OMEROConnectionManager(cache=cache_from_args(args),
+                                          detach=args.keep_session)
 
-    q = 'select'
-    header = []
+    # The name of each column and its expression in the same query of the
+    # server in HQL and of the local index in SQL
+    columns = []
 
     if not args.nonames:
-        q += ' project.name, '
-        header.append('Project Name')
+        columns.append(('Project Name', 'project.name', 'project.name'))
 
-    q += """
-               project.id,
-               project.details.owner.omeName,
-         """
-    header.extend(['Project ID', 'Project Owner'])
+    columns.extend([
+        ('Project ID', 'project.id', 'project.id'),
+        ('Project Owner', 'project.details.owner.omeName', 'project.owner')
+    ])
 
     if not args.nonames:
-        q += ' dataset.name, '
-        header.append('Dataset Name')
+        columns.append(('Dataset Name', 'dataset.name', 'dataset.name'))
 
-    q += """
-               dataset.id,
-               dsowner.omeName
+    columns.extend([
+        ('Dataset ID', 'dataset.id', 'dataset.id'),
+        ('Dataset Owner', 'dsowner.omeName', 'dataset.owner')
+    ])
+
+    names, hql_columns, sql_columns = zip(*columns)
+
+    q = 'select ' + ', '.join(hql_columns) + """
         from Project project
         left outer join project.datasetLinks pdlink
         left outer join pdlink.child dataset
         left outer join dataset.details.owner dsowner
+         """
+    sql = 'select ' + ', '.join(sql_columns) + """
+        from project
+        left outer join project_dataset pdlink on pdlink.parent = project.id
+        left outer join dataset on dataset.id = pdlink.child
+         """
+
+    # Filter the projects, so that routine refreshes only fetch what has
+    # changed
+    params = ParametersI()
+    params.map = {}
+    conditions = []
+    sql_params = {}
+    sql_conditions = []
+
+    if args.group is not None:
+        conn_manager.group = args.group
+        sql_conditions.append('project.grp = :group')
+        sql_params['group'] = args.group
+
+    if args.owner is not None:
+        conditions.append('project.details.owner.omeName = :owner')
+        params.map['owner'] = rstring(args.owner)
+        sql_conditions.append('project.owner = :owner')
+        sql_params['owner'] = args.owner
+
+    if args.modified_since is not None:
+        try:
+            since = dateutil.parser.parse(args.modified_since)
+        except ValueError:
+            sys.stderr.write('Modification timestamp has to be parseable!')
+            sys.exit(1)
+
+        q += """
+        join project.details.updateEvent pevent
+        left outer join dataset.details.updateEvent dsevent
+             """
+        conditions.append('(pevent.time >= :since or dsevent.time >= :since)')
+        params.map['since'] = rtime(int(since.timestamp() * 1000))
+        sql_conditions.append('(project.updated >= :since or '
+                              'dataset.updated >= :since)')
+        sql_params['since'] = int(since.timestamp() * 1000)
+
+    q += """
+        {where}
+        order by project.id,
+                 dataset.id
         """
 
-    # Run the query
-    rows = conn_manager.hql_query(q)
+    key_columns = (names.index('Project ID'), names.index('Dataset ID'))
 
-    header.extend(['Dataset ID', 'Dataset Owner'])
+    if args.local:
 
-    # Print results (if not quieted)
-    if args.quiet is False:
-        print(', '.join(header))
-        for row in rows:
-            print(', '.join([str(item) for item in row]))
+        # Answer from the local index of the hierarchy, which is quick
+        # enough that there is no need to resume
+        if sql_conditions:
+            sql += ' where ' + ' and '.join(sql_conditions)
+        sql += ' order by project.id, dataset.id'
+        result = ResultSet.stream(names, local_query(conn_manager, sql,
+                                                     sql_params))
+
+        count = write_rows(result, filename=args.file, quiet=args.quiet,
+                           output_format=args.format)
+        report_written(count, args.file)
+        return
+
+    if args.state is None:
+
+        # Run the query, streaming the results a page at a time
+        result = ResultSet.stream(names, iter_keyset(
+            conn_manager, q, conditions, params, key_columns
+        ))
+
+        # Print results (if not quieted) and output file (if specified) in a
+        # single pass as they stream past
+        count = write_rows(result, filename=args.file, quiet=args.quiet,
+                           output_format=args.format)
+        report_written(count, args.file)
+        return
+
+    # Resume after the last row written if there is a saved state
+    try:
+        state = ExportState(args.state, {
+            'query': ' '.join(q.split()),
+            'conditions': conditions,
+            'params': {k: str(v.getValue()) for k, v in params.map.items()},
+            'group': conn_manager.group
+        })
+    except ValueError as e:
+        sys.stderr.write('{}\n'.format(e))
+        sys.exit(1)
+
+    if state.resumed:
+        sys.stderr.write('Resuming after {} rows\n'.format(state.rows))
+
+    result = ResultSet.stream(names, iter_keyset(
+        conn_manager, q, conditions, params, key_columns, key=state.key
+    ))
+
+    # Save the key of the last row written as it is flushed to the file
+    def checkpoint(count, row):
+        state.save([row[key_columns[0]], row[key_columns[1]]],
+                   state.rows + count)
+
+    count = write_rows(result, filename=args.file, quiet=args.quiet,
+                       output_format=args.format, append=state.resumed,
+                       checkpoint=checkpoint)
+    report_written(count, args.file)
 
-    # Output CSV file (if specified)
-    if args.file is not None:
-        write_csv(rows, args.file, header)
+    state.remove()
 
 
 if __name__ == '__main__':
@@ -2,11 +2,12 @@
 
 import sys
 from argparse import ArgumentParser
-from ..omero_basics import OMEROConnectionManager, write_csv
-from omero.sys import ParametersI
-from omero.rtypes import rtime
+from ..omero_basics import (OMEROConnectionManager, add_connection_arguments,
+                            add_cache_arguments, add_format_arguments,
+                            cache_from_args, write_rows, report_written,
+                            ResultSet)
+from ..period_store import PeriodCountStore
 import datetime
-import dateutil.parser
 
 epoch = datetime.datetime.utcfromtimestamp(0)
 periods = {
@@ -15,11 +16,133 @@ periods = {
     'day': 'YYYY-MM-DD'
 }
 
+# The same periods as formatted by strftime
+period_formats = {
+    'year': '%Y',
+    'month': '%Y-%m',
+    'day': '%Y-%m-%d'
+}
+
+# The name of each column of the complete report, of images imported in
+# each period, and the expression selecting it
+ALL_IMPORTS_COLUMNS = [
+    ('Group', 'grp.name'),
+    ('Username', 'experimenter.omeName'),
+    ('Period', "TO_CHAR(event.time, '{period}') AS cal_period"),
+    ('Count', 'count(event.time)')
+]
+
+# The same of the report of images imported between a start and end
+IMPORTS_COLUMNS = [
+    ('Group', 'grp.name'),
+    ('Username', 'experimenter.omeName'),
+    ('Count', 'count(event.time)')
+]
+
+# Periods are only treated as closed once they ended this long ago, so that
+# any difference between the server's time zone and UTC does not matter
+CLOSED_MARGIN = datetime.timedelta(days=2)
+
 
 def unix_time_millis(dt):
     return (dt - epoch).total_seconds() * 1000.0
 
 
+def all_imports_query(period, since=False):
+    ''' Return the query counting images imported by each user of each group
+        in each period, optionally only since the time bound to :dstart '''
+
+    q = 'SELECT ' + ', '.join(hql for _, hql in ALL_IMPORTS_COLUMNS) + '''
+        FROM Image image
+        JOIN image.details.creationEvent event
+        JOIN image.details.owner experimenter
+        JOIN image.details.group grp
+        '''
+
+    if since:
+        q += ' WHERE event.time >= :dstart '
+
+    q += '''
+        GROUP BY grp.name,
+                 experimenter.omeName,
+                 TO_CHAR(event.time, '{period}')
+        ORDER BY grp.name,
+                 experimenter.omeName,
+                 TO_CHAR(event.time, '{period}')
+        DESC
+        '''
+
+    return q.format(period=periods[period])
+
+
+def incremental_import_counts(conn_manager, period, rebuild=False,
+                              store=None):
+    ''' Return the same rows as the all_imports_query, only counting the
+        periods which were not closed when last run. The counts of closed
+        periods are kept in a local store and are not counted again unless
+        rebuilding, so images deleted from a closed period are only
+        discounted by a rebuild. The stored and newly counted rows are merged
+        in the order of sort_import_counts '''
+
+    from omero.sys import ParametersI
+    from omero.rtypes import rtime
+
+    if store is None:
+        store = PeriodCountStore()
+
+    conn_params = conn_manager.get_params()
+    identity = (conn_params['host'], conn_params['username'],
+                'imports-' + period)
+
+    if rebuild:
+        store.clear(*identity)
+    closed, rows = store.load(*identity)
+
+    params = ParametersI()
+    params.map = {}
+
+    if closed is not None:
+        # Start a day early in case the server's periods are offset from
+        # UTC. The partial counts of the stored period before are discarded
+        start = datetime.datetime.strptime(closed, period_formats[period])
+        start -= datetime.timedelta(days=1)
+        params.map['dstart'] = rtime(unix_time_millis(start))
+
+    q = all_imports_query(period, since=closed is not None)
+
+    # The first period which has not closed
+    now_closed = (datetime.datetime.utcnow() - CLOSED_MARGIN).strftime(
+        period_formats[period]
+    )
+
+    newly_closed = []
+    for row in conn_manager.iter_hql_query(q, params):
+        if closed is not None and row[2] < closed:
+            continue
+        if row[2] < now_closed:
+            newly_closed.append(list(row))
+        rows.append(row)
+
+    if closed is None or now_closed > closed:
+        store.save(*identity, closed=now_closed, rows=newly_closed)
+    store.close()
+
+    return sort_import_counts(rows)
+
+
+def sort_import_counts(rows):
+    ''' Order the rows of the complete report on the same keys as the
+        all_imports_query: by group and user, latest period first. Names are
+        compared by code point rather than by the collation of the server's
+        database, which may for example ignore case, so that a full count
+        and an incremental one are listed in the same order '''
+
+    rows = list(rows)
+    rows.sort(key=lambda row: row[2], reverse=True)
+    rows.sort(key=lambda row: (row[0], row[1]))
+    return rows
+
+
 def main(argv=sys.argv):
 
     # Configure argument parsing
@@ -28,47 +151,65 @@ def main(argv=sys.argv):
     parser.add_argument('-q', '--quiet', action='store_const', const=True,
                         default=False, help='Do not print output')
     parser.add_argument('-f', '--file', metavar='file',
-                        help='Destination CSV file')
+                        help='''Destination file. Compressed if it ends
+                                in .gz or .zst''')
+    add_format_arguments(parser)
     parser.add_argument('-s', '--start', metavar='start',
                         help='Start timestamp')
     parser.add_argument('-e', '--end', metavar='end',
                         help='End timestamp')
     parser.add_argument('-a', '--all', action='store_const', const=True,
                         default=False,
-                        help='Complete report. Ignores start/end')
+                        help='''Complete report, with groups and users
+                                ordered by their names' code points. Ignores
+                                start/end''')
     parser.add_argument('-p', '--period', choices=['year', 'month', 'day'],
                         default='month',
                         help='Period for use in conjunction with -a')
-    args = parser.parse_args()
+    parser.add_argument('-i', '--incremental', action='store_const',
+                        const=True, default=False,
+                        help='''Use with -a. Only count periods which had not
+                                closed when last run, storing closed periods
+                                locally''')
+    parser.add_argument('--rebuild', action='store_const', const=True,
+                        default=False,
+                        help='''Use with -a. Count all periods again,
+                                replacing those stored locally by -i''')
+    add_connection_arguments(parser)
+    add_cache_arguments(parser)
+    args = parser.parse_args(argv[1:])
 
-    # Create an OMERO Connection with our basic connection manager
-    conn_manager = OMEROConnectionManager()
+    if (args.incremental or args.rebuild) and not args.all:
+        parser.error('-i/--incremental and --rebuild require -a/--all')
+
+    # OMERO is only imported once the arguments are parsed, so that --help
+    # and argument errors are quick
+    from omero.sys import ParametersI
+    from omero.rtypes import rtime
+    import dateutil.parser
+
+    # Create an OMERO Connection with our basic connection manager, answering
+    # repeated queries from the local cache if asked to
+    conn_manager = OMEROConnectionManager(cache=cache_from_args(args),
+                                          detach=args.keep_session)
 
     if args.all:
 
-        q = '''
-            SELECT grp.name,
-                   experimenter.omeName,
-                   TO_CHAR(event.time, '{period}') AS cal_period,
-                   count(event.time)
-            FROM Image image
-            JOIN image.details.creationEvent event
-            JOIN image.details.owner experimenter
-            JOIN image.details.group grp
-            GROUP BY grp.name,
-                     experimenter.omeName,
-                     TO_CHAR(event.time, '{period}')
-            ORDER BY grp.name,
-                     experimenter.omeName,
-                     TO_CHAR(event.time, '{period}')
-            DESC
-            '''
+        if args.incremental or args.rebuild:
+
+            # Only count the periods which were not closed when last run
+            rows = incremental_import_counts(conn_manager, args.period,
+                                             rebuild=args.rebuild)
 
-        q = q.format(period=periods[args.period])
+        else:
 
-        # Run the query
-        rows = conn_manager.hql_query(q)
-        header = ['Group', 'Username', 'Period', 'Count']
+            # Run the query, ordering its rows as an incremental count does.
+            # There are only as many as groups, users and periods
+            rows = sort_import_counts(conn_manager.iter_hql_query(
+                all_imports_query(args.period)
+            ))
+
+        columns = ALL_IMPORTS_COLUMNS
 
     else:
 
@@ -87,10 +228,7 @@ def main(argv=sys.argv):
             sys.stderr.write('Start and/or end dates have to be parseable!')
             sys.exit(1)
 
-        q = '''
-            SELECT grp.name,
-                   experimenter.omeName,
-                   count(event.time)
+        q = 'SELECT ' + ', '.join(hql for _, hql in IMPORTS_COLUMNS) + '''
             FROM Image image
             JOIN image.details.creationEvent event
             JOIN image.details.owner experimenter
@@ -114,23 +252,21 @@ def main(argv=sys.argv):
         q += '''
             GROUP BY grp.name,
                      experimenter.omeName
+            ORDER BY grp.name,
+                     experimenter.omeName
             '''
 
-        # Run the query
-        rows = conn_manager.hql_query(q, params)
-        header = ['Group', 'Username', 'Count']
-
-    # Print results (if not quieted)
-    if args.quiet is False:
-        print(', '.join(header))
-        for row in rows:
-            print(', '.join([str(item) for item in row]))
-
-    # Output CSV file (if specified)
-    if args.file is not None:
-        write_csv(rows,
-                  args.file,
-                  header)
+        # Run the query, streaming the results a page at a time
+        rows = conn_manager.iter_hql_query(q, params)
+        columns = IMPORTS_COLUMNS
+
+    result = ResultSet.stream([name for name, _ in columns], rows)
+
+    # Print results (if not quieted) and output file (if specified) in a
+    # single pass as they stream past
+    count = write_rows(result, filename=args.file, quiet=args.quiet,
+                       output_format=args.format)
+    report_written(count, args.file)
 
 
 if __name__ == '__main__':
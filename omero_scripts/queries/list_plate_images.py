@@ -2,78 +2,109 @@
 
 import sys
 from argparse import ArgumentParser
-from ..omero_basics import OMEROConnectionManager, write_csv, well_from_row_col
+from ..omero_basics import (OMEROConnectionManager, add_connection_arguments,
+                            add_cache_arguments, add_format_arguments,
+                            cache_from_args, write_rows, report_written,
+                            replace_row_col_with_well, iter_hql_query_ids,
+                            ids_from_args, add_local_arguments, local_query,
+                            ResultSet)
 
 
 def main(argv=sys.argv):
 
     # Configure argument parsing
-    parser = ArgumentParser(description='List all images in a plate')
-    parser.add_argument('plate', type=int)
+    parser = ArgumentParser(description='''List all images in one or more
+                                           plates''')
+    parser.add_argument('plate', type=int, nargs='*',
+                        help='''Plate IDs. Read from stdin if none are
+                                given''')
     parser.add_argument('-q', '--quiet', action='store_const', const=True,
                         default=False, help="Do not print output")
     parser.add_argument('-n', '--nonames', action='store_const', const=True,
                         default=False, help='Do not print names')
     parser.add_argument('-f', '--file', metavar='file',
-                        help='Destination CSV file')
-    args = parser.parse_args()
+                        help='''Destination file. Compressed if it ends
+                                in .gz or .zst''')
+    add_format_arguments(parser)
+    add_local_arguments(parser)
+    add_connection_arguments(parser, pool=True)
+    add_cache_arguments(parser)
+    args = parser.parse_args(argv[1:])
 
-    # Create an OMERO Connection with our basic connection manager
-    conn_manager = OMEROConnectionManager()
+    plates = ids_from_args(args.plate)
+
+    # Create an OMERO Connection with our basic connection manager, answering
+    # repeated queries from the local cache if asked to
+    conn_manager = OMEROConnectionManager(cache=cache_from_args(args),
+                                          detach=args.keep_session)
 
     # Define a query to get the list of image ID in a screen complete with
     # screen name, plate ID and well row/column. Only queries the first field.
-    q = 'select'
-    header = []
-    first_well = 2
+    # The name of each column and its expression in the same query of the
+    # server in HQL and of the local index in SQL
+    columns = []
 
     if not args.nonames:
-        q += ' plate.name, '
-        header.append('Plate Name')
-        first_well += 1
-
-    q += """
-               plate.id,
-               index(ws),
-               well.row,
-               well.column,
-               ws.image.id
+        columns.append(('Plate Name', 'plate.name', 'plate.name'))
+
+    columns.extend([
+        ('Plate ID', 'plate.id', 'plate.id'),
+        ('Field', 'index(ws)', 'ws.idx'),
+        ('Row', 'well.row', 'well.row'),
+        ('Column', 'well.column', 'well.col'),
+        ('Image ID', 'ws.image.id', 'ws.image')
+    ])
+
+    names, hql_columns, sql_columns = zip(*columns)
+
+    q = 'select ' + ', '.join(hql_columns) + """
         from Well well
         join well.plate plate
         join well.wellSamples ws
-        where plate.id=%i
+        where plate.id in (:ids)
         order by plate.id,
                  index(ws),
                  well.row,
                  well.column,
                  ws.image.id
-        """ % args.plate
+        """
 
-    # Run the query
-    rows = conn_manager.hql_query(q)
+    sql = 'select ' + ', '.join(sql_columns) + """
+        from well
+        join plate on plate.id = well.plate
+        join well_sample ws on ws.well = well.id
+        where plate.id in (select id from ids)
+        order by plate.id,
+                 ws.idx,
+                 well.row,
+                 well.col,
+                 ws.image
+        """
 
-    # Replace Row+Column IDs with a more meaningful Well designation
-    # E.g. Row 3, Column 2: D3
-    for row in rows:
+    if args.local:
+
+        # Answer from the local index of the hierarchy
+        rows = local_query(conn_manager, sql, ids=plates)
 
-        # Calculate the Well and assign it to the position that row was in
-        row[first_well] = well_from_row_col(row[first_well],
-                                            row[first_well + 1])
+    else:
 
-        # Remove the column field altogether
-        row.pop(first_well + 1)
+        # Run the query over all the plates, binding their IDs a chunk at a
+        # time. Chunks are run concurrently over a pool of connections if
+        # there are several
+        rows = iter_hql_query_ids(conn_manager, q, plates,
+                                  connections=args.connections)
 
-    header.extend(['Plate ID', 'Field', 'Well', 'Image ID'])
+    result = ResultSet.stream(names, rows)
 
-    # Print results (if not quieted)
-    if args.quiet is False:
-        print(', '.join(header))
-        for row in rows:
-            print(', '.join([str(item) for item in row]))
+    # Replace Row+Column IDs with a more meaningful Well designation
+    # E.g. Row 3, Column 2: D3
+    result = replace_row_col_with_well(result)
 
-    # Output CSV file (if specified)
-    if args.file is not None:
-        write_csv(rows, args.file, header)
+    # Print results (if not quieted) and output file (if specified) in a
+    # single pass as they stream past
+    count = write_rows(result, filename=args.file, quiet=args.quiet,
+                       output_format=args.format)
+    report_written(count, args.file)
 
 
 if __name__ == '__main__':
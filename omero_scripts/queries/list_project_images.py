@@ -2,65 +2,106 @@
 
 import sys
 from argparse import ArgumentParser
-from ..omero_basics import OMEROConnectionManager, write_csv
+from ..omero_basics import (OMEROConnectionManager, add_connection_arguments,
+                            add_cache_arguments, add_format_arguments,
+                            cache_from_args, write_rows, report_written,
+                            iter_hql_query_ids, ids_from_args,
+                            add_local_arguments, local_query, ResultSet)
 
 
 def main(argv=sys.argv):
 
     # Configure argument parsing
-    parser = ArgumentParser(description='List all images in a project')
-    parser.add_argument('project', type=int)
+    parser = ArgumentParser(description='''List all images in one or more
+                                           projects''')
+    parser.add_argument('project', type=int, nargs='*',
+                        help='''Project IDs. Read from stdin if none are
+                                given''')
     parser.add_argument('-q', '--quiet', action='store_const', const=True,
                         default=False, help='Do not print output')
     parser.add_argument('-n', '--nonames', action='store_const', const=True,
                         default=False, help='Do not print names')
     parser.add_argument('-f', '--file', metavar='file',
-                        help='Destination CSV file')
-    args = parser.parse_args()
+                        help='''Destination file. Compressed if it ends
+                                in .gz or .zst''')
+    add_format_arguments(parser)
+    add_local_arguments(parser)
+    add_connection_arguments(parser, pool=True)
+    add_cache_arguments(parser)
+    args = parser.parse_args(argv[1:])
 
-    # Create an OMERO Connection with our basic connection manager
-    conn_manager = OMEROConnectionManager()
+    projects = ids_from_args(args.project)
 
-    q = 'select'
-    header = []
+    # Create an OMERO Connection with our basic connection manager, answering
+    # repeated queries from the local cache if asked to
+    conn_manager = OMEROConnectionManager(cache=cache_from_args(args),
+                                          detach=args.keep_session)
+
+    # The name of each column and its expression in the same query of the
+    # server in HQL and of the local index in SQL
+    columns = []
+
+    # Identify the project of each row if there are several
+    if len(set(projects)) > 1:
+        columns.append(('Project ID', 'project.id', 'project.id'))
 
     if not args.nonames:
-        q += ' project.name, '
-        q += ' dataset.name, '
-        header.append('Project Name')
-        header.append('Dataset Name')
+        columns.append(('Project Name', 'project.name', 'project.name'))
+        columns.append(('Dataset Name', 'dataset.name', 'dataset.name'))
 
-    q += ' dataset.id, '
-    header.append('Dataset ID')
+    columns.append(('Dataset ID', 'dataset.id', 'dataset.id'))
 
     if not args.nonames:
-        q += ' image.name, '
-        header.append('Image Name')
+        columns.append(('Image Name', 'image.name', 'image.name'))
+
+    columns.append(('Image ID', 'image.id', 'image.id'))
+
+    names, hql_columns, sql_columns = zip(*columns)
 
-    q += """
-               image.id
+    q = 'select ' + ', '.join(hql_columns) + """
         from Project project
         join project.datasetLinks dlink
         join dlink.child dataset
         join dataset.imageLinks iLink
         join iLink.child image
-        where project.id=%i
-        """ % args.project
-
-    # Run the query
-    rows = conn_manager.hql_query(q)
-
-    header.append('Image ID')
-
-    # Print results (if not quieted)
-    if args.quiet is False:
-        print(', '.join(header))
-        for row in rows:
-            print(', '.join([str(item) for item in row]))
-
-    # Output CSV file (if specified)
-    if args.file is not None:
-        write_csv(rows, args.file, header)
+        where project.id in (:ids)
+        order by project.id,
+                 dataset.id,
+                 image.id
+        """
+
+    sql = 'select ' + ', '.join(sql_columns) + """
+        from project
+        join project_dataset dlink on dlink.parent = project.id
+        join dataset on dataset.id = dlink.child
+        join dataset_image ilink on ilink.parent = dataset.id
+        join image on image.id = ilink.child
+        where project.id in (select id from ids)
+        order by project.id,
+                 dataset.id,
+                 image.id
+        """
+
+    if args.local:
+
+        # Answer from the local index of the hierarchy
+        rows = local_query(conn_manager, sql, ids=projects)
+
+    else:
+
+        # Run the query over all the projects, binding their IDs a chunk at a
+        # time. Chunks are run concurrently over a pool of connections if
+        # there are several
+        rows = iter_hql_query_ids(conn_manager, q, projects,
+                                  connections=args.connections)
+
+    result = ResultSet.stream(names, rows)
+
+    # Print results (if not quieted) and output file (if specified) in a
+    # single pass as they stream past
+    count = write_rows(result, filename=args.file, quiet=args.quiet,
+                       output_format=args.format)
+    report_written(count, args.file)
 
 
 if __name__ == '__main__':
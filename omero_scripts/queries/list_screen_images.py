@@ -2,82 +2,120 @@
 
 import sys
 from argparse import ArgumentParser
-from ..omero_basics import OMEROConnectionManager, write_csv, well_from_row_col
+from ..omero_basics import (OMEROConnectionManager, add_connection_arguments,
+                            add_cache_arguments, add_format_arguments,
+                            cache_from_args, write_rows, report_written,
+                            replace_row_col_with_well, iter_hql_query_ids,
+                            ids_from_args, add_local_arguments, local_query,
+                            ResultSet)
 
 
 def main(argv=sys.argv):
 
     # Configure argument parsing
-    parser = ArgumentParser(description='List all images in a screen')
-    parser.add_argument('screen', type=int)
+    parser = ArgumentParser(description='''List all images in one or more
+                                           screens''')
+    parser.add_argument('screen', type=int, nargs='*',
+                        help='''Screen IDs. Read from stdin if none are
+                                given''')
     parser.add_argument('-q', '--quiet', action='store_const', const=True,
                         default=False, help="Do not print output")
     parser.add_argument('-n', '--nonames', action='store_const', const=True,
                         default=False, help='Do not print names')
     parser.add_argument('-f', '--file', metavar='file',
-                        help='Destination CSV file')
-    args = parser.parse_args()
+                        help='''Destination file. Compressed if it ends
+                                in .gz or .zst''')
+    add_format_arguments(parser)
+    add_local_arguments(parser)
+    add_connection_arguments(parser, pool=True)
+    add_cache_arguments(parser)
+    args = parser.parse_args(argv[1:])
 
-    # Create an OMERO Connection with our basic connection manager
-    conn_manager = OMEROConnectionManager()
+    screens = ids_from_args(args.screen)
+
+    # Create an OMERO Connection with our basic connection manager, answering
+    # repeated queries from the local cache if asked to
+    conn_manager = OMEROConnectionManager(cache=cache_from_args(args),
+                                          detach=args.keep_session)
 
     # Define a query to get the list of image ID in a screen complete with
     # screen name, plate ID and well row/column. Only queries the first field.
-    q = 'select'
-    header = []
-    first_well = 2
+    # The name of each column and its expression in the same query of the
+    # server in HQL and of the local index in SQL
+    columns = []
+
+    # Identify the screen of each row if there are several
+    if len(set(screens)) > 1:
+        columns.append(('Screen ID', 'screen.id', 'screen.id'))
 
     if not args.nonames:
-        q += ' screen.name, '
-        q += ' plate.name, '
-        header.append('Screen Name')
-        header.append('Plate Name')
-        first_well += 2
-
-    q += """
-               plate.id,
-               index(ws),
-               well.row,
-               well.column,
-               ws.image.id
+        columns.append(('Screen Name', 'screen.name', 'screen.name'))
+        columns.append(('Plate Name', 'plate.name', 'plate.name'))
+
+    columns.extend([
+        ('Plate ID', 'plate.id', 'plate.id'),
+        ('Field', 'index(ws)', 'ws.idx'),
+        ('Row', 'well.row', 'well.row'),
+        ('Column', 'well.column', 'well.col'),
+        ('Image ID', 'ws.image.id', 'ws.image')
+    ])
+
+    names, hql_columns, sql_columns = zip(*columns)
+
+    q = 'select ' + ', '.join(hql_columns) + """
         from Well well
         join well.plate plate
         join plate.screenLinks slink
         join slink.parent screen
         join well.wellSamples ws
-        where slink.parent.id=%i
-        order by plate.id,
+        where slink.parent.id in (:ids)
+        order by screen.id,
+                 plate.id,
                  index(ws),
                  well.row,
                  well.column,
                  ws.image.id
-        """ % args.screen
+        """
+
+    sql = 'select ' + ', '.join(sql_columns) + """
+        from well
+        join plate on plate.id = well.plate
+        join screen_plate slink on slink.child = plate.id
+        join screen on screen.id = slink.parent
+        join well_sample ws on ws.well = well.id
+        where screen.id in (select id from ids)
+        order by screen.id,
+                 plate.id,
+                 ws.idx,
+                 well.row,
+                 well.col,
+                 ws.image
+        """
 
-    # Run the query
-    rows = conn_manager.hql_query(q)
+    if args.local:
 
-    # Replace Row+Column IDs with a more meaningful Well designation
-    # E.g. Row 3, Column 2: D3
-    for row in rows:
+        # Answer from the local index of the hierarchy
+        rows = local_query(conn_manager, sql, ids=screens)
 
-        # Calculate the Well and assign it to the position that row was in
-        row[first_well] = well_from_row_col(row[first_well],
-                                            row[first_well + 1])
+    else:
 
-        # Remove the column field altogether
-        row.pop(first_well + 1)
+        # Run the query over all the screens, binding their IDs a chunk at a
+        # time. Chunks are run concurrently over a pool of connections if
+        # there are several
+        rows = iter_hql_query_ids(conn_manager, q, screens,
+                                  connections=args.connections)
 
-    header.extend(['Plate ID', 'Field', 'Well', 'Image ID'])
+    result = ResultSet.stream(names, rows)
 
-    # Print results (if not quieted)
-    if args.quiet is False:
-        print(', '.join(header))
-        for row in rows:
-            print(', '.join([str(item) for item in row]))
+    # Replace Row+Column IDs with a more meaningful Well designation
+    # E.g. Row 3, Column 2: D3
+    result = replace_row_col_with_well(result)
 
-    # Output CSV file (if specified)
-    if args.file is not None:
-        write_csv(rows, args.file, header)
+    # Print results (if not quieted) and output file (if specified) in a
+    # single pass as they stream past
+    count = write_rows(result, filename=args.file, quiet=args.quiet,
+                       output_format=args.format)
+    report_written(count, args.file)
 
 
 if __name__ == '__main__':
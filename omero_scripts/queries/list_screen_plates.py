@@ -2,56 +2,95 @@
 
 import sys
 from argparse import ArgumentParser
-from ..omero_basics import OMEROConnectionManager, write_csv
+from ..omero_basics import (OMEROConnectionManager, add_connection_arguments,
+                            add_cache_arguments, add_format_arguments,
+                            cache_from_args, write_rows, report_written,
+                            iter_hql_query_ids, ids_from_args,
+                            add_local_arguments, local_query, ResultSet)
 
 
 def main(argv=sys.argv):
 
     # Configure argument parsing
-    parser = ArgumentParser(description='List all plates in a screen')
-    parser.add_argument('screen', type=int)
+    parser = ArgumentParser(description='''List all plates in one or more
+                                           screens''')
+    parser.add_argument('screen', type=int, nargs='*',
+                        help='''Screen IDs. Read from stdin if none are
+                                given''')
     parser.add_argument('-q', '--quiet', action='store_const', const=True,
                         default=False, help='Do not print output')
     parser.add_argument('-n', '--nonames', action='store_const', const=True,
                         default=False, help='Do not print names')
     parser.add_argument('-f', '--file', metavar='file',
-                        help='Destination CSV file')
-    args = parser.parse_args()
+                        help='''Destination file. Compressed if it ends
+                                in .gz or .zst''')
+    add_format_arguments(parser)
+    add_local_arguments(parser)
+    add_connection_arguments(parser, pool=True)
+    add_cache_arguments(parser)
+    args = parser.parse_args(argv[1:])
 
-    # Create an OMERO Connection with our basic connection manager
-    conn_manager = OMEROConnectionManager()
+    screens = ids_from_args(args.screen)
 
-    q = 'select'
-    header = []
+    # Create an OMERO Connection with our basic connection manager, answering
+    # repeated queries from the local cache if asked to
+    conn_manager = OMEROConnectionManager(cache=cache_from_args(args),
+                                          detach=args.keep_session)
+
+    # The name of each column and its expression in the same query of the
+    # server in HQL and of the local index in SQL
+    columns = []
+
+    # Identify the screen of each row if there are several
+    if len(set(screens)) > 1:
+        columns.append(('Screen ID', 'screen.id', 'screen.id'))
 
     if not args.nonames:
-        q += ' screen.name, '
-        q += ' plate.name, '
-        header.append('Screen Name')
-        header.append('Plate Name')
+        columns.append(('Screen Name', 'screen.name', 'screen.name'))
+        columns.append(('Plate Name', 'plate.name', 'plate.name'))
+
+    columns.append(('Plate ID', 'plate.id', 'plate.id'))
+
+    names, hql_columns, sql_columns = zip(*columns)
 
-    q += """
-               plate.id
+    q = 'select ' + ', '.join(hql_columns) + """
         from Plate plate
         join plate.screenLinks slink
         join slink.parent screen
-        where slink.parent.id=%i
-        """ % args.screen
+        where slink.parent.id in (:ids)
+        order by screen.id,
+                 plate.id
+        """
+
+    sql = 'select ' + ', '.join(sql_columns) + """
+        from screen_plate slink
+        join screen on screen.id = slink.parent
+        join plate on plate.id = slink.child
+        where screen.id in (select id from ids)
+        order by screen.id,
+                 plate.id
+        """
+
+    if args.local:
+
+        # Answer from the local index of the hierarchy
+        rows = local_query(conn_manager, sql, ids=screens)
 
-    # Run the query
-    rows = conn_manager.hql_query(q)
+    else:
 
-    header.append('Plate ID')
+        # Run the query over all the screens, binding their IDs a chunk at a
+        # time. Chunks are run concurrently over a pool of connections if
+        # there are several
+        rows = iter_hql_query_ids(conn_manager, q, screens,
+                                  connections=args.connections)
 
-    # Print results (if not quieted)
-    if args.quiet is False:
-        print(', '.join(header))
-        for row in rows:
-            print(', '.join([str(item) for item in row]))
+    result = ResultSet.stream(names, rows)
 
-    # Output CSV file (if specified)
-    if args.file is not None:
-        write_csv(rows, args.file, header)
+    # Print results (if not quieted) and output file (if specified) in a
+    # single pass as they stream past
+    count = write_rows(result, filename=args.file, quiet=args.quiet,
+                       output_format=args.format)
+    report_written(count, args.file)
 
 
 if __name__ == '__main__':
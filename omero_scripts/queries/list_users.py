@@ -2,8 +2,23 @@
 
 import sys
 from argparse import ArgumentParser
-from ..omero_basics import OMEROConnectionManager, write_csv
-from omero.sys import ParametersI
+from ..omero_basics import (OMEROConnectionManager, add_connection_arguments,
+                            add_cache_arguments, add_format_arguments,
+                            cache_from_args, write_rows, report_written,
+                            ResultSet)
+
+# Users rarely change so cached results are used for longer
+CACHE_TTL = 3600
+
+# The name of each column and the expression selecting it
+COLUMNS = [
+    ('Username', 'experimenter.omeName'),
+    ('Firstname', 'experimenter.firstName'),
+    ('Lastname', 'experimenter.lastName'),
+    ('Institution', 'experimenter.institution'),
+    ('Email', 'experimenter.email'),
+    ('ID', 'experimenter.id')
+]
 
 
 def main(argv=sys.argv):
@@ -13,40 +28,34 @@ def main(argv=sys.argv):
     parser.add_argument('-q', '--quiet', action='store_const', const=True,
                         default=False, help='Do not print output')
     parser.add_argument('-f', '--file', metavar='file',
-                        help='Destination CSV file')
-    args = parser.parse_args()
-
-    # Create an OMERO Connection with our basic connection manager
-    conn_manager = OMEROConnectionManager()
-
-    q = '''
-        SELECT experimenter.omeName,
-               experimenter.firstName,
-               experimenter.lastName,
-               experimenter.institution,
-               experimenter.email,
-               experimenter.id
+                        help='''Destination file. Compressed if it ends
+                                in .gz or .zst''')
+    add_format_arguments(parser)
+    add_connection_arguments(parser)
+    add_cache_arguments(parser, ttl=CACHE_TTL)
+    args = parser.parse_args(argv[1:])
+
+    # Create an OMERO Connection with our basic connection manager, answering
+    # repeated queries from the local cache if asked to
+    conn_manager = OMEROConnectionManager(cache=cache_from_args(args),
+                                          detach=args.keep_session)
+
+    names, hql_columns = zip(*COLUMNS)
+
+    q = 'SELECT ' + ', '.join(hql_columns) + '''
         FROM Experimenter experimenter
         ORDER BY experimenter.omeName
         DESC
         '''
 
-    # Run the query
-    rows = conn_manager.hql_query(q)
-    header = ['Username', 'Firstname', 'Lastname', 'Institution', 'Email',
-              'ID']
-
-    # Print results (if not quieted)
-    if args.quiet is False:
-        print(', '.join(header))
-        for row in rows:
-            print(', '.join([str(item) for item in row]))
-
-    # Output CSV file (if specified)
-    if args.file is not None:
-        write_csv(rows,
-                  args.file,
-                  header)
+    # Run the query, streaming the results a page at a time
+    result = ResultSet.stream(names, conn_manager.iter_hql_query(q))
+
+    # Print results (if not quieted) and output file (if specified) in a
+    # single pass as they stream past
+    count = write_rows(result, filename=args.file, quiet=args.quiet,
+                       output_format=args.format)
+    report_written(count, args.file)
 
 
 if __name__ == '__main__':
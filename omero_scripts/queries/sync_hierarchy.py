@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import sys
+import time
+from argparse import ArgumentParser
+from ..omero_basics import OMEROConnectionManager, add_connection_arguments
+from ..hierarchy_index import HierarchyIndex
+
+
+def main(argv=sys.argv):
+
+    # Configure argument parsing
+    parser = ArgumentParser(description='''Build or update the local index of
+                                           projects, datasets, screens,
+                                           plates, wells and images used by
+                                           the list scripts' --local option''')
+    parser.add_argument('-q', '--quiet', action='store_const', const=True,
+                        default=False, help='Do not print progress')
+    parser.add_argument('--rebuild', action='store_const', const=True,
+                        default=False,
+                        help='Fetch everything again instead of only changes')
+    add_connection_arguments(parser)
+    args = parser.parse_args(argv[1:])
+
+    # Create an OMERO Connection with our basic connection manager. The query
+    # cache is not used as the index must reflect the server as it is now
+    conn_manager = OMEROConnectionManager(detach=args.keep_session)
+    conn_params = conn_manager.get_params()
+
+    index = HierarchyIndex(HierarchyIndex.path_for(conn_params['host'],
+                                                   conn_params['username']))
+
+    start = time.time()
+    try:
+        for table, updated, deleted in index.sync(conn_manager,
+                                                  rebuild=args.rebuild):
+            if not args.quiet:
+                print('{}: {} updated, {} deleted'.format(table, updated,
+                                                          deleted))
+    finally:
+        index.close()
+
+    sys.stderr.write('Synced {} in {:.1f}s\n'.format(
+        index.path, time.time() - start
+    ))
+
+
+if __name__ == '__main__':
+    main()
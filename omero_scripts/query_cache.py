@@ -0,0 +1,271 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+# Location of the cache, alongside the OMERO configuration file
+DEFAULT_CACHE_FILE = Path.home() / '.omero' / 'query_cache.sqlite'
+
+# Seconds for which a cached result is considered fresh
+DEFAULT_CACHE_TTL = 300
+
+# Total size of cached results before the least recently used are evicted
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+
+# Number of rows stored together in a single compressed chunk
+CHUNK_ROWS = 5000
+
+# Seconds after which an incomplete entry is assumed to be abandoned
+ABANDONED_AGE = 24 * 60 * 60
+
+# Seconds for which a superseded entry is kept for readers still reading it
+SUPERSEDED_AGE = 60 * 60
+
+# States of an entry
+INCOMPLETE = 0
+COMPLETE = 1
+SUPERSEDED = 2
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS entries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT NOT NULL,
+        created REAL NOT NULL,
+        accessed REAL NOT NULL,
+        size INTEGER NOT NULL DEFAULT 0,
+        complete INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS entries_key ON entries (key);
+    CREATE TABLE IF NOT EXISTS chunks (
+        entry INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (entry, seq)
+    );
+'''
+
+
+class QueryCache(object):
+    ''' Persistent cache of unwrapped HQL query results, stored in SQLite as
+        compressed chunks of rows. Results older than the TTL are ignored and
+        the least recently used results are evicted once the cache grows
+        beyond its maximum size. A cache may be used from several threads,
+        such as those of an OMEROConnectionPool, which share its database
+        connection one statement at a time '''
+
+    def __init__(self, path=DEFAULT_CACHE_FILE, ttl=DEFAULT_CACHE_TTL,
+                 max_size=DEFAULT_CACHE_SIZE, refresh=False):
+
+        self.path = str(path)
+        self.ttl = ttl
+        self.max_size = max_size
+
+        # If refreshing, cached results are never read, only replaced
+        self.refresh = refresh
+
+        self.db = None
+        self.lock = threading.RLock()
+
+    def open(self):
+        ''' Open (creating if necessary) the cache database '''
+
+        with self.lock:
+            if self.db is None:
+                os.makedirs(os.path.dirname(self.path), mode=0o700,
+                            exist_ok=True)
+                self.db = sqlite3.connect(self.path, timeout=30,
+                                          check_same_thread=False)
+                self.db.executescript(SCHEMA)
+                self.db.commit()
+
+        return self.db
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    @staticmethod
+    def key(host, username, group, query, params=None):
+        ''' Compute the cache key for a query. Whitespace in the query is
+            normalized so that reformatting the HQL does not miss the cache '''
+
+        identity = json.dumps([host, username, str(group),
+                               ' '.join(query.split()), params],
+                              sort_keys=True, default=str)
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        ''' Return an iterator over the cached rows for key, or None if there
+            is no fresh result in the cache '''
+
+        if self.refresh or self.ttl <= 0:
+            return None
+
+        db = self.open()
+        now = time.time()
+
+        with self.lock:
+            entry = db.execute(
+                'SELECT id FROM entries '
+                'WHERE key = ? AND complete = ? AND created >= ? '
+                'ORDER BY created DESC LIMIT 1',
+                (key, COMPLETE, now - self.ttl)
+            ).fetchone()
+
+            if entry is None:
+                return None
+
+            db.execute('UPDATE entries SET accessed = ? WHERE id = ?',
+                       (now, entry[0]))
+            db.commit()
+
+        return self._iter_entry(entry[0])
+
+    def _iter_entry(self, entry):
+
+        # Chunks are read one at a time, rather than through a cursor held
+        # open between them, so that other threads can use the connection
+        # while the rows are consumed
+        db = self.open()
+        seq = 0
+        while True:
+            with self.lock:
+                chunk = db.execute('SELECT data FROM chunks '
+                                   'WHERE entry = ? AND seq = ?',
+                                   (entry, seq)).fetchone()
+            if chunk is None:
+                break
+
+            for row in json.loads(zlib.decompress(chunk[0]).decode('utf-8')):
+                yield row
+            seq += 1
+
+    def store(self, key, rows):
+        ''' Yield rows unchanged while storing them in the cache under key.
+            The result only becomes visible to readers once all the rows have
+            been consumed; if iteration is abandoned it is discarded. Results
+            larger than the cache are not stored, and are discarded as soon
+            as they outgrow it '''
+
+        db = self.open()
+        now = time.time()
+
+        with self.lock:
+            entry = db.execute(
+                'INSERT INTO entries (key, created, accessed) '
+                'VALUES (?, ?, ?)', (key, now, now)
+            ).lastrowid
+            db.commit()
+
+        size = 0
+        storing = True
+        complete = False
+        try:
+            chunk = []
+            seq = 0
+            for row in rows:
+                if storing:
+                    # Copy, as consumers are free to modify the rows yielded
+                    chunk.append(list(row))
+                    if len(chunk) == CHUNK_ROWS:
+                        size += self._write_chunk(entry, seq, chunk)
+                        seq += 1
+                        chunk = []
+                        storing = self._within_size(entry, size)
+                yield row
+
+            if storing and chunk:
+                size += self._write_chunk(entry, seq, chunk)
+                storing = self._within_size(entry, size)
+
+            complete = True
+
+        finally:
+            with self.lock:
+                if complete and storing:
+                    # Publish this result. Any it supersedes are no longer
+                    # read, but are kept for a while for readers still
+                    # reading them
+                    db.execute('UPDATE entries SET complete = ?, size = ? '
+                               'WHERE id = ?', (COMPLETE, size, entry))
+                    db.execute('UPDATE entries SET complete = ? '
+                               'WHERE key = ? AND id != ? AND complete = ?',
+                               (SUPERSEDED, key, entry, COMPLETE))
+                    db.commit()
+                    self.evict()
+                elif storing:
+                    self._delete(db, 'id = ?', (entry,))
+                    db.commit()
+
+    def _within_size(self, entry, size):
+        ''' Check that a result being stored is no larger than the cache,
+            discarding it if it is '''
+
+        if size <= self.max_size:
+            return True
+
+        with self.lock:
+            self._delete(self.db, 'id = ?', (entry,))
+            self.db.commit()
+        return False
+
+    def _write_chunk(self, entry, seq, chunk):
+        data = zlib.compress(json.dumps(chunk, default=str,
+                                        separators=(',', ':')).encode('utf-8'))
+        with self.lock:
+            self.db.execute('INSERT INTO chunks (entry, seq, data) '
+                            'VALUES (?, ?, ?)', (entry, seq, data))
+            self.db.commit()
+        return len(data)
+
+    @staticmethod
+    def _delete(db, where, args):
+        ids = [row[0] for row in
+               db.execute('SELECT id FROM entries WHERE ' + where, args)]
+        for entry in ids:
+            db.execute('DELETE FROM chunks WHERE entry = ?', (entry,))
+            db.execute('DELETE FROM entries WHERE id = ?', (entry,))
+
+    def evict(self):
+        ''' Remove abandoned and superseded entries, then the least recently
+            used entries until the cache is within its maximum size '''
+
+        db = self.open()
+        now = time.time()
+
+        with self.lock:
+            self._delete(db, 'complete = ? AND created < ?',
+                         (INCOMPLETE, now - ABANDONED_AGE))
+            self._delete(db, 'complete = ? AND accessed < ?',
+                         (SUPERSEDED, now - SUPERSEDED_AGE))
+
+            total = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries '
+                               'WHERE complete != ?',
+                               (INCOMPLETE,)).fetchone()[0]
+
+            if total > self.max_size:
+                entries = db.execute('SELECT id, size FROM entries '
+                                     'WHERE complete != ? '
+                                     'ORDER BY accessed',
+                                     (INCOMPLETE,)).fetchall()
+                for entry, size in entries:
+                    if total <= self.max_size:
+                        break
+                    self._delete(db, 'id = ?', (entry,))
+                    total -= size
+
+            db.commit()
+
+    def invalidate(self):
+        ''' Remove all cached results '''
+        db = self.open()
+        with self.lock:
+            db.execute('DELETE FROM chunks')
+            db.execute('DELETE FROM entries')
+            db.commit()
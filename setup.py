@@ -15,6 +15,11 @@ requires = [
     'omero-py>=5.6.0'
 ]
 
+extras = {
+    'zstd': ['zstandard>=0.11.0'],
+    'arrow': ['pyarrow>=4.0.0']
+}
+
 
 def read_version():
     config = ConfigParser()
@@ -36,10 +41,13 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=requires,
+    extras_require=extras,
     python_requires="~=3.5",
     entry_points={
         'console_scripts': [
+            'omero-scripts=omero_scripts.cli:main',
             'zmovie=omero_scripts.analysis.zmovie:main',
+            'zmovie_batch=omero_scripts.analysis.zmovie_batch:main',
             'list_all_projects_with_datasets=omero_scripts.queries.list_all_projects_with_datasets:main',
             'list_plate_images=omero_scripts.queries.list_plate_images:main',
             'list_project_images=omero_scripts.queries.list_project_images:main',
@@ -47,6 +55,7 @@ setup(
             'list_screen_plates=omero_scripts.queries.list_screen_plates:main',
             'list_imports=omero_scripts.queries.list_imports:main',
             'list_users=omero_scripts.queries.list_users:main',
+            'sync_hierarchy=omero_scripts.queries.sync_hierarchy:main',
             'csv2yaml=omero_scripts.conversion.csv2yaml:main'
         ]
     },
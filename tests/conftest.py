@@ -0,0 +1,45 @@
+''' Fixtures running the scripts against the fake server of
+    benchmarks/fake_omero.py, so that they can be tested without an OMERO
+    server. Tests needing omero-py are skipped if it is not installed '''
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'benchmarks'))
+
+# Credentials for the fake server, which accepts anything
+PARAMS = {
+    'host': 'localhost',
+    'port': 4064,
+    'username': 'user0',
+    'password': 'password'
+}
+
+
+@pytest.fixture
+def catalog():
+    ''' A small synthetic catalog, served to every new BlitzGateway '''
+    pytest.importorskip('omero.gateway')
+    from fake_omero import Catalog, install
+    c = Catalog(images=100, screens=2500, plates=2, fields=1)
+    install(c)
+    return c
+
+
+@pytest.fixture
+def params():
+    return dict(PARAMS)
+
+
+@pytest.fixture
+def session(tmp_path, monkeypatch):
+    ''' A throwaway home directory and a current session with the fake
+        server, for tests running the scripts' main functions '''
+    from omero_scripts import omero_basics
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setattr(omero_basics, 'get_params_from_session',
+                        lambda: dict(PARAMS))
+    return tmp_path
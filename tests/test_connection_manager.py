@@ -0,0 +1,26 @@
+import pytest
+
+from omero_scripts.omero_basics import OMEROConnectionManager
+
+from test_pool import SCREEN_PLATES, expected_plates
+
+
+@pytest.mark.parametrize('page_size', [3, 5, 20, 30])
+def test_iter_hql_query_pages(catalog, params, page_size):
+    ''' Rows are the same however they are split into pages, including when
+        the last page is full '''
+
+    from omero.sys import ParametersI
+
+    screens = list(range(1, 11))
+    bound = ParametersI()
+    bound.addIds(screens)
+
+    conn_manager = OMEROConnectionManager(params=params, resident=False)
+    try:
+        rows = list(conn_manager.iter_hql_query(SCREEN_PLATES, bound,
+                                                page_size=page_size))
+    finally:
+        conn_manager.disconnect()
+
+    assert rows == expected_plates(catalog, screens)
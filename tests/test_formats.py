@@ -0,0 +1,50 @@
+import pytest
+
+from omero_scripts.formats import open_row_writer
+from omero_scripts.omero_basics import ResultSet
+
+pyarrow = pytest.importorskip('pyarrow')
+
+NAMES = ['Project ID', 'Dataset Name']
+
+# The first batch of the category column is entirely null
+BATCHES = [
+    [(1, None), (2, None)],
+    [(3, 'dataset-1'), (4, None), (5, 'dataset-2')],
+    [(6, 'dataset-2'), (7, 'dataset-3')]
+]
+
+
+@pytest.mark.parametrize('columnar', [True, False])
+@pytest.mark.parametrize('extension', ['arrow', 'parquet'])
+def test_category_null_then_populated(tmp_path, extension, columnar,
+                                      monkeypatch):
+    ''' A category column with no values in the first batch is extended,
+        rather than replaced, by the values of later batches, whether they
+        are written as record batches or as rows '''
+
+    from omero_scripts import formats
+
+    import pyarrow.feather
+    import pyarrow.parquet
+
+    read = {'parquet': pyarrow.parquet.read_table,
+            'arrow': pyarrow.feather.read_table}[extension]
+    filename = str(tmp_path / 'out.{}'.format(extension))
+
+    # Flush every two rows, so that the first row group has no categories
+    monkeypatch.setattr(formats, 'ROW_GROUP_SIZE', 2)
+
+    writer = open_row_writer(filename, NAMES)
+    for rows in BATCHES:
+        if columnar:
+            for batch in ResultSet.from_rows(NAMES, rows).iter_arrow():
+                writer.write_arrow(batch)
+        else:
+            for row in rows:
+                writer.write(row)
+    writer.close()
+
+    table = read(filename)
+    assert [tuple(row.values()) for row in table.to_pylist()] == \
+        [row for rows in BATCHES for row in rows]
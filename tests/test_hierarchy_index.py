@@ -0,0 +1,42 @@
+import pytest
+
+from omero_scripts.hierarchy_index import HierarchyIndex
+
+
+def test_sync_scans_deletions_only_when_updating(params, tmp_path,
+                                                 monkeypatch):
+    ''' Deleted objects are only looked for when updating a table, not when
+        it is fetched from scratch by a first sync or a rebuild '''
+
+    pytest.importorskip('omero.gateway')
+    from fake_omero import Catalog, install
+    from omero_scripts.omero_basics import OMEROConnectionManager
+
+    install(Catalog(projects=2, datasets=2, images=5, screens=1, plates=1,
+                    fields=1))
+    conn_manager = OMEROConnectionManager(params=params, resident=False)
+
+    scanned = []
+    sync_deleted = HierarchyIndex._sync_deleted
+
+    def record(self, conn_manager, table, entity, last):
+        scanned.append(table)
+        return sync_deleted(self, conn_manager, table, entity, last)
+
+    monkeypatch.setattr(HierarchyIndex, '_sync_deleted', record)
+
+    index = HierarchyIndex(tmp_path / 'index.sqlite')
+    try:
+        first = list(index.sync(conn_manager))
+        assert scanned == []
+        assert all(deleted == 0 for _, _, deleted in first)
+        assert sum(updated for _, updated, _ in first) > 0
+
+        list(index.sync(conn_manager))
+        assert scanned == [table for table, _, _ in first]
+
+        del scanned[:]
+        list(index.sync(conn_manager, rebuild=True))
+        assert scanned == []
+    finally:
+        index.close()
@@ -0,0 +1,111 @@
+import pytest
+
+from omero_scripts.queries import list_all_projects_with_datasets as script
+
+
+def test_iter_keyset_pages(catalog, params):
+    ''' Paging by key yields the same rows as a single page, and resumes
+        after a key '''
+
+    from omero.sys import ParametersI
+    from omero_scripts.omero_basics import OMEROConnectionManager
+
+    conn_manager = OMEROConnectionManager(params=params, resident=False)
+    query = '''
+        select project.id, dataset.id
+        from Project project
+        left outer join project.datasetLinks pdlink
+        left outer join pdlink.child dataset
+        {where}
+        order by project.id, dataset.id
+        '''
+
+    def keyset(**kwargs):
+        bound = ParametersI()
+        bound.map = {}
+        return list(script.iter_keyset(conn_manager, query, [], bound,
+                                       (0, 1), **kwargs))
+
+    rows = keyset()
+    assert len(rows) == catalog.projects * catalog.datasets
+    assert keyset(page_size=7) == rows
+    assert keyset(key=rows[41], page_size=7) == rows[42:]
+
+
+def test_resume(catalog, session, monkeypatch):
+    ''' An export interrupted part way through is resumed after the last row
+        written, appending to the destination file '''
+
+    full = session / 'full.csv'
+    script.main(['list_all_projects_with_datasets', '-q', '-f', str(full)])
+
+    write_rows = script.write_rows
+
+    def interrupted(rows, **kwargs):
+        def rows_until_interrupted():
+            for i, row in enumerate(rows):
+                if i == 45:
+                    raise KeyboardInterrupt()
+                yield row
+        return write_rows(rows_until_interrupted(), header=rows.names,
+                          checkpoint_rows=10, **kwargs)
+
+    state = session / 'state.json'
+    resumed = session / 'resumed.csv'
+    argv = ['list_all_projects_with_datasets', '-q', '-f', str(resumed),
+            '--state', str(state)]
+
+    monkeypatch.setattr(script, 'write_rows', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        script.main(argv)
+    assert state.exists()
+    assert len(resumed.read_text().splitlines()) == 46
+
+    monkeypatch.setattr(script, 'write_rows', write_rows)
+    script.main(argv)
+    assert not state.exists()
+    assert resumed.read_text() == full.read_text()
+
+
+def test_resume_after_failed_write(catalog, session, monkeypatch):
+    ''' A row which fails to be written is not checkpointed, so that the
+        resumed export starts with it '''
+
+    from omero_scripts.formats import CSVRowWriter
+
+    full = session / 'full.csv'
+    script.main(['list_all_projects_with_datasets', '-q', '-f', str(full)])
+
+    write = CSVRowWriter.write
+    written = []
+
+    def broken(self, row):
+        if len(written) == 45:
+            raise BrokenPipeError()
+        write(self, row)
+        written.append(row)
+
+    state = session / 'state.json'
+    resumed = session / 'resumed.csv'
+    argv = ['list_all_projects_with_datasets', '-q', '-f', str(resumed),
+            '--state', str(state)]
+
+    monkeypatch.setattr(CSVRowWriter, 'write', broken)
+    with pytest.raises(BrokenPipeError):
+        script.main(argv)
+    assert state.exists()
+
+    monkeypatch.setattr(CSVRowWriter, 'write', write)
+    script.main(argv)
+    assert not state.exists()
+    assert resumed.read_text() == full.read_text()
+
+
+@pytest.mark.parametrize('argv', [['-f', 'out.parquet'],
+                                  ['-f', 'out.csv', '--format', 'arrow']])
+def test_resume_requires_append(argv, capsys):
+    with pytest.raises(SystemExit) as e:
+        script.main(['list_all_projects_with_datasets', '--state',
+                     'state.json'] + argv)
+    assert e.value.code == 2
+    assert 'appended' in capsys.readouterr().err
@@ -0,0 +1,78 @@
+import csv
+import datetime
+import io
+
+import pytest
+
+from omero_scripts.period_store import PeriodCountStore
+from omero_scripts.queries import list_imports as script
+
+
+@pytest.fixture
+def store(session, monkeypatch):
+    path = session / 'period_counts.sqlite'
+    monkeypatch.setattr(script, 'PeriodCountStore',
+                        lambda: PeriodCountStore(path))
+    return path
+
+
+@pytest.mark.parametrize('period', ['day', 'month'])
+@pytest.mark.parametrize('closed', [None, datetime.datetime(2020, 7, 1)])
+def test_incremental(catalog, session, store, period, closed, monkeypatch):
+    ''' Counting incrementally, whether first storing the closed periods or
+        then merging them with those still open, gives the same report as
+        counting in full. The catalog's imports are all in 2020, so its
+        periods are all closed unless closing is put back to mid 2020 '''
+
+    if closed is not None:
+        monkeypatch.setattr(script, 'CLOSED_MARGIN',
+                            datetime.datetime.utcnow() - closed)
+
+    def report(name, *options):
+        path = session / '{}.csv'.format(name)
+        script.main(['list_imports', '-q', '-a', '-p', period,
+                     '-f', str(path)] + list(options))
+        return path.read_text()
+
+    full = report('full')
+    assert len(full.splitlines()) > 1
+    assert report('first', '-i') == full
+    assert report('merged', '-i') == full
+    assert report('rebuilt', '--rebuild') == full
+
+
+def test_incremental_ignores_collation(catalog, session, store,
+                                       monkeypatch):
+    ''' A full count is listed in the same order as an incremental one,
+        by code point, even if the server's collation ignores case '''
+
+    # Every other user of each group is capitalized
+    def user_name(user):
+        upper = user // catalog.groups % 2
+        return ('User{}' if upper else 'user{}').format(user)
+
+    monkeypatch.setattr(catalog, 'user_name', user_name)
+    catalog.collation = str.lower
+
+    def report(name, *options):
+        path = session / '{}.csv'.format(name)
+        script.main(['list_imports', '-q', '-a', '-f', str(path)] +
+                    list(options))
+        return path.read_text()
+
+    full = report('full')
+    users = [tuple(row[:2])
+             for row in list(csv.reader(io.StringIO(full)))[1:]]
+    assert users == sorted(users)
+    assert users != sorted(users, key=lambda user: (user[0].lower(),
+                                                    user[1].lower()))
+    assert report('first', '-i') == full
+    assert report('merged', '-i') == full
+
+
+@pytest.mark.parametrize('option', ['-i', '--rebuild'])
+def test_incremental_requires_all(option, capsys):
+    with pytest.raises(SystemExit) as e:
+        script.main(['list_imports', option])
+    assert e.value.code == 2
+    assert '-a/--all' in capsys.readouterr().err
@@ -0,0 +1,37 @@
+import pytest
+
+from omero_scripts.analysis.plane_cache import PlaneCache
+
+numpy = pytest.importorskip('numpy')
+
+
+def test_put_scans_only_to_evict(tmp_path, monkeypatch):
+    ''' The cache directory is scanned once to count its size and then only
+        when planes must be evicted, which keeps it within its size '''
+
+    plane = numpy.zeros((32, 32, 3), dtype=numpy.uint8)
+    cache = PlaneCache(tmp_path, max_size=10 * plane.nbytes)
+
+    scans = []
+    scan = PlaneCache._scan
+
+    def count(self):
+        scans.append(1)
+        return scan(self)
+
+    monkeypatch.setattr(PlaneCache, '_scan', count)
+
+    for i in range(5):
+        cache.put(str(i), plane)
+        cache.put(str(i), plane)
+    assert len(scans) == 1
+
+    # Once full, every plane added does not evict
+    for i in range(5, 30):
+        cache.put(str(i), plane)
+    assert 1 < len(scans) < 15
+    assert cache.total <= cache.max_size
+    assert cache.total == scan(cache)[1]
+
+    assert cache.get('29').shape == plane.shape
+    assert cache.get('0') is None
@@ -0,0 +1,97 @@
+from omero_scripts.omero_basics import (OMEROConnectionManager,
+                                        OMEROConnectionPool,
+                                        iter_hql_query_ids)
+from omero_scripts.query_cache import QueryCache
+
+SCREEN_PLATES = '''
+    select screen.id, plate.id
+    from Plate plate
+    join plate.screenLinks slink
+    join slink.parent screen
+    where slink.parent.id in (:ids)
+    order by screen.id,
+             plate.id
+    '''
+
+
+def expected_plates(catalog, screens):
+    return [[screen, plate] for screen in sorted(set(screens))
+            for plate in range((screen - 1) * catalog.plates + 1,
+                               screen * catalog.plates + 1)]
+
+
+def test_pool_with_cache(catalog, params, tmp_path):
+    ''' More than one chunk of IDs run over a pool share the cache between
+        its threads, and are answered from it when repeated '''
+
+    screens = list(range(1, 2501))
+    expected = expected_plates(catalog, screens)
+
+    for _ in range(2):
+        cache = QueryCache(tmp_path / 'cache.sqlite')
+        conn_manager = OMEROConnectionManager(cache=cache, params=params,
+                                              resident=False)
+        pool = OMEROConnectionPool(4, params=params, cache=cache,
+                                   keepalive=0)
+        try:
+            rows = list(iter_hql_query_ids(conn_manager, SCREEN_PLATES,
+                                           screens, pool))
+        finally:
+            pool.close()
+            cache.close()
+        assert rows == expected
+
+
+def test_ids_chunked_over_pool(catalog, params, monkeypatch):
+    ''' A pool is created only for more than one chunk, and closed once they
+        have been read or abandoned '''
+
+    from omero_scripts import omero_basics
+
+    pools = []
+
+    class RecordedPool(OMEROConnectionPool):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            pools.append(self)
+
+    monkeypatch.setattr(omero_basics, 'OMEROConnectionPool', RecordedPool)
+    conn_manager = OMEROConnectionManager(params=params, resident=False)
+
+    screens = list(range(1, 11))
+    rows = list(iter_hql_query_ids(conn_manager, SCREEN_PLATES, screens,
+                                   connections=4))
+    assert rows == expected_plates(catalog, screens)
+    assert pools == []
+
+    screens = list(range(2500, 0, -1))
+    rows = list(iter_hql_query_ids(conn_manager, SCREEN_PLATES, screens,
+                                   chunk_size=100, connections=4))
+    assert rows == expected_plates(catalog, screens)
+    assert len(pools) == 1 and pools[0].closed.is_set()
+
+    rows = iter_hql_query_ids(conn_manager, SCREEN_PLATES, screens,
+                              chunk_size=100, connections=4)
+    assert next(rows) == [1, 1]
+    rows.close()
+    assert len(pools) == 2 and pools[1].closed.is_set()
+
+
+def test_paged_queries_over_pool(catalog, params):
+    ''' Each query is run a page at a time, and the rows of all of them are
+        yielded in order '''
+
+    from omero.sys import ParametersI
+    from omero_scripts.omero_basics import iter_paged_hql_queries
+
+    chunks = [list(range(i, i + 7)) for i in range(1, 50, 7)]
+    queries = []
+    for chunk in chunks:
+        bound = ParametersI()
+        bound.addIds(chunk)
+        queries.append((SCREEN_PLATES, bound))
+
+    with OMEROConnectionPool(2, params=params, keepalive=0) as pool:
+        rows = list(iter_paged_hql_queries(pool, queries, page_size=3))
+
+    assert rows == expected_plates(catalog, range(1, 50))
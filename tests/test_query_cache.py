@@ -0,0 +1,76 @@
+import threading
+from argparse import ArgumentParser
+
+from omero_scripts.omero_basics import add_cache_arguments, cache_from_args
+from omero_scripts.query_cache import QueryCache, CHUNK_ROWS
+
+
+def rows(n, tag=''):
+    return [[i, '{}{}'.format(tag, i)] for i in range(n)]
+
+
+def test_store_and_get(tmp_path):
+    cache = QueryCache(tmp_path / 'cache.sqlite')
+    assert cache.get('key') is None
+    assert list(cache.store('key', rows(CHUNK_ROWS + 1))) == \
+        rows(CHUNK_ROWS + 1)
+    assert list(cache.get('key')) == rows(CHUNK_ROWS + 1)
+
+
+def test_abandoned_store_is_discarded(tmp_path):
+    cache = QueryCache(tmp_path / 'cache.sqlite')
+    stored = cache.store('key', rows(10))
+    next(stored)
+    stored.close()
+    assert cache.get('key') is None
+
+
+def test_larger_than_cache_is_not_stored(tmp_path):
+    ''' All of the rows of a result too large for the cache are yielded, but
+        it is not stored '''
+    cache = QueryCache(tmp_path / 'cache.sqlite', max_size=1024)
+    assert list(cache.store('key', rows(3 * CHUNK_ROWS))) == \
+        rows(3 * CHUNK_ROWS)
+    assert cache.get('key') is None
+    assert cache.open().execute('SELECT COUNT(*) FROM chunks').fetchone() \
+        == (0,)
+
+
+def test_several_threads(tmp_path):
+    ''' Threads storing and reading results at once through one cache '''
+
+    cache = QueryCache(tmp_path / 'cache.sqlite')
+    results = {}
+    errors = []
+
+    def run(i):
+        try:
+            key = 'key{}'.format(i % 4)
+            expected = rows(CHUNK_ROWS + 10, key)
+            for _ in range(3):
+                cached = cache.get(key)
+                if cached is None:
+                    cached = cache.store(key, iter(expected))
+                results[i] = list(cached) == expected
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert all(results.values()) and len(results) == 8
+
+
+def test_cache_is_opt_in():
+    parser = ArgumentParser()
+    add_cache_arguments(parser)
+    assert cache_from_args(parser.parse_args([])) is None
+    assert cache_from_args(parser.parse_args(['--no-cache'])) is None
+    assert isinstance(cache_from_args(parser.parse_args(['--cache'])),
+                      QueryCache)
+    cache = cache_from_args(parser.parse_args(['--refresh']))
+    assert cache.refresh
@@ -0,0 +1,90 @@
+import pytest
+
+from omero_scripts.omero_basics import ResultSet, write_rows
+
+numpy = pytest.importorskip('numpy')
+
+NAMES = ['Plate Name', 'Plate ID', 'Score', 'Well', 'Note']
+
+ROWS = [
+    ('plate-1', 1, 0.5, 'A1', None),
+    ('plate-1', 2, None, 'A2', None),
+    (None, 3, 1.5, 'A1', 'retake'),
+    ('plate-2', None, 2.5, 'B1', None),
+    ('plate-2', 5, 3.5, None, 'ok')
+]
+
+
+def test_round_trip():
+    result = ResultSet.from_rows(NAMES, ROWS)
+    assert list(result) == ROWS
+    assert len(result) == len(ROWS)
+    assert result.types == ['category', 'int', 'string', 'category',
+                            'string']
+
+
+def test_concatenate_merges_dictionaries():
+    ''' Batches are joined with the dictionaries of their strings merged,
+        including columns entirely null in the first batch '''
+
+    result = ResultSet.stream(NAMES, iter(ROWS), batch_size=2).collect()
+    assert len(result.batches) == 1
+    assert list(result) == ROWS
+
+    codes, dictionary = result.codes('Plate Name')
+    assert dictionary == ['plate-1', 'plate-2']
+    assert codes.tolist() == [0, 0, -1, 1, 1]
+
+    assert result.column('Plate ID').mask.tolist() == [False] * 3 + \
+        [True, False]
+
+
+def test_streamed_once():
+    result = ResultSet.stream(NAMES, iter(ROWS))
+    assert list(iter(result)) == ROWS
+    with pytest.raises(ValueError):
+        list(iter(result))
+
+
+def test_to_arrow():
+    pytest.importorskip('pyarrow')
+    table = ResultSet.from_rows(NAMES, ROWS).to_arrow()
+    assert table.column_names == NAMES
+    assert [tuple(row.values()) for row in table.to_pylist()] == ROWS
+    assert str(table.schema.field('Plate Name').type) == \
+        'dictionary<values=string, indices=int32, ordered=0>'
+
+
+@pytest.mark.parametrize('extension', ['parquet', 'arrow'])
+def test_write_columnar(tmp_path, extension, monkeypatch):
+    ''' A result set written a batch of columns at a time reads back the
+        same as when written a row at a time, with the dictionaries of its
+        categories extended from batch to batch '''
+
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.feather
+    import pyarrow.parquet
+    from omero_scripts import formats
+
+    monkeypatch.setattr(formats, 'ROW_GROUP_SIZE', 3)
+    read = {'parquet': pyarrow.parquet.read_table,
+            'arrow': pyarrow.feather.read_table}[extension]
+
+    def write_columns(rows, **kwargs):
+        # The rows of a result set are never written one at a time
+        with monkeypatch.context() as m:
+            m.setattr(formats.ArrowRowWriter, 'write', None)
+            return write_rows(rows, **kwargs)
+
+    tables = []
+    for rows, write in ((ResultSet.stream(NAMES, iter(ROWS), batch_size=2),
+                         write_columns),
+                        (iter(ROWS), write_rows)):
+        filename = str(tmp_path / 'out.{}'.format(extension))
+        assert write(rows, header=NAMES, filename=filename,
+                     quiet=True) == len(ROWS)
+        tables.append(read(filename))
+
+    assert tables[0].num_rows == len(ROWS)
+    assert tables[0].schema == tables[1].schema
+    assert tables[0].to_pylist() == tables[1].to_pylist()
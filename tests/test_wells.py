@@ -0,0 +1,23 @@
+import pytest
+
+from omero_scripts.omero_basics import ResultSet, replace_row_col_with_well
+
+pytest.importorskip('numpy')
+
+NAMES = ['Plate ID', 'Row', 'Column', 'Image ID']
+
+
+@pytest.mark.parametrize('rows, wells', [
+    ([], []),
+    ([(1, 3, 1, 10), (1, 0, 0, 11)], ['D2', 'A1']),
+    ([(1, 3, 1, 10), (1, None, 0, 11), (1, 0, None, 12)],
+     ['D2', None, None]),
+    ([(1, None, None, 10), (1, None, None, 11)], [None, None])
+])
+def test_replace_row_col_with_well(rows, wells):
+    ''' Wells are looked up for any number of rows, and are null where the
+        row or column is '''
+
+    result = replace_row_col_with_well(ResultSet.from_rows(NAMES, rows))
+    assert result.names == ['Plate ID', 'Well', 'Image ID']
+    assert [row[1] for row in result] == wells
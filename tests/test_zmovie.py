@@ -0,0 +1,57 @@
+import pytest
+
+from omero_scripts.analysis.zmovie import (PlaneRenderer, ZMovieError,
+                                           JPEG_COMPRESSION)
+
+numpy = pytest.importorskip('numpy')
+pytest.importorskip('cv2')
+
+
+class Image(object):
+    ''' Records the calls made to render its planes, failing those given '''
+
+    def __init__(self, failures=()):
+        self.calls = []
+        self.failures = set(failures)
+
+    def set_active_channels(self, channels, windows=None, colors=None):
+        self.calls.append(('settings', channels))
+
+    def renderImage(self, z, t, compression=None):
+        self.calls.append(('render', z, compression))
+        if z in self.failures:
+            return None
+        return numpy.zeros((4, 4, 3), dtype=numpy.uint8)
+
+    def _closeRE(self):
+        self.calls.append(('close',))
+
+
+def test_engine_set_up_once():
+    ''' Settings and compression are only sent again once they change, a
+        plane fails to render or the engine is closed '''
+
+    image = Image(failures=[2])
+    renderer = PlaneRenderer(image)
+    settings = [[0, [0, 255], 'FF0000']]
+
+    for z in range(4):
+        renderer.apply(settings)
+        if z == 2:
+            with pytest.raises(ZMovieError):
+                renderer.render(z, 0)
+        else:
+            renderer.render(z, 0)
+    renderer.close()
+    renderer.apply(settings)
+    renderer.render(4, 0)
+
+    compression = JPEG_COMPRESSION
+    assert image.calls == [
+        ('settings', [1]), ('render', 0, compression),
+        ('render', 1, None),
+        ('render', 2, None),
+        ('settings', [1]), ('render', 3, compression),
+        ('close',),
+        ('settings', [1]), ('render', 4, compression)
+    ]